@@ -5,6 +5,12 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+
+The site is deployed with WSGI (see the Procfile), not with this file.
+Measured with the loadtest command on one CPU and SQLite, ASGI was slower
+than WSGI, and async versions of the home page and the dashboard were no
+faster than the sync ones, so they were dropped and no ASGI server is
+installed.  Every page still works under ASGI if it is ever run that way.
 """
 
 import os
@@ -13,4 +19,5 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "HouseSwap.settings")
 
+# static files are served by WhiteNoiseMiddleware, the same as under WSGI
 application = get_asgi_application()
@@ -45,16 +45,24 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     "kswap.apps.KswapConfig",  # This object was created for us in /catalog/apps.py
     "django_countries",
+    "cities_light",
     "users.apps.UsersConfig",
 ]
 
 MIDDLEWARE = [
+    # only does anything with QUERY_TIMING = True, see below
+    "kswap.query_timing.QueryTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    # kept under ASGI too: Django runs it in a thread there, and it is what
+    # knows the hashed names of the static files
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # only does anything with REQUEST_PROFILING = True, see below
+    "kswap.profiling.ProfilingMiddleware",
+    "kswap.history.NavigationHistoryMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -132,12 +140,81 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = "/media/"
 
+# how many threads make the smaller copies of uploaded pictures in the
+# background - see kswap/variants.py.  0 makes them during the request
+IMAGE_WORKERS = 2
+
+# pictures uploaded in pieces are put together here before they are moved
+# into MEDIA_ROOT - see kswap/uploads.py.  If there is more than one web
+# server they all need to share this folder
+CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
+
+# how many cities have a choice in the city drop down of the property
+# search, the ones with the most homes - see kswap/facets.py
+FACET_CITY_OPTIONS = 50
+
+# the pages kept for the Back link, and where they are kept: "cookie" (a
+# signed cookie, nothing is written on the server), "cache" or "session"
+# see kswap/history.py
+NAVIGATION_HISTORY_SIZE = 10
+NAVIGATION_HISTORY_STORE = "cookie"
+
+# the results of the property search are cached for SEARCH_CACHE_TIMEOUT
+# seconds (0 turns the cache off), and the most recent SEARCH_CACHE_LOCAL_SIZE
+# of them are also kept in each process - see kswap/search_cache.py.  Left as
+# None it is 300 when CACHES is shared by every web server process and 0 with
+# the default local memory cache, where each process would have its own copy
+# of the numbers that throw the old results away
+SEARCH_CACHE_TIMEOUT = None
+SEARCH_CACHE_LOCAL_SIZE = 100
+
+# Server-Timing header with the number of queries and the database and
+# template time of every request, and a log of the slow ones with their
+# SQL - see kswap/query_timing.py.  Off unless QUERY_TIMING=1 is in the
+# environment, and then only a sample of the slow requests are logged
+QUERY_TIMING = os.environ.get("QUERY_TIMING") == "1"
+QUERY_TIMING_SLOW_MS = 500
+QUERY_TIMING_MAX_DUPLICATES = 10
+QUERY_TIMING_SAMPLE_RATE = 0.1
+
+# With REQUEST_PROFILING=1 in the environment a staff user can add
+# ?profile=1 to any page to run it under cProfile and tracemalloc.  The
+# results are saved in REQUEST_PROFILE_DIR and listed in the admin under
+# "Request profiles", which keeps the last REQUEST_PROFILE_KEEP of them -
+# see kswap/profiling.py
+REQUEST_PROFILING = os.environ.get("REQUEST_PROFILING") == "1"
+REQUEST_PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+REQUEST_PROFILE_KEEP = 50
+
+# the numbers on the home page are kept in the SiteCounter table.  With
+# this set, refresh_site_stats uses the table sizes Postgres estimates
+# instead of counting every row - see SiteCounter in kswap/models.py
+SITE_STATS_ESTIMATED = False
+
 # Update database configuration from $DATABASE_URL.
 import dj_database_url
 
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES["default"].update(db_from_env)
 
+# SQLite only lets one transaction write at a time.  When lots of
+# bookings arrive together the others wait up to this many seconds
+# for their turn instead of failing with "database is locked"
+if DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+    DATABASES["default"]["OPTIONS"] = {"timeout": 20}
+
+# cities_light holds the towns and their latitude and longitude which the
+# "homes near" search on the property list uses - see kswap/geo.py
+# Load it once with
+#   python manage.py cities_light
+# The data files are kept in CITIES_LIGHT_DATA_DIR.  If they are already there,
+# or the CITIES_LIGHT_..._SOURCES settings are set to file:// paths, no
+# network is needed.
+# Only place names in English are needed, so the big translations file is skipped
+CITIES_LIGHT_DATA_DIR = os.path.join(BASE_DIR, "cities_light_data")
+CITIES_LIGHT_TRANSLATION_LANGUAGES = []
+CITIES_LIGHT_TRANSLATION_SOURCES = []
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.0/howto/static-files/
 # The absolute path to the directory where collectstatic will collect static files for deployment.
@@ -148,5 +225,12 @@ STATIC_URL = "/static/"
 
 # Simplified static file serving.
 # https://pypi.org/project/whitenoise/
+# collectstatic puts a hash of each file's contents in its name
+# (carousel.js becomes carousel.3f2a...js, {% static %} gives the new name)
+# and saves a gzip and, with the Brotli package installed, a brotli copy next
+# to it.  WhiteNoiseMiddleware sends the smallest copy the browser accepts,
+# and the files with a hash in their name with "Cache-Control: immutable"
+# and a max-age of ten years, as a changed file gets a new name.  The
+# benchmark_page_weight command measures what a page downloads
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
@@ -1,9 +1,100 @@
+import copy
+import os
+
+from django import forms
 from django.contrib import admin
-from .models import Profile, Kashrut, Property, Image, Booking
+from django.db import transaction
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from . import availability
+from .models import Profile, Kashrut, Property, Image, Booking, ExpiryRun, PropertyImport, RequestProfile, SwapWish
 
 admin.site.register(Profile)
 admin.site.register(Kashrut)
 admin.site.register(Property)
 admin.site.register(Image)
-admin.site.register(Booking)
+admin.site.register(SwapWish)
+
+
+# A booking changed here is saved by availability.reserve() like on the
+# booking pages, so days another booking already holds are shown as a form
+# error instead of the OccupiedDay constraint's IntegrityError
+class BookingAdminForm(forms.ModelForm):
+    class Meta:
+        model = Booking
+        fields = "__all__"
+
+    # Only the database can say whether the days are free, so reserve() is
+    # tried on a copy of the booking in a transaction that is rolled back
+    def validate_unique(self):
+        super().validate_unique()
+        if self.errors:
+            return
+        with transaction.atomic():
+            try:
+                availability.reserve(copy.copy(self.instance))
+            except availability.BookingConflict as conflict:
+                self.add_error(None, str(conflict))
+            transaction.set_rollback(True)
+
+
+@admin.register(Booking)
+class BookingAdmin(admin.ModelAdmin):
+    form = BookingAdminForm
+    list_display = ("id", "property", "my_property", "date_from", "date_to", "status")
+
+    def save_model(self, request, obj, form, change):
+        availability.reserve(obj)
+
+
+# the runs of the expire_bookings command, newest first
+@admin.register(ExpiryRun)
+class ExpiryRunAdmin(admin.ModelAdmin):
+    list_display = ("started", "declined", "batches", "retries", "seconds")
+
+
+# the files loaded with the import_properties command
+@admin.register(PropertyImport)
+class PropertyImportAdmin(admin.ModelAdmin):
+    list_display = ("source", "started", "finished", "rows", "imported", "failed", "images")
+
+
+# the requests staff have profiled with ?profile=1, newest first (see
+# profiling.py).  Each one shows the text summary and links to the .prof
+# file, which can be opened with pstats or snakeviz
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ("created", "view_name", "method", "path", "status", "ms", "allocated_kb", "user", "download")
+    list_filter = ("view_name",)
+    fields = ("created", "user", "method", "path", "view_name", "status", "ms", "allocated_kb", "download", "summary")
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        download = self.admin_site.admin_view(self.download_view)
+        return [path("<int:pk>/download/", download, name="kswap_requestprofile_download")] + super().get_urls()
+
+    def download_view(self, request, pk):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        if not os.path.exists(profile.file_path("prof")):
+            raise Http404("The profile file has been deleted")
+        return FileResponse(open(profile.file_path("prof"), "rb"), as_attachment=True, filename=f"{profile.name}.prof")
+
+    @admin.display(description=".prof file")
+    def download(self, profile):
+        url = reverse("admin:kswap_requestprofile_download", args=[profile.pk])
+        return format_html('<a href="{}">download</a>', url)
 
+    def summary(self, profile):
+        if not os.path.exists(profile.file_path("txt")):
+            return "The summary file has been deleted"
+        with open(profile.file_path("txt")) as file:
+            return format_html("<pre>{}</pre>", file.read())
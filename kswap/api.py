@@ -0,0 +1,440 @@
+# The JSON API, for the mobile app and anything else that would otherwise
+# have to read the HTML pages.  Everything is under /api/v1/ (see urls.py),
+# so a new version can be added later without breaking the app.
+#   - each kind of row is sent as a short dict made with values(), so only
+#     the columns that are sent are read from the database
+#   - lists are paged with a cursor, the id of the last row sent, so the
+#     next page is "id > cursor" on the primary key and doesn't get slower
+#     the further you go, like OFFSET does
+#   - every property, booking and review has a version which goes up when
+#     it changes (see models.py).  The ETag of a reply is made from the
+#     versions of its rows, so a client that sends it back in If-None-Match
+#     gets 304 Not Modified, and for a single row that is worked out from
+#     the version alone before anything else is read.  If-Match on a PATCH
+#     refuses the change (412) when somebody else changed the row first
+#   - include=owner,images adds the owners and pictures of all the
+#     properties on the page with one query for the owners and two for the
+#     pictures, however many properties there are
+# Logging in is the same as for the web pages (the session cookie), and
+# requests that change something need the CSRF token like a form does
+import base64
+import hashlib
+import json
+from functools import wraps
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.forms.models import model_to_dict
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+
+from . import availability, uploads
+from .forms import PropertyBookForm, PropertyForm
+from .models import Booking, Image, ImageUpload, ImageVariant, Property, Review
+from .views import bookings_awaiting_review, leave_reviews
+
+VERSION = "v1"
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# the columns sent in lists, and the extra ones sent for a single property
+PROPERTY_LIST_FIELDS = (
+    "id",
+    "owner_id",
+    "country",
+    "city",
+    "address",
+    "property_type",
+    "no_of_rooms",
+    "max_occupancy",
+    "rating",
+    "rating_count",
+    "version",
+)
+PROPERTY_FIELDS = PROPERTY_LIST_FIELDS + (
+    "postcode",
+    "pet_friendly",
+    "succah",
+    "passover_kitchen",
+    "smoking_allowed",
+    "proximity_to_public_transport",
+    "home_description",
+    "latitude",
+    "longitude",
+)
+BOOKING_FIELDS = ("id", "user_id", "property_id", "my_property_id", "date_from", "date_to", "status", "version")
+REVIEW_FIELDS = ("id", "booking_id", "property_reviewed_id", "reviewer_id", "stars", "text", "version")
+PROPERTY_INCLUDES = {"owner", "images"}
+BOOKING_INCLUDES = {"property"}
+
+
+# Raised by the API views to send an error back as JSON
+class ApiError(Exception):
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+# Wraps an API view: only the given methods are allowed, login=True sends
+# 401 (not a redirect to the login page) to anyone not logged in, and an
+# ApiError becomes a JSON reply
+def api_view(*methods, login=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"error": f"Use {' or '.join(methods)}"}, status=405)
+            if login and not request.user.is_authenticated:
+                return JsonResponse({"error": "Please log in"}, status=401)
+            try:
+                return view(request, *args, **kwargs)
+            except ApiError as error:
+                return JsonResponse({"error": str(error), **error.extra}, status=error.status)
+
+        return wrapper
+
+    return decorator
+
+
+def json_body(request):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        raise ApiError("The body must be JSON")
+    if not isinstance(data, dict):
+        raise ApiError("The body must be a JSON object")
+    return data
+
+
+def form_error(form):
+    return ApiError("Some fields are not right", fields=form.errors.get_json_data())
+
+
+def requested_includes(request, allowed):
+    include = {name for name in request.GET.get("include", "").split(",") if name}
+    if include - allowed:
+        raise ApiError(f"include can only be {', '.join(sorted(allowed))}")
+    return include
+
+
+# The cursor is the id of the last row sent, so the client can't read
+# anything into it and it can be changed later
+def encode_cursor(row_id):
+    return base64.urlsafe_b64encode(str(row_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except ValueError:
+        raise ApiError("The cursor is not right")
+
+
+# Returns one page of the rows, as dicts of fields, and the link to the next
+# page or None.  One more row than asked for is read to see if there is more
+def page(request, rows, fields):
+    limit = request.GET.get("limit", "")
+    limit = min(int(limit), MAX_LIMIT) if limit.isdigit() and int(limit) > 0 else DEFAULT_LIMIT
+    cursor = request.GET.get("cursor")
+    if cursor:
+        rows = rows.filter(id__gt=decode_cursor(cursor))
+    rows = list(rows.order_by("id").values(*fields)[: limit + 1])
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        params = request.GET.copy()
+        params["cursor"] = encode_cursor(rows[-1]["id"])
+        next_url = f"{request.path}?{params.urlencode()}"
+    return rows, next_url
+
+
+# extra is anything else that changes the reply, like the includes
+def make_etag(kind, versions, extra=""):
+    text = ",".join(f"{row_id}:{version}" for row_id, version in versions)
+    return '"%s"' % hashlib.md5(f"{VERSION}|{kind}|{extra}|{text}".encode()).hexdigest()
+
+
+def etag_matches(request, etag, header="If-None-Match"):
+    sent = request.headers.get(header)
+    if sent is None:
+        return None
+    tags = [tag.strip().removeprefix("W/") for tag in sent.split(",")]
+    return "*" in tags or etag in tags
+
+
+# Sends data as JSON with its ETag, or 304 if the client already has it
+def reply(request, data, etag, status=200):
+    if status == 200 and etag_matches(request, etag):
+        response = HttpResponse(status=304)
+    else:
+        response = JsonResponse(data, status=status)
+    response["ETag"] = etag
+    # the client must ask each time, but can use If-None-Match to do it cheaply
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def list_reply(request, kind, rows, next_url, include, add_includes):
+    etag = make_etag(kind, [(row["id"], row["version"]) for row in rows], f"{','.join(sorted(include))}|{next_url}")
+    if etag_matches(request, etag):
+        return reply(request, None, etag)
+    add_includes(rows, include)
+    return reply(request, {"results": rows, "next": next_url}, etag)
+
+
+# Adds "owner" and/or "images" to each property dict
+def add_property_includes(rows, include):
+    if "owner" in include:
+        owners = User.objects.filter(id__in={row["owner_id"] for row in rows}).values("id", "username")
+        owners = {owner["id"]: owner for owner in owners}
+        for row in rows:
+            row["owner"] = owners.get(row["owner_id"])
+    if "images" in include:
+        property_ids = [row["id"] for row in rows]
+        copies = {}
+        for variant in (
+            ImageVariant.objects.filter(image__property_id__in=property_ids)
+            .order_by("width")
+            .values("image_id", "format", "width", "file")
+        ):
+            copies.setdefault(variant["image_id"], []).append(
+                {"format": variant["format"], "width": variant["width"], "url": default_storage.url(variant["file"])}
+            )
+        images = {}
+        for image in (
+            Image.objects.filter(property_id__in=property_ids)
+            .order_by("id")
+            .values("id", "property_id", "image", "width", "height")
+        ):
+            images.setdefault(image["property_id"], []).append(
+                {
+                    "id": image["id"],
+                    "url": default_storage.url(image["image"]),
+                    "width": image["width"],
+                    "height": image["height"],
+                    "copies": copies.get(image["id"], []),
+                }
+            )
+        for row in rows:
+            row["images"] = images.get(row["id"], [])
+
+
+def add_booking_includes(rows, include):
+    if "property" in include:
+        property_ids = {row["property_id"] for row in rows} | {row["my_property_id"] for row in rows}
+        properties = {
+            row["id"]: row for row in Property.objects.filter(id__in=property_ids).values(*PROPERTY_LIST_FIELDS)
+        }
+        for row in rows:
+            row["property"] = properties.get(row["property_id"])
+            row["my_property"] = properties.get(row["my_property_id"])
+
+
+# A single property, booking or review.  The version is read first, so a
+# client that already has it gets 304 after one small query
+def row_reply(request, kind, rows, fields, include=(), add_includes=None):
+    versions = rows.values_list("id", "version").first()
+    if versions is None:
+        raise ApiError(f"There is no such {kind}", status=404)
+    etag = make_etag(kind, [versions], ",".join(sorted(include)))
+    if etag_matches(request, etag):
+        return reply(request, None, etag)
+    row = rows.values(*fields).first()
+    if add_includes:
+        add_includes([row], include)
+    return reply(request, row, etag)
+
+
+# A PATCH with If-Match is refused when the row has changed since the client read it
+def check_if_match(request, kind, row):
+    if etag_matches(request, make_etag(kind, [(row.id, row.version)]), "If-Match") is False:
+        raise ApiError(f"The {kind} has been changed by somebody else", status=412)
+
+
+@api_view("GET", "POST")
+def properties(request):
+    if request.method == "POST":
+        if not request.user.is_authenticated:
+            raise ApiError("Please log in", status=401)
+        form = PropertyForm(json_body(request))
+        if not form.is_valid():
+            raise form_error(form)
+        property = form.save(commit=False)
+        property.owner = request.user
+        property.save()
+        return property_detail(request, property.id, status=201)
+
+    include = requested_includes(request, PROPERTY_INCLUDES)
+    rows = Property.objects.all()
+    for name in ("country", "city", "property_type"):
+        if request.GET.get(name):
+            rows = rows.filter(**{name: request.GET[name]})
+    if request.GET.get("owner") == "me" and request.user.is_authenticated:
+        rows = rows.filter(owner=request.user)
+    rows, next_url = page(request, rows, PROPERTY_LIST_FIELDS)
+    return list_reply(request, "property", rows, next_url, include, add_property_includes)
+
+
+@api_view("GET", "PATCH", "DELETE")
+def property_item(request, pk):
+    if request.method == "GET":
+        return property_detail(request, pk)
+    if not request.user.is_authenticated:
+        raise ApiError("Please log in", status=401)
+    property = Property.objects.filter(id=pk, owner=request.user).first()
+    if property is None:
+        raise ApiError("There is no such property of yours", status=404)
+    check_if_match(request, "property", property)
+    if request.method == "DELETE":
+        property.delete()
+        return HttpResponse(status=204)
+    # the fields that aren't sent keep their values
+    form = PropertyForm({**model_to_dict(property), **json_body(request)}, instance=property)
+    if not form.is_valid():
+        raise form_error(form)
+    form.save()
+    return property_detail(request, pk)
+
+
+def property_detail(request, pk, status=200):
+    include = requested_includes(request, PROPERTY_INCLUDES)
+    if status != 200:
+        # a new property, sent back without looking at If-None-Match
+        row = Property.objects.filter(id=pk).values(*PROPERTY_FIELDS).first()
+        add_property_includes([row], include)
+        return reply(
+            request, row, make_etag("property", [(row["id"], row["version"])], ",".join(sorted(include))), status
+        )
+    return row_reply(
+        request, "property", Property.objects.filter(id=pk), PROPERTY_FIELDS, include, add_property_includes
+    )
+
+
+# Adds pictures that were sent in pieces to /image_upload/ (see uploads.py)
+# to a property.  The body is {"uploads": [upload ids]}
+@api_view("POST", login=True)
+def property_images(request, pk):
+    property = Property.objects.filter(id=pk, owner=request.user).first()
+    if property is None:
+        raise ApiError("There is no such property of yours", status=404)
+    upload_ids = json_body(request).get("uploads")
+    if not isinstance(upload_ids, list) or not all(isinstance(upload_id, str) for upload_id in upload_ids):
+        raise ApiError("uploads must be a list of upload ids")
+    try:
+        pictures = list(ImageUpload.objects.filter(id__in=upload_ids, owner=request.user).order_by("started"))
+    except ValidationError:
+        raise ApiError("uploads must be a list of upload ids")
+    images = uploads.attach(property, pictures)
+    return JsonResponse({"added": len(images)}, status=201)
+
+
+# The bookings the user is in, on either side
+def my_bookings(user):
+    my_homes = Property.objects.filter(owner=user).values("id")
+    return Booking.objects.filter(user=user) | Booking.objects.filter(property_id__in=my_homes)
+
+
+@api_view("GET", "POST", login=True)
+def bookings(request):
+    if request.method == "POST":
+        data = json_body(request)
+        property_id = data.get("property")
+        # true and false are ints in Python, so they are left out on their own
+        is_id = isinstance(property_id, int) and not isinstance(property_id, bool)
+        property = Property.objects.filter(id=property_id).first() if is_id else None
+        if property is None:
+            raise ApiError("There is no such property", status=404)
+        form = PropertyBookForm(data, user=request.user)
+        if not form.is_valid():
+            raise form_error(form)
+        booking = form.save(commit=False)
+        booking.property = property
+        booking.user = request.user
+        try:
+            availability.reserve(booking)
+        except availability.BookingConflict as conflict:
+            raise ApiError(str(conflict), status=409)
+        row = Booking.objects.filter(id=booking.id).values(*BOOKING_FIELDS).first()
+        return reply(request, row, make_etag("booking", [(row["id"], row["version"])]), status=201)
+
+    include = requested_includes(request, BOOKING_INCLUDES)
+    rows = my_bookings(request.user)
+    if request.GET.get("status"):
+        rows = rows.filter(status=request.GET["status"])
+    rows, next_url = page(request, rows, BOOKING_FIELDS)
+    return list_reply(request, "booking", rows, next_url, include, add_booking_includes)
+
+
+# The owner of the home that was asked for can accept or decline with
+# {"status": "accepted"} or {"status": "declined"}
+@api_view("GET", "PATCH", login=True)
+def booking_item(request, pk):
+    include = requested_includes(request, BOOKING_INCLUDES)
+    if request.method == "GET":
+        return row_reply(
+            request, "booking", my_bookings(request.user).filter(id=pk), BOOKING_FIELDS, include, add_booking_includes
+        )
+    booking = Booking.objects.filter(id=pk, property__owner=request.user).first()
+    if booking is None:
+        raise ApiError("There is no such booking of your home", status=404)
+    check_if_match(request, "booking", booking)
+    status = json_body(request).get("status")
+    if status not in ("accepted", "declined"):
+        raise ApiError('status must be "accepted" or "declined"')
+    try:
+        availability.change_status(booking, status)
+    except availability.BookingConflict as conflict:
+        raise ApiError(str(conflict), status=409)
+    return row_reply(request, "booking", Booking.objects.filter(id=pk), BOOKING_FIELDS, include, add_booking_includes)
+
+
+# GET lists the reviews, of one property with ?property=<id>.  POST leaves
+# a review of a booking that the user hasn't reviewed yet, with
+# {"booking": id, "stars": 1 to 5, "text": "..."}
+@api_view("GET", "POST")
+def reviews(request):
+    if request.method == "POST":
+        if not request.user.is_authenticated:
+            raise ApiError("Please log in", status=401)
+        data = json_body(request)
+        booking_id = data.get("booking")
+        form = {f"stars-{booking_id}": str(data.get("stars", "")), f"text-{booking_id}": str(data.get("text", ""))}
+        try:
+            saved = leave_reviews(request.user, form)
+        except ValueError as problem:
+            raise ApiError(str(problem))
+        if not saved:
+            raise ApiError("There is no booking of yours waiting for a review with that id", status=404)
+        row = Review.objects.filter(booking_id=booking_id, reviewer=request.user).values(*REVIEW_FIELDS).first()
+        return reply(request, row, make_etag("review", [(row["id"], row["version"])]), status=201)
+
+    rows = Review.objects.all()
+    if request.GET.get("property", "").isdigit():
+        rows = rows.filter(property_reviewed_id=request.GET["property"])
+    rows, next_url = page(request, rows, REVIEW_FIELDS)
+    return list_reply(request, "review", rows, next_url, set(), lambda rows, include: None)
+
+
+# The bookings the user still has to review, with the same fields as bookings
+@api_view("GET", login=True)
+def reviews_to_leave(request):
+    rows, next_url = page(request, bookings_awaiting_review(request.user), BOOKING_FIELDS)
+    return list_reply(request, "booking", rows, next_url, set(), lambda rows, include: None)
+
+
+# What the API has, so the app can find the pages without building URLs itself
+@api_view("GET")
+def index(request):
+    return JsonResponse(
+        {
+            "version": VERSION,
+            "properties": reverse("api_properties"),
+            "bookings": reverse("api_bookings"),
+            "reviews": reverse("api_reviews"),
+            "reviews_to_leave": reverse("api_reviews_to_leave"),
+            "bookings_export": reverse("api_bookings_export"),
+            "reviews_export": reverse("api_reviews_export"),
+        }
+    )
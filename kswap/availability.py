@@ -0,0 +1,113 @@
+# Availability of properties for the property search
+# The OccupiedDay table in models.py stores one row per night that a home is
+# in use by a pending or accepted booking.  The functions below read and
+# maintain that table so that the views don't need to scan the Booking table
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+
+from . import search_cache
+from .models import ACTIVE_STATUSES, Booking, OccupiedDay
+
+
+# Returns a queryset of the ids of the properties that are in use on
+# at least one day between start_date and end_date (both included)
+# This is a range lookup on the (day, property) index
+def unavailable_property_ids(start_date, end_date):
+    return OccupiedDay.objects.filter(day__range=(start_date, end_date)).values_list('property_id', flat=True)
+
+
+# Takes any queryset of properties and removes the ones which are not free
+# for the whole of the date range
+def available_properties(queryset, start_date, end_date):
+    return queryset.exclude(id__in=unavailable_property_ids(start_date, end_date))
+
+
+# queryset.update() does not send post_save so the signal in models.py
+# never sees bookings that are changed in bulk.  Any code which declines
+# bookings in bulk must call this first to free up their days
+def release_bookings(bookings):
+    OccupiedDay.objects.filter(booking__in=bookings).delete()
+
+
+# Raised by reserve() when one of the two homes is already in use
+class BookingConflict(Exception):
+    pass
+
+
+# Saves a booking and its occupied days in one transaction.
+# The post_save signal in models.py inserts the OccupiedDay rows and the
+# unique constraint on (property, day) makes the database refuse them if
+# another pending or accepted booking already has one of those days.
+# When that happens the whole transaction is rolled back so the booking
+# is never saved.  This also works when two requests arrive at the same time:
+# on Postgres the second insert waits for the first one to commit and then
+# fails, and on SQLite only one transaction can write at a time anyway
+def reserve(booking):
+    adding = booking.pk is None
+    try:
+        with transaction.atomic():
+            booking.save()
+    except IntegrityError:
+        # the failed save may have given a new booking an id - take it off again
+        if adding:
+            booking.pk = None
+        raise BookingConflict(
+            "One of the homes is already booked for some of these dates. "
+            "Please choose different dates."
+        )
+    return booking
+
+
+# Every change to the status of a saved booking goes through here.  A
+# declined booking that is accepted again takes its days back, and they may
+# have been booked by somebody else since, so it is saved by reserve() and
+# BookingConflict is raised.  Then the booking keeps its old status
+def change_status(booking, status):
+    old_status = booking.status
+    booking.status = status
+    try:
+        reserve(booking)
+    except BookingConflict:
+        booking.status = old_status
+        raise
+    return booking
+
+
+# Throws the whole store away and builds it again from the Booking table
+# This is used by the rebuild_availability management command, for example
+# after bookings were loaded in bulk without going through save().
+# Returns the number of days written and the ids of the bookings that clash
+# with an older one, which only have the days the older one left them
+def rebuild(batch_size=1000):
+    with transaction.atomic():
+        OccupiedDay.objects.all().delete()
+        rows = []
+        active = Booking.objects.filter(status__in=ACTIVE_STATUSES).only(
+            'id', 'property_id', 'my_property_id', 'date_from', 'date_to', 'status'
+        )
+        # older bookings go first so that if two of them overlap (which was
+        # possible before reserve() existed, or with bookings loaded in bulk)
+        # the earlier one keeps the days
+        for booking in active.order_by('id').iterator(chunk_size=batch_size):
+            rows.extend(OccupiedDay.rows_for_booking(booking))
+            if len(rows) >= batch_size:
+                OccupiedDay.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+                rows = []
+        OccupiedDay.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+        # ignore_conflicts doesn't say which rows were left out, so the
+        # days are counted afterwards
+        created = OccupiedDay.objects.count()
+        clashes = clashing_bookings(active, batch_size)
+    search_cache.changed("booking")
+    return created, clashes
+
+
+# The ids of the bookings that have fewer occupied days than nights
+def clashing_bookings(active, batch_size):
+    clashes = []
+    counted = active.annotate(days=Count('occupied_days')).order_by('id')
+    for booking in counted.iterator(chunk_size=batch_size):
+        homes = len({booking.property_id, booking.my_property_id})
+        if booking.days < ((booking.date_to - booking.date_from).days + 1) * homes:
+            clashes.append(booking.id)
+    return clashes
@@ -2,19 +2,25 @@
 # explanation is that I  need  the dict pending_requests_count to be
 # available in any html  template and I can do this by registering
 # this procesor in settings.py  
-from .models import Booking
+# The numbers used to be counted from the Booking table for every page.
+# Now they are kept up to date in the BadgeCounts table (see models.py)
+# and both come from the same row, which is only read once per request
+from .models import BadgeCounts
+
+
+def badge_counts(request):
+    if not hasattr(request, "_badge_counts"):
+        request._badge_counts = BadgeCounts.for_user(request.user.id)
+    return request._badge_counts
+
 
 def pending_requests_count(request):
     if request.user.is_authenticated:
-        count = Booking.objects.filter(property__owner=request.user, status='pending').count()
-        return {'pending_requests_count': count}
+        return {'pending_requests_count': badge_counts(request).pending_requests}
     return {}
 
 
-from django.db.models import Q
 def your_next_escapes_count(request):
     if request.user.is_authenticated:
-        bookings = Booking.objects.filter(Q(property__owner=request.user) | Q(my_property__owner=request.user), status='accepted').order_by('-date_from')
-        count = bookings.count()
-        return {'your_next_escapes_count': count}
-    return {}
\ No newline at end of file
+        return {'your_next_escapes_count': badge_counts(request).next_escapes}
+    return {}
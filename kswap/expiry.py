@@ -0,0 +1,90 @@
+# Declining swap requests that were never answered
+# A pending booking that starts in less than a day is too late to accept,
+# so it is declined and its days are freed for other bookings.  This used to
+# be done by the pending_bookings page, for every booking in the table, each
+# time anyone opened the page.  Now the expire_bookings management command
+# does it every few minutes (see the worker line in the Procfile):
+#   - the stale bookings are found with the (status, date_from) index
+#   - they are declined BATCH_SIZE at a time, each batch in its own short
+#     transaction, so other users are never kept waiting for long
+#   - a batch that fails because the database is busy is tried again.  Only
+#     bookings that are still pending are changed, so trying again, or two
+#     workers running at once, can't decline a booking twice
+#   - the numbers for each run are saved in the ExpiryRun table and logged
+import logging
+import time
+
+from django.db import OperationalError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import availability, search_cache
+from .models import BadgeCounts, Booking, ExpiryRun, stale_cutoff
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+RETRIES = 3
+
+
+# Bookings that start on or before this day can't be accepted any more
+def cutoff(now=None):
+    return stale_cutoff(now)
+
+
+def stale_bookings(now=None):
+    return Booking.objects.filter(status="pending", date_from__lte=cutoff(now))
+
+
+# Declines one batch and returns how many bookings it declined
+# On Postgres the rows are locked, skipping any another worker has locked,
+# so their status can't change before they are updated.  SQLite only lets
+# one transaction write at a time so it doesn't need the lock
+def decline_batch(now, batch_size):
+    with transaction.atomic():
+        batch = stale_bookings(now).select_for_update(skip_locked=True, of=("self",)).order_by("date_from", "id")
+        rows = list(batch.values_list("id", "property__owner_id")[:batch_size])
+        if not rows:
+            return 0
+        booking_ids = [booking_id for booking_id, owner_id in rows]
+        # update() doesn't send post_save, so free the days and let the
+        # owners' menu numbers be counted again here
+        availability.release_bookings(Booking.objects.filter(id__in=booking_ids))
+        declined = Booking.objects.filter(id__in=booking_ids, status="pending").update(
+            status="declined", version=F("version") + 1
+        )
+        BadgeCounts.forget({owner_id for booking_id, owner_id in rows})
+        search_cache.changed("booking")
+        return declined
+
+
+# Declines every stale booking and returns the ExpiryRun with the numbers
+def expire(now=None, batch_size=BATCH_SIZE):
+    run = ExpiryRun(started=timezone.now())
+    clock = time.perf_counter()
+    while True:
+        for attempt in range(RETRIES + 1):
+            try:
+                declined = decline_batch(now, batch_size)
+                break
+            except OperationalError:
+                # "database is locked" or similar - wait a little and try again
+                if attempt == RETRIES:
+                    raise
+                run.retries += 1
+                time.sleep(0.5 * (attempt + 1))
+        if not declined:
+            break
+        run.batches += 1
+        run.declined += declined
+
+    run.seconds = time.perf_counter() - clock
+    run.save()
+    logger.info(
+        "Declined %s stale bookings in %s batches (%s retries) in %.2f s",
+        run.declined,
+        run.batches,
+        run.retries,
+        run.seconds,
+    )
+    return run
@@ -0,0 +1,181 @@
+# Downloading the history of swaps as CSV or JSON Lines
+# Owners and admins used to copy their bookings and reviews out of the
+# admin a page at a time.  Now /api/v1/bookings/export and
+# /api/v1/reviews/export send all of them in one file (?format=csv, the
+# default, or ?format=jsonl), and the export_history management command
+# writes the same file.  Staff get every row, anyone else the bookings they
+# are in on either side and the reviews they wrote or that are of their homes.
+#
+# However many rows there are the memory used stays the same:
+#   - the columns of the joined tables (the homes, the users) come from the
+#     same query, with values_list(), so nothing is looked up row by row
+#   - the rows are read with iterator(chunk_size=CHUNK_SIZE), which on
+#     Postgres is a server-side cursor, so only one chunk is in memory
+#   - they go out with StreamingHttpResponse as they are read, put
+#     together in blocks of about BLOCK_SIZE bytes.  The header line is
+#     sent first, before the query has even started
+#   - under ASGI Django reads a plain generator into a list before sending
+#     any of it, so there the blocks are handed over by an async generator
+#     that reads one block at a time on the thread Django keeps for sync code
+#
+# A cell starting with =, +, - or @ is a formula to Excel and LibreOffice,
+# and one starting with a tab or a carriage return can hide one, as OWASP
+# warns about CSV injection.  The addresses and reviews are typed in by
+# users, so in the CSV file those cells get a ' in front and are shown as text
+import csv
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+
+from .api import ApiError, api_view, my_bookings
+from .models import Booking, Property, Review
+
+CHUNK_SIZE = 2000
+BLOCK_SIZE = 64 * 1024
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+FORMULA_STARTS = ("=", "+", "-", "@", "\t", "\r")
+
+# (name in the file, column) for each kind of row
+BOOKING_COLUMNS = (
+    ("id", "id"),
+    ("status", "status"),
+    ("date_from", "date_from"),
+    ("date_to", "date_to"),
+    ("guest_id", "user_id"),
+    ("guest", "user__username"),
+    ("property_id", "property_id"),
+    ("property_address", "property__address"),
+    ("property_city", "property__city"),
+    ("property_country", "property__country"),
+    ("owner", "property__owner__username"),
+    ("my_property_id", "my_property_id"),
+    ("my_property_address", "my_property__address"),
+    ("my_property_city", "my_property__city"),
+    ("my_property_country", "my_property__country"),
+    ("version", "version"),
+)
+REVIEW_COLUMNS = (
+    ("id", "id"),
+    ("booking_id", "booking_id"),
+    ("property_id", "property_reviewed_id"),
+    ("property_address", "property_reviewed__address"),
+    ("property_city", "property_reviewed__city"),
+    ("reviewer_id", "reviewer_id"),
+    ("reviewer", "reviewer__username"),
+    ("stars", "stars"),
+    ("text", "text"),
+    ("version", "version"),
+)
+
+
+def bookings_for(user=None):
+    rows = Booking.objects.all() if user is None or user.is_staff else my_bookings(user)
+    return rows, BOOKING_COLUMNS
+
+
+def reviews_for(user=None):
+    rows = Review.objects.all()
+    if user is not None and not user.is_staff:
+        my_homes = Property.objects.filter(owner=user).values("id")
+        rows = rows.filter(Q(reviewer=user) | Q(property_reviewed_id__in=my_homes))
+    return rows, REVIEW_COLUMNS
+
+
+KINDS = {"bookings": bookings_for, "reviews": reviews_for}
+
+
+# The rows as tuples, CHUNK_SIZE at a time, oldest first
+def read_rows(rows, columns):
+    return rows.order_by("id").values_list(*[column for name, column in columns]).iterator(chunk_size=CHUNK_SIZE)
+
+
+# csv.writer wants a file, and this one just hands back what it is given
+class Echo:
+    def write(self, text):
+        return text
+
+
+# A cell a spreadsheet would run as a formula is made into text
+def csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_STARTS):
+        return "'" + value
+    return value
+
+
+def csv_lines(names, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(names)
+    for row in rows:
+        yield writer.writerow([csv_cell(value) for value in row])
+
+
+def jsonl_lines(names, rows):
+    yield from (json.dumps(dict(zip(names, row)), default=str) + "\n" for row in rows)
+
+
+# The file a line at a time.  A JSON Lines file has no header line, so
+# the first line is sent as soon as the first row has been read
+def lines(kind, format, user=None):
+    rows, columns = KINDS[kind](user)
+    names = [name for name, column in columns]
+    make_lines = csv_lines if format == "csv" else jsonl_lines
+    return make_lines(names, read_rows(rows, columns))
+
+
+# Puts the lines together in blocks of about BLOCK_SIZE bytes, so a big
+# file isn't sent in thousands of tiny pieces.  The first line goes on its own
+def blocks(lines, size=BLOCK_SIZE):
+    block = []
+    length = 0
+    first = True
+    for line in lines:
+        block.append(line)
+        length += len(line)
+        if first or length >= size:
+            yield "".join(block).encode()
+            block = []
+            length = 0
+            first = False
+    if block:
+        yield "".join(block).encode()
+
+
+# The same blocks for StreamingHttpResponse under ASGI.  Each one is read
+# on the sync thread, as the rows come from the database, and the query is
+# closed there too when the download ends or is stopped
+async def async_blocks(blocks):
+    next_block = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            block = await next_block(blocks, None)
+            if block is None:
+                return
+            yield block
+    finally:
+        await sync_to_async(blocks.close, thread_sensitive=True)()
+
+
+def export(request, kind):
+    format = request.GET.get("format", "csv")
+    if format not in FORMATS:
+        raise ApiError(f"format can only be {', '.join(FORMATS)}")
+    content = blocks(lines(kind, format, request.user))
+    if isinstance(request, ASGIRequest):
+        content = async_blocks(content)
+    response = StreamingHttpResponse(content, content_type=FORMATS[format])
+    response["Content-Disposition"] = f'attachment; filename="{kind}.{format}"'
+    response["Cache-Control"] = "private, no-store"
+    return response
+
+
+@api_view("GET", login=True)
+def bookings_export(request):
+    return export(request, "bookings")
+
+
+@api_view("GET", login=True)
+def reviews_export(request):
+    return export(request, "reviews")
@@ -0,0 +1,274 @@
+# Filters and filter counts for the property search page
+# The counts come from the FacetBitmap table in models.py.  There is one
+# bitmap of property ids for each value of each filter (stored in chunks of
+# ids), so the number of homes matching any set of filters is the number of
+# bits left after ANDing the bitmaps together.  Python ints can be used as
+# bitmaps of any size.
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Sum
+from django_countries import countries
+
+from . import search_cache
+from .models import FACET_CHUNK_BITS, FACET_FIELDS, FacetBitmap, Kashrut, Profile, Property, facet_value
+
+# label shown on the page and how to read the value for each filter
+FACETS = {
+    "country": ("Country", str),
+    "city": ("City", str),
+    "no_of_rooms": ("Rooms", int),
+    "max_occupancy": ("Sleeps", int),
+    "property_type": ("Property type", str),
+    "kashrut": ("Kashrut", int),
+    "succah": ("Succah", bool),
+    "passover_kitchen": ("Passover kitchen", bool),
+    "pet_friendly": ("Pet friendly", bool),
+    "smoking_allowed": ("Smoking allowed", bool),
+}
+
+# kashrut is on the owner's profile rather than on the property
+PROPERTY_LOOKUPS = {"kashrut": "owner__profile__kashrut"}
+
+
+def property_lookup(name):
+    return PROPERTY_LOOKUPS.get(name, name)
+
+
+# Reads the filters out of request.GET.  Anything that is empty or
+# can't be understood is ignored so that a bad link still shows results
+def filters_from_request(params):
+    filters = {}
+    for name in FACET_FIELDS:
+        label, kind = FACETS[name]
+        value = params.get(name, "")
+        if value == "":
+            continue
+        if kind is bool:
+            if value in ("true", "false"):
+                filters[name] = value == "true"
+        elif kind is int:
+            if value.isdigit():
+                filters[name] = int(value)
+        else:
+            filters[name] = value
+    return filters
+
+
+def filter_properties(queryset, filters):
+    return queryset.filter(**{property_lookup(name): value for name, value in filters.items()})
+
+
+# Makes a bitmap with the bits for the given ids set.  Setting the bits in a
+# bytearray first is much quicker than building up a big int one bit at a time
+def bitmap_of(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for property_id in ids:
+        data[property_id >> 3] |= 1 << (property_id & 7)
+    return int.from_bytes(data, "little")
+
+
+# The cities with the most homes, which are the ones with a choice in the
+# city drop down.  city is typed in by the owners so there can be thousands
+# of them, and the search would have to read all their bitmaps to count them
+def top_cities(limit):
+    rows = (
+        FacetBitmap.objects.filter(facet="city")
+        .exclude(value="")
+        .values("value")
+        .annotate(homes=Sum("count"))
+        .order_by("-homes", "value")
+    )
+    return [row["value"] for row in rows[:limit]]
+
+
+# Returns the bitmap of the matching properties and the counts as
+# {facet name: {value: number of homes}}
+# Only the bitmaps of the choices on the page are read: every value of the
+# filters with a few values, and of the cities only the FACET_CITY_OPTIONS
+# with the most homes and the one that was chosen.  unavailable_ids is a
+# queryset of property ids to leave out, used when the search has dates, and
+# only_ids are the only ids to keep, when there is a keyword search or
+# a search for homes near a place
+def count_facets(filters, unavailable_ids=None, only_ids=None):
+    cities = top_cities(getattr(settings, "FACET_CITY_OPTIONS", 50))
+    if "city" in filters:
+        cities.append(facet_value(filters["city"]))
+    bitmaps = defaultdict(lambda: defaultdict(int))
+    rows = FacetBitmap.objects.filter(~Q(facet="city") | Q(value__in=cities))
+    for facet, value, chunk, bits in rows.values_list("facet", "value", "chunk", "bits"):
+        bitmaps[facet][value] |= int.from_bytes(bits, "little") << (chunk * FACET_CHUNK_BITS)
+
+    # every property is in exactly one country bitmap, so together
+    # they give all the properties
+    matching = 0
+    for bits in bitmaps["country"].values():
+        matching |= bits
+    for name, value in filters.items():
+        matching &= bitmaps[name].get(facet_value(value), 0)
+    if unavailable_ids is not None:
+        matching &= ~bitmap_of(unavailable_ids)
+    if only_ids is not None:
+        matching &= bitmap_of(only_ids)
+
+    counts = {}
+    for name in FACET_FIELDS:
+        counts[name] = {value: (bits & matching).bit_count() for value, bits in bitmaps[name].items()}
+    return matching, counts
+
+
+# The ids of the set bits number start to stop-1, lowest id first
+# bin() gives the bits as text, so reversing it puts bit N at position N
+def ids_in_bitmap(bits, start, stop):
+    text = bin(bits)[:1:-1]
+    ids = []
+    position = text.find("1")
+    number = 0
+    while position != -1 and number < stop:
+        if number >= start:
+            ids.append(position)
+        number += 1
+        position = text.find("1", position + 1)
+    return ids
+
+
+# Django's Paginator only needs count() and slicing, so this lets it page
+# through the matching bitmap.  A page then only loads its own 20 rows by id,
+# instead of the database having to sort every matching home to find them.
+# The queryset still has all the filters on it in case a bitmap is out of date.
+# For a keyword search ranked_ids gives the order, best match first, and
+# for a search near a place it is nearest first
+class FacetResults:
+    def __init__(self, matching, queryset, ranked_ids=None):
+        self.matching = matching
+        self.queryset = queryset
+        self.ranked_ids = None
+        if ranked_ids is not None:
+            self.ranked_ids = [property_id for property_id in ranked_ids if matching >> property_id & 1]
+
+    def count(self):
+        if self.ranked_ids is not None:
+            return len(self.ranked_ids)
+        return self.matching.bit_count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        if self.ranked_ids is not None:
+            ids = self.ranked_ids[index]
+        else:
+            ids = ids_in_bitmap(self.matching, index.start or 0, index.stop)
+        found = self.queryset.in_bulk(ids)
+        return [found[property_id] for property_id in ids if property_id in found]
+
+
+# Pages through the homes best rated first, then the ones without a rating
+# in order of id, for sort=rating when there is no keyword, near or
+# min_rating search to give a list of ids.  Each page is ordered and sliced
+# by the database on the rating index, so no list of every home is made.
+# The queryset has the filters on it and count() comes from the bitmap
+class RatedResults:
+    def __init__(self, matching, queryset):
+        self.matching = matching
+        self.queryset = queryset
+        self.rated_count = None
+
+    def count(self):
+        return self.matching.bit_count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        if self.rated_count is None:
+            self.rated_count = self.queryset.filter(rating__isnull=False).count()
+        page = []
+        if start < self.rated_count:
+            rated = self.queryset.filter(rating__isnull=False).order_by("-rating", "-id")
+            page += rated[start:min(stop, self.rated_count)]
+        if stop > self.rated_count:
+            unrated = self.queryset.filter(rating__isnull=True).order_by("id")
+            page += unrated[max(start - self.rated_count, 0):stop - self.rated_count]
+        return page
+
+
+# Builds the list used by property_list.html to draw one drop down per
+# filter, with the number of matching homes next to each choice
+def facet_options(filters, counts):
+    kashrut_ids = [int(value) for value in counts["kashrut"] if value.isdigit()]
+    kashrut_names = {str(pk): name for pk, name in Kashrut.objects.filter(id__in=kashrut_ids).values_list("id", "name")}
+    facets = []
+    for name in FACET_FIELDS:
+        label, kind = FACETS[name]
+        selected = facet_value(filters[name]) if name in filters else None
+        options = []
+        for value, count in counts[name].items():
+            # leave out empty values and choices that would give no homes
+            if value == "" or (count == 0 and value != selected):
+                continue
+            if name == "country":
+                text = countries.name(value) or value
+            elif name == "kashrut":
+                text = kashrut_names.get(value, value)
+            elif kind is bool:
+                text = "Yes" if value == "true" else "No"
+            else:
+                text = value
+            options.append({
+                "value": value,
+                "label": text,
+                "count": count,
+                "selected": value == selected,
+                "sort_key": (int(value), "") if kind is int else (0, str(text)),
+            })
+        options.sort(key=lambda option: option["sort_key"])
+        facets.append({"name": name, "label": label, "options": options})
+    return facets
+
+
+# Sets the bits of new properties that were saved with bulk_create, which
+# doesn't send post_save.  The properties with the same value of a filter
+# are moved in one go, and the kashrut comes from the owners' profiles
+def add(properties):
+    owner_ids = {property.owner_id for property in properties}
+    kashrut = dict(Profile.objects.filter(user_id__in=owner_ids).values_list("user_id", "kashrut_id"))
+    ids = defaultdict(list)
+    for property in properties:
+        values = FacetBitmap.values_for(property)
+        values["kashrut"] = facet_value(kashrut.get(property.owner_id))
+        for name, value in values.items():
+            ids[(name, value)].append(property.id)
+    for (name, value), property_ids in sorted(ids.items()):
+        FacetBitmap.move(property_ids, {}, {name: value})
+
+
+# Works out all the bitmaps again from the Property table
+# Used by the rebuild_facets management command and after bulk loads
+def rebuild():
+    columns = [property_lookup(name) for name in FACET_FIELDS]
+    ids = defaultdict(list)
+    for row in Property.objects.order_by().values_list("id", *columns).iterator(chunk_size=2000):
+        chunk = row[0] // FACET_CHUNK_BITS
+        for name, value in zip(FACET_FIELDS, row[1:]):
+            ids[(name, facet_value(value), chunk)].append(row[0])
+
+    with transaction.atomic():
+        FacetBitmap.objects.all().delete()
+        rows = []
+        for (facet, value, chunk), property_ids in ids.items():
+            bitmap = FacetBitmap(facet=facet, value=value, chunk=chunk)
+            bitmap.set_int(bitmap_of(property_ids))
+            rows.append(bitmap)
+        FacetBitmap.objects.bulk_create(rows, batch_size=1000)
+    search_cache.changed("property")
+    return len(rows)
@@ -1,5 +1,5 @@
 from django import forms
-from .models import Profile, Property, Booking
+from .models import Profile, Property, Booking, SwapWish
 from django.contrib.auth.models import User
 
 
@@ -44,6 +44,16 @@ class PropertyBookForm(forms.ModelForm):
         # filter the properties queryset by the current user
         if user:
             self.fields['my_property'].queryset = Property.objects.filter(owner=user)
+
+    # a booking has to end on or after the day it starts, otherwise it would
+    # not take up any days and could never clash with another booking
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_to < date_from:
+            raise forms.ValidationError("The end date must be on or after the start date.")
+        return cleaned_data
         
     class Meta:
         model = Booking
@@ -53,3 +63,29 @@ class PropertyBookForm(forms.ModelForm):
             'date_to': DateInput(),
         }
 
+
+# The form on the swap matches page for saying where a user would like to go
+class SwapWishForm(forms.ModelForm):
+
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop('user', None)
+        super().__init__(*args, **kwargs)
+        # only the user's own homes can be offered
+        if user:
+            self.fields['home'].queryset = Property.objects.filter(owner=user)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_to < date_from:
+            raise forms.ValidationError("The end date must be on or after the start date.")
+        return cleaned_data
+
+    class Meta:
+        model = SwapWish
+        fields = ("home", "country", "city", "date_from", "date_to")
+        widgets = {
+            'date_from': DateInput(),
+            'date_to': DateInput(),
+        }
@@ -0,0 +1,169 @@
+# "Homes near a place" search on the property list
+# The latitude and longitude of a town come from the cities_light tables,
+# which are loaded from files so no map website is needed while searching.
+# Each property stores the coordinates of its town and the number of the
+# grid cell it is in.  The world is cut into squares of CELL_DEGREES, so a
+# radius search first picks the squares the circle touches, using the index
+# on geo_cell, and only works out the exact distance for the homes in them.
+import math
+
+from cities_light.models import City
+from django.db.models import Q
+from django_countries import countries
+
+CELL_DEGREES = 0.25
+ROWS = int(180 / CELL_DEGREES)
+COLUMNS = int(360 / CELL_DEGREES)
+
+EARTH_RADIUS_KM = 6371.0
+# how far one degree of latitude is
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# the biggest radius anyone can ask for.  Asking for half way round the
+# world made every search work out the distance to every home in Python
+MAX_KM = 200
+# and the most grid cells one search looks in.  Near the poles the cells are
+# narrow, so a small circle can cover whole rows of them, and the nearest
+# search stops making its circle bigger when it would cover more than this
+MAX_CELLS = 2000
+
+
+def grid_row(latitude):
+    return min(int((latitude + 90) / CELL_DEGREES), ROWS - 1)
+
+
+def grid_column(longitude):
+    return int((longitude + 180) / CELL_DEGREES) % COLUMNS
+
+
+# The cell number is row * COLUMNS + column, so the cells along one row
+# have numbers next to each other and a row can be searched as a range
+def grid_cell(latitude, longitude):
+    return grid_row(latitude) * COLUMNS + grid_column(longitude)
+
+
+# Great circle distance between two points in km (the haversine formula)
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+# Returns (first cell, last cell) ranges which together cover every point
+# within km of the given point.  There is one range per row of the grid,
+# or two when the circle goes over the 180 degree line
+def cell_ranges(latitude, longitude, km):
+    degrees = km / KM_PER_DEGREE
+    top = latitude + degrees
+    bottom = latitude - degrees
+    # near the poles the columns get narrow, so use the widest part of
+    # the circle to decide how many columns it crosses
+    widest = max(abs(top), abs(bottom))
+    if top >= 90 or bottom <= -90 or widest >= 89:
+        column_degrees = 180
+    else:
+        column_degrees = degrees / math.cos(math.radians(widest))
+
+    if column_degrees >= 180:
+        spans = [(0, COLUMNS - 1)]
+    else:
+        first = grid_column(longitude - column_degrees)
+        last = grid_column(longitude + column_degrees)
+        if first <= last:
+            spans = [(first, last)]
+        else:
+            spans = [(first, COLUMNS - 1), (0, last)]
+
+    ranges = []
+    for row in range(grid_row(max(bottom, -90)), grid_row(min(top, 90)) + 1):
+        for first, last in spans:
+            ranges.append((row * COLUMNS + first, row * COLUMNS + last))
+    return ranges
+
+
+# How many cells the ranges from cell_ranges cover
+def cell_count(ranges):
+    return sum(last - first + 1 for first, last in ranges)
+
+
+# The radius, up to km, that looks in no more than MAX_CELLS cells
+def bounded_km(latitude, longitude, km):
+    while km > 1 and cell_count(cell_ranges(latitude, longitude, km)) > MAX_CELLS:
+        km /= 2
+    return km
+
+
+# The queryset of homes in the cells around a point
+def in_cells(queryset, latitude, longitude, km):
+    condition = Q()
+    for first, last in cell_ranges(latitude, longitude, km):
+        condition |= Q(geo_cell__range=(first, last))
+    return queryset.filter(condition)
+
+
+# Returns [(property id, km away)] for the homes within km of the point,
+# nearest first.  The homes in the cells are checked exactly because the
+# corners of the cells stick out past the circle
+def in_circle(queryset, latitude, longitude, km):
+    found = []
+    candidates = in_cells(queryset, latitude, longitude, km).values_list("id", "latitude", "longitude")
+    for property_id, lat, lng in candidates.iterator(chunk_size=2000):
+        away = distance_km(latitude, longitude, lat, lng)
+        if away <= km:
+            found.append((property_id, away))
+    found.sort(key=lambda pair: (pair[1], pair[0]))
+    return found
+
+
+# The same for the radius someone asked for.  One bigger than MAX_KM, or
+# one that would look in more than MAX_CELLS cells, is made smaller
+def within(queryset, latitude, longitude, km):
+    return in_circle(queryset, latitude, longitude, bounded_km(latitude, longitude, min(km, MAX_KM)))
+
+
+# Returns the number nearest homes as [(property id, km away)].  It looks
+# in a small circle first and doubles it until there are enough homes.
+# Every home in the circle has been found, so the nearest ones are right.
+# The circle never covers more than MAX_CELLS cells, so in a place with few
+# homes around it there can be fewer than number of them
+def nearest(queryset, latitude, longitude, number, start_km=25):
+    km = bounded_km(latitude, longitude, start_km)
+    while True:
+        found = in_circle(queryset, latitude, longitude, km)
+        bigger = km * 2
+        if len(found) >= number or cell_count(cell_ranges(latitude, longitude, bigger)) > MAX_CELLS:
+            return found[:number]
+        km = bigger
+
+
+# Finds a town in the cities_light tables and returns (latitude, longitude)
+# or None.  Where there are several towns with the same name the biggest
+# one is used, so "Manchester" is the one in England unless a country is given
+def locate(city, country=""):
+    city = city.strip()
+    if not city:
+        return None
+    towns = City.objects.filter(latitude__isnull=False, longitude__isnull=False)
+    if country:
+        towns = towns.filter(country__code2=str(country).upper())
+    towns = towns.order_by("-population").values_list("latitude", "longitude")
+    # an exact match can use the index on the name, so try that first
+    found = towns.filter(Q(name=city) | Q(name_ascii=city)).first()
+    if found is None:
+        found = towns.filter(Q(name__iexact=city) | Q(name_ascii__iexact=city)).first()
+    if found is None:
+        return None
+    return float(found[0]), float(found[1])
+
+
+# Reads what was typed into the "near" box, like "Manchester",
+# "Manchester, GB" or "Manchester, United Kingdom"
+def locate_place(text):
+    city, comma, country = text.rpartition(",")
+    if not comma:
+        return locate(text)
+    country = country.strip()
+    code = country.upper() if len(country) == 2 else countries.by_name(country)
+    if not code:
+        return locate(text)
+    return locate(city, code)
@@ -0,0 +1,170 @@
+# The list of pages a user has visited, used by the Back link
+# It used to be a Stack kept in the session.  That meant a write to the
+# session table on every page anybody looked at, and a new session for
+# every visitor who wasn't logged in (including search engine robots), and
+# the stack kept growing for as long as the session lasted.  Now:
+#   - only the last HISTORY_SIZE pages are kept.  The Stack is a deque with
+#     a maxlen, so pushing onto a full one drops the oldest page (a ring buffer)
+#   - visitors who aren't logged in don't get a history, or a session
+#   - the history is only saved when it changes.  Refreshing a page
+#     doesn't push it a second time, so it doesn't change anything
+#   - it is saved by NavigationHistoryMiddleware once the page is ready,
+#     in a signed cookie (the default), the cache or the session, chosen
+#     by NAVIGATION_HISTORY_STORE in settings.py
+import json
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import BadSignature
+
+COOKIE_NAME = "visited_links"
+SESSION_KEY = "visited_links"
+# the history is forgotten after two weeks without a visit
+MAX_AGE = 14 * 24 * 60 * 60
+
+
+def history_size():
+    return getattr(settings, "NAVIGATION_HISTORY_SIZE", 10)
+
+
+def store_name():
+    return getattr(settings, "NAVIGATION_HISTORY_STORE", "cookie")
+
+
+class Stack:
+    def __init__(self, items=(), size=None):
+        self.items = deque(items, maxlen=size or history_size())
+        # set when the stack has been changed and needs saving
+        self.changed = False
+
+    # a page that is already on top (like when the page is refreshed)
+    # isn't pushed again
+    def push(self, item):
+        if self.items and self.items[-1] == item:
+            return
+        self.items.append(item)
+        self.changed = True
+
+    def pop(self):
+        if not self.items:
+            return None
+        self.changed = True
+        return self.items.pop()
+
+    def peek(self):
+        return self.items[-1] if self.items else None
+
+    def is_empty(self):
+        return len(self.items) == 0
+
+    def size(self):
+        return len(self.items)
+
+    def to_json(self):
+        return list(self.items)
+
+    @staticmethod
+    def from_json(json_data):
+        if not isinstance(json_data, list):
+            json_data = []
+        return Stack(item for item in json_data if isinstance(item, str))
+
+
+# The cookie is signed with the user's id in the salt so it can't be edited,
+# and it doesn't work for somebody else logging in on the same browser
+def cookie_salt(request):
+    return f"kswap.history.{request.user.pk}"
+
+
+def cache_key(request):
+    return f"kswap:history:{request.user.pk}"
+
+
+def read(request):
+    store = store_name()
+    if store == "session":
+        return request.session.get(SESSION_KEY, [])
+    if store == "cache":
+        return cache.get(cache_key(request), [])
+    try:
+        return json.loads(request.get_signed_cookie(COOKIE_NAME, default="[]", salt=cookie_salt(request)))
+    except (BadSignature, ValueError):
+        return []
+
+
+def write(request, response, items):
+    store = store_name()
+    if store == "session":
+        request.session[SESSION_KEY] = items
+    elif store == "cache":
+        cache.set(cache_key(request), items, MAX_AGE)
+    else:
+        response.set_signed_cookie(
+            COOKIE_NAME,
+            json.dumps(items),
+            salt=cookie_salt(request),
+            max_age=MAX_AGE,
+            httponly=True,
+            samesite="Lax",
+            secure=request.is_secure(),
+        )
+
+
+# The history of the user making the request.  It is read at most once per
+# request.  Anyone who isn't logged in gets an empty one which is never saved
+def for_request(request):
+    if not hasattr(request, "_visited_links"):
+        if request.user.is_authenticated:
+            request._visited_links = Stack.from_json(read(request))
+        else:
+            request._visited_links = None
+    return request._visited_links
+
+
+def visit(request, url, is_back_link):
+    stack = for_request(request)
+    if stack is not None and not is_back_link:
+        stack.push(url)
+
+
+# Takes the last page off the history.  The top of the history is usually
+# the page the Back link was clicked on, so that one is skipped
+def go_back(request):
+    stack = for_request(request)
+    if stack is None:
+        return None
+    current = urlparse(request.headers.get("Referer", "")).path
+    last_visited = stack.pop()
+    if last_visited and last_visited == current:
+        last_visited = stack.pop()
+    return last_visited
+
+
+# It works with both WSGI and ASGI.  Under ASGI it is async too, so Django
+# doesn't need to move the request to another thread to call it
+class NavigationHistoryMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.save(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.save(request, await self.get_response(request))
+
+    def save(self, request, response):
+        stack = getattr(request, "_visited_links", None)
+        if stack is not None and stack.changed:
+            write(request, response, stack.to_json())
+        return response
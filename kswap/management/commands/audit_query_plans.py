@@ -0,0 +1,143 @@
+# Audit of the query plans of every page in kswap/urls.py
+# It fills the database with made-up data (see seed() in
+# kswap/management/seed.py), logs in as the busy user and asks for every
+# page once, recording the SQL each one runs.  Each query is then explained
+# (see kswap/query_plans.py) and the full table scans and temporary sorts
+# are listed by page, with the columns the query filters on as the hint
+# for an index.  The made-up data is rolled back at the end, and its
+# picture is saved in a temporary folder.
+#
+# The problems we already know about and accept (a scan of the small
+# kashrut table to fill a drop down...) are kept in
+# kswap/query_plan_baseline.json.  Anything not in it is shown as NEW and
+# the command fails, so a deploy script or CI can stop.  After looking at
+# the new ones, and adding an index or deciding they are fine, save them
+# with --update-baseline.  The database chooses differently for a small
+# table, so compare runs made with the same --properties
+# python manage.py audit_query_plans
+# python manage.py audit_query_plans --properties 5000 --verbose
+# python manage.py audit_query_plans --update-baseline
+import json
+import os
+import random
+import tempfile
+import uuid
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import URLPattern, reverse
+
+from kswap import query_plans, urls
+from kswap.management.seed import rolled_back, seed, sizes_for
+from kswap.models import Booking, Property
+
+BASELINE = os.path.join(os.path.dirname(query_plans.__file__), "query_plan_baseline.json")
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the SQL of every kswap page and report full scans and temporary sorts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--properties", type=int, default=2000)
+        parser.add_argument("--baseline", default=BASELINE)
+        parser.add_argument("--update-baseline", action="store_true", help="accept everything found now")
+        parser.add_argument("--verbose", action="store_true", help="show the SQL of each problem")
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ("sqlite", "postgresql"):
+            raise CommandError(f"Can't read the query plans of {connection.vendor}")
+        # the placeholder picture seed() saves goes in a folder that is thrown away
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+            SEARCH_CACHE_TIMEOUT=0,
+        ), rolled_back():
+            found = self.run(options["properties"])
+
+        baseline = {}
+        if os.path.exists(options["baseline"]):
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)
+        new = self.report(found, baseline, options["verbose"])
+
+        if options["update_baseline"]:
+            with open(options["baseline"], "w") as file:
+                json.dump({page: sorted(problems) for page, problems in sorted(found.items())}, file, indent=2)
+                file.write("\n")
+            self.stdout.write(f"Saved to {options['baseline']}")
+        elif new:
+            raise CommandError(f"{new} new full scans or sorts, see above")
+
+    def run(self, size):
+        self.stdout.write(f"Making the data for {size} properties...")
+        busy = seed(sizes_for(size), random.Random(1), prefix="audit_query_plans")
+        # the planner chooses its indexes from the table statistics
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        client = Client()
+        client.force_login(busy)
+
+        home = Property.objects.filter(owner=busy).order_by("id").first()
+        other = Property.objects.exclude(owner=busy).order_by("id").first()
+        booking = Booking.objects.filter(user=busy).order_by("id").first()
+        # the number each page with a pk in its address is given
+        pks = {
+            "property_book": other.id,
+            "api_booking": booking.id,
+        }
+        start = date.today() + timedelta(days=60)
+        # pages that run different SQL with some of their filters
+        extra = {
+            "property_search": [
+                {
+                    "city": "London",
+                    "start_date": start.isoformat(),
+                    "end_date": (start + timedelta(days=7)).isoformat(),
+                },
+                {"q": "shul", "sort": "rating"},
+            ],
+            "api_properties": [{"include": "owner,images"}],
+        }
+
+        found = {}
+        for pattern in urls.urlpatterns:
+            if not isinstance(pattern, URLPattern):
+                continue
+            kwargs = {}
+            for name, converter in pattern.pattern.converters.items():
+                kwargs[name] = uuid.uuid4() if name == "upload_id" else pks.get(pattern.name, home.id)
+            url = reverse(pattern.name, kwargs=kwargs)
+            queries = []
+            for params in [{}] + extra.get(pattern.name, []):
+                with CaptureQueriesContext(connection) as captured:
+                    response = client.get(url, params)
+                    # the exports only read their rows as they are sent
+                    if response.streaming:
+                        b"".join(response.streaming_content)
+                # read now, every request empties Django's list of queries
+                queries += captured.captured_queries
+            # the plans are read after the pages, so EXPLAIN isn't captured
+            found[pattern.name] = query_plans.audit(queries)
+        return found
+
+    def report(self, found, baseline, verbose):
+        new = 0
+        for page, problems in found.items():
+            if not problems:
+                continue
+            self.stdout.write(page)
+            for key, problem in sorted(problems.items()):
+                note = f"  ({problem['rows']} rows)"
+                if key not in baseline.get(page, []):
+                    note += "  NEW"
+                    new += 1
+                if problem["columns"]:
+                    note += f"  filters on {', '.join(problem['columns'])}, an index may help"
+                self.stdout.write(f"  {key}{note}")
+                if verbose:
+                    self.stdout.write(f"    {problem['sql']}")
+        self.stdout.write(f"{new} new full scans or sorts")
+        return new
@@ -0,0 +1,98 @@
+# Benchmark of the JSON API (api.py) against the HTML pages that show the
+# same things.  For each pair it measures how many bytes are sent, how many
+# queries are made and the median and 99th percentile time of many requests.
+# The made-up data is rolled back at the end
+# run it with
+# python manage.py benchmark_api --properties 10000 --requests 200
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from kswap import facets
+from kswap.management.seed import make_property, rolled_back
+from kswap.models import Booking, Profile, Property
+
+
+class Command(BaseCommand):
+    help = "Compare the size and speed of the JSON API with the HTML pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--properties", type=int, default=10000)
+        parser.add_argument("--owners", type=int, default=1000)
+        parser.add_argument("--bookings", type=int, default=100)
+        parser.add_argument("--requests", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with rolled_back(), override_settings(
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+        ):
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owners = User.objects.bulk_create([User(username=f"benchmark_api_{i}") for i in range(options["owners"])])
+        Profile.objects.bulk_create([Profile(user=owner) for owner in owners])
+        Property.objects.bulk_create(
+            [make_property(rng.choice(owners), i, rng) for i in range(options["properties"])], batch_size=1000
+        )
+        facets.rebuild()
+
+        # one user with lots of accepted swaps, for the escapes page
+        user = User.objects.create_user("benchmark_api_user", password="password")
+        home = make_property(user, 0, rng)
+        home.save()
+        others = list(Property.objects.exclude(owner=user).order_by("?")[: options["bookings"]])
+        start = date(2030, 1, 1)
+        Booking.objects.bulk_create(
+            [
+                Booking(
+                    user=user,
+                    property=other,
+                    my_property=home,
+                    date_from=start + timedelta(weeks=i),
+                    date_to=start + timedelta(weeks=i, days=6),
+                    status="accepted",
+                )
+                for i, other in enumerate(others)
+            ]
+        )
+        client = Client()
+        client.login(username="benchmark_api_user", password="password")
+
+        some_home = others[0].id
+        api_home = reverse("api_property", args=[some_home])
+        pairs = [
+            ("search, first page", reverse("property_search"), reverse("api_properties") + "?include=owner"),
+            ("one property", reverse("property_detail", args=[some_home]), api_home + "?include=owner,images"),
+            ("next escapes", reverse("your_next_escapes"), reverse("api_bookings") + "?status=accepted&limit=100"),
+        ]
+        self.stdout.write(f"{'':22} {'':5} {'bytes':>8} {'queries':>8} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for name, html_url, api_url in pairs:
+            self.measure(client, name, "html", html_url, {}, options["requests"])
+            self.measure(client, "", "json", api_url, {}, options["requests"])
+
+        # asking again with the ETag
+        etag = client.get(api_home)["ETag"]
+        self.measure(client, "property, not changed", "304", api_home, {"if_none_match": etag}, options["requests"])
+
+    def measure(self, client, name, kind, url, headers, requests):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, headers=headers)
+        size = len(response.content)
+        query_count = len(queries)
+        timings = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            client.get(url, headers=headers)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(f"{name:22} {kind:5} {size:>8} {query_count:>8} {p50:>9.2f} {p99:>9.2f}")
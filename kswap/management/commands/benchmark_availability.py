@@ -0,0 +1,75 @@
+# Benchmark for the date search on the property list
+# It compares the old way (a subquery over every overlapping Booking) with
+# the OccupiedDay lookup used now.  The test data is made inside a transaction
+# which is rolled back at the end so the real database is not changed
+# run it with
+# python manage.py benchmark_availability --sizes 1000 10000 100000
+import random
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from kswap import availability
+from kswap.management.seed import make_property, rolled_back, time_ms
+from kswap.models import Booking, Property
+
+
+class Command(BaseCommand):
+    help = "Time the property date search against growing numbers of bookings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--properties", type=int, default=2000)
+        parser.add_argument("--repeats", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owner = User.objects.create(username="benchmark_availability_owner")
+        Property.objects.bulk_create(
+            [make_property(owner, i, rng) for i in range(options["properties"])]
+        )
+        property_ids = list(Property.objects.filter(owner=owner).values_list("id", flat=True))
+
+        # most of the bookings are history from the last ten years and the
+        # search is for a fortnight in the future
+        today = date.today()
+        search_from = today + timedelta(days=60)
+        search_to = search_from + timedelta(days=14)
+        statuses = ["accepted", "declined", "pending"]
+        made = 0
+
+        self.stdout.write("bookings   old subquery (ms)   occupied days (ms)")
+        for size in sorted(options["sizes"]):
+            bookings = []
+            for _ in range(size - made):
+                date_from = today - timedelta(days=rng.randint(-120, 3650))
+                bookings.append(
+                    Booking(
+                        user=owner,
+                        property_id=rng.choice(property_ids),
+                        my_property_id=rng.choice(property_ids),
+                        date_from=date_from,
+                        date_to=date_from + timedelta(days=rng.randint(2, 14)),
+                        status=rng.choice(statuses),
+                    )
+                )
+            Booking.objects.bulk_create(bookings, batch_size=1000)
+            made = size
+            # bulk_create does not send post_save, so build the store in one go
+            availability.rebuild()
+
+            base = Property.objects.filter(owner=owner)
+            old = base.exclude(
+                id__in=Booking.objects.filter(
+                    date_from__lte=search_to, date_to__gte=search_from
+                ).values_list("property", flat=True)
+            )
+            new = availability.available_properties(base, search_from, search_to)
+            old_ms = time_ms(lambda: list(old.values_list("id", flat=True)), options["repeats"])
+            new_ms = time_ms(lambda: list(new.values_list("id", flat=True)), options["repeats"])
+            self.stdout.write(f"{size:>8}   {old_ms:>17.2f}   {new_ms:>18.2f}")
@@ -0,0 +1,65 @@
+# Benchmark for the filters on the property search page
+# It fills the database with made-up properties (rolled back at the end),
+# then times the whole page, including the counts next to every filter
+# run it with
+# python manage.py benchmark_facets --properties 100000
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from kswap import facets
+from kswap.management.seed import make_property, rolled_back, time_ms
+from kswap.models import Kashrut, Profile, Property
+
+SEARCHES = [
+    {},
+    {"country": "GB"},
+    {"country": "GB", "city": "London", "succah": "true"},
+    {"country": "IL", "no_of_rooms": "4", "passover_kitchen": "true", "pet_friendly": "false",
+     "smoking_allowed": "false", "property_type": "flat", "max_occupancy": "6"},
+]
+
+
+class Command(BaseCommand):
+    help = "Time the filtered property search page with lots of properties"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--properties", type=int, default=100000)
+        parser.add_argument("--owners", type=int, default=5000)
+        parser.add_argument("--repeats", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with rolled_back(), override_settings(
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+        ):
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        kashruts = Kashrut.objects.bulk_create([Kashrut(name=f"Benchmark Beth Din {i}") for i in range(10)])
+        owners = User.objects.bulk_create(
+            [User(username=f"benchmark_facets_{i}") for i in range(options["owners"])]
+        )
+        Profile.objects.bulk_create([Profile(user=owner, kashrut=rng.choice(kashruts)) for owner in owners])
+        Property.objects.bulk_create(
+            [make_property(rng.choice(owners), i, rng) for i in range(options["properties"])],
+            batch_size=1000,
+        )
+        # bulk_create does not send post_save so build the bitmaps in one go
+        bitmaps = facets.rebuild()
+        self.stdout.write(f"{options['properties']} properties, {bitmaps} facet bitmaps")
+
+        client = Client()
+        url = reverse("property_search")
+        for search in SEARCHES:
+            with CaptureQueriesContext(connection) as queries:
+                client.get(url, search)
+            # read the count straight away - every request clears the query log
+            query_count = len(queries)
+            ms = time_ms(lambda: client.get(url, search), options["repeats"])
+            self.stdout.write(f"{ms:8.2f} ms  {query_count:3} queries  {search or 'no filters'}")
@@ -0,0 +1,88 @@
+# Benchmark for the "homes near a place" search on the property list
+# It compares the grid cell search in geo.py with working out the distance
+# to every property, for growing numbers of properties.  The properties are
+# spread around a few towns like real listings.  The test data is rolled back
+# run it with
+# python manage.py benchmark_geo --sizes 1000 10000 100000
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from kswap import geo
+from kswap.management.seed import make_property, rolled_back, time_ms
+from kswap.models import Property
+
+# (latitude, longitude) of some towns with lots of homes
+TOWNS = [
+    (51.51, -0.13),  # London
+    (53.48, -2.24),  # Manchester
+    (31.77, 35.21),  # Jerusalem
+    (32.08, 34.83),  # Bnei Brak
+    (40.71, -74.01),  # New York
+    (48.86, 2.35),  # Paris
+    (51.22, 4.40),  # Antwerp
+    (43.65, -79.38),  # Toronto
+]
+
+
+class Command(BaseCommand):
+    help = "Time the grid cell search for homes near a place against checking every home"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--km", type=int, default=30)
+        parser.add_argument("--nearest", type=int, default=20)
+        parser.add_argument("--repeats", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owner = User.objects.create(username="benchmark_geo_owner")
+        # search every home, like the property list does
+        homes = Property.objects.all()
+        latitude, longitude = TOWNS[1]
+        km = options["km"]
+
+        def every_home():
+            found = []
+            for property_id, lat, lng in (
+                homes.filter(latitude__isnull=False)
+                .values_list("id", "latitude", "longitude")
+                .iterator(chunk_size=2000)
+            ):
+                away = geo.distance_km(latitude, longitude, lat, lng)
+                if away <= km:
+                    found.append((property_id, away))
+            found.sort(key=lambda pair: (pair[1], pair[0]))
+            return found
+
+        made = 0
+        self.stdout.write("properties   matches   every home (ms)   grid (ms)   nearest (ms)")
+        for size in sorted(options["sizes"]):
+            properties = []
+            for i in range(made, size):
+                town = rng.choice(TOWNS)
+                # homes up to about 100 km from the middle of the town
+                lat = town[0] + rng.uniform(-1, 1)
+                lng = town[1] + rng.uniform(-1, 1)
+                properties.append(
+                    make_property(owner, i, rng, latitude=lat, longitude=lng, geo_cell=geo.grid_cell(lat, lng))
+                )
+            Property.objects.bulk_create(properties, batch_size=1000)
+            made = size
+
+            matches = geo.within(homes, latitude, longitude, km)
+            if matches != every_home():
+                self.stdout.write(self.style.ERROR("The grid search and the full check found different homes"))
+            scan_ms = time_ms(every_home, options["repeats"])
+            grid_ms = time_ms(lambda: geo.within(homes, latitude, longitude, km), options["repeats"])
+            nearest_ms = time_ms(
+                lambda: geo.nearest(homes, latitude, longitude, options["nearest"]), options["repeats"]
+            )
+            self.stdout.write(
+                f"{size:>10}   {len(matches):>7}   {scan_ms:>15.2f}   {grid_ms:>9.2f}   {nearest_ms:>12.2f}"
+            )
@@ -0,0 +1,105 @@
+# Benchmark for the pictures on the property detail page
+# It makes a property with some camera sized photos, makes their smaller
+# copies and then counts how many bytes of pictures a browser downloads for
+# one view of the detail page: the originals, as the page used to send, and
+# the copy srcset picks for a few screen widths.  Everything is rolled back
+# and the files are written to a temporary folder
+# run it with
+# python manage.py benchmark_images --images 6
+import random
+import re
+import tempfile
+from io import BytesIO
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from PIL import Image as PillowImage
+from PIL import ImageFilter
+
+from kswap import variants
+from kswap.management.seed import make_property, rolled_back, time_ms
+from kswap.models import Image
+
+# screen widths in real pixels, so a 400 px wide phone with a 2x screen is 800
+SCREEN_WIDTHS = [400, 800, 1200, 2400]
+
+
+# A made-up photo with smooth colours and some noise so that it
+# compresses about as well as a real one
+def made_up_photo(rng, width, height):
+    picture = PillowImage.effect_noise((width // 8, height // 8), 60).convert("RGB")
+    picture = picture.resize((width, height), PillowImage.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    tint = PillowImage.new("RGB", (width, height), tuple(rng.randint(0, 255) for _ in range(3)))
+    picture = PillowImage.blend(picture, tint, 0.4)
+    noise = PillowImage.effect_noise((width, height), 20).convert("RGB")
+    data = BytesIO()
+    PillowImage.blend(picture, noise, 0.15).save(data, "JPEG", quality=92)
+    return data.getvalue()
+
+
+# The URL a browser takes from a srcset for a screen this wide.  The page
+# says the picture fills the screen up to 1200 px, so it is the smallest
+# copy at least that wide, or the biggest copy there is
+def chosen_from_srcset(srcset, screen_width):
+    candidates = sorted((int(width), url) for url, width in re.findall(r"(\S+) (\d+)w", srcset))
+    for width, url in candidates:
+        if width >= screen_width:
+            return url
+    return candidates[-1][1]
+
+
+def size_of_url(url):
+    return default_storage.size(url.removeprefix("/media/"))
+
+
+class Command(BaseCommand):
+    help = "Compare the picture bytes sent per detail page view before and after the resized copies"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=6)
+        parser.add_argument("--width", type=int, default=4000)
+        parser.add_argument("--height", type=int, default=3000)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root,
+            MEDIA_URL="/media/",
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+        ), rolled_back():
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owner = User.objects.create(username="benchmark_images_owner")
+        home = make_property(owner, 1, rng)
+        home.save()
+        images = []
+        for number in range(options["images"]):
+            photo = made_up_photo(rng, options["width"], options["height"])
+            image = Image(property=home)
+            image.image.save(f"benchmark_{number}.jpg", ContentFile(photo), save=False)
+            image.save()
+            images.append(image)
+
+        # the worker threads only start after a commit, which never happens
+        # here, so make the copies in this thread and time them
+        made_ms = time_ms(lambda: [variants.make_variants(image) for image in images], 1)
+        self.stdout.write(f"Made the copies of {len(images)} pictures in {made_ms:.0f} ms")
+
+        page = Client().get(home.get_absolute_url()).content.decode()
+        webp_srcsets = re.findall(r'<source type="image/webp" srcset="([^"]+)"', page)
+        jpeg_srcsets = re.findall(r'<img src="[^"]+" srcset="([^"]+)"', page)
+        before = sum(image.image.size for image in images)
+
+        self.stdout.write(f"Before: {before / 1024:10.0f} KB of originals per page view")
+        for screen_width in SCREEN_WIDTHS:
+            webp = sum(size_of_url(chosen_from_srcset(srcset, screen_width)) for srcset in webp_srcsets)
+            jpeg = sum(size_of_url(chosen_from_srcset(srcset, screen_width)) for srcset in jpeg_srcsets)
+            self.stdout.write(
+                f"{screen_width:>5} px screen: {webp / 1024:8.0f} KB WebP ({webp / before:.1%}),"
+                f" {jpeg / 1024:8.0f} KB JPEG ({jpeg / before:.1%})"
+            )
@@ -0,0 +1,95 @@
+# Benchmark for the swap matching in matching.py
+# For growing numbers of homes, each with one wish, it times matching one
+# new wish (what happens when somebody adds a wish) against comparing the
+# new wish with every other wish, which only finds the swaps of 2 homes.
+# There are more towns as there are more homes, about --per-town homes in
+# each, like real listings.  The test data is rolled back
+# run it with
+# python manage.py benchmark_matching --sizes 1000 10000 100000
+import random
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from kswap import matching
+from kswap.management.seed import COUNTRIES, make_property, rolled_back, time_ms
+from kswap.models import Property, SwapWish
+
+
+class Command(BaseCommand):
+    help = "Time matching a new swap wish against checking it with every other wish"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--per-town", type=int, default=50)
+        parser.add_argument("--new-wishes", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        start = date.today()
+
+        def random_wish(owner, home, towns):
+            country, city = rng.choice(towns)
+            date_from = start + timedelta(days=rng.randint(0, 365))
+            return SwapWish(
+                owner=owner,
+                home=home,
+                home_country=home.country,
+                home_city=home.city,
+                country=country,
+                # one in ten are happy to go anywhere in the country
+                city="" if rng.random() < 0.1 else city,
+                date_from=date_from,
+                date_to=date_from + timedelta(days=rng.randint(7, 28)),
+            )
+
+        def every_wish(new):
+            found = []
+            for other in SwapWish.objects.values_list(*matching.FIELDS, named=True).iterator(chunk_size=2000):
+                if (
+                    other.owner_id != new.owner_id
+                    and matching.wants(new, other)
+                    and matching.wants(other, new)
+                    and matching.shared_dates([new, other])
+                ):
+                    found.append(other)
+            return found
+
+        made = 0
+        self.stdout.write("homes   towns   2 homes found   every wish (ms)   matching (ms)   matches")
+        for size in sorted(options["sizes"]):
+            towns = [(COUNTRIES[i % len(COUNTRIES)], f"Town {i}") for i in range(max(8, size // options["per_town"]))]
+            owners = User.objects.bulk_create(
+                [User(username=f"benchmark_matching_{i}") for i in range(made, size)], batch_size=1000
+            )
+            homes = []
+            for owner, i in zip(owners, range(made, size)):
+                country, city = rng.choice(towns)
+                homes.append(make_property(owner, i, rng, country=country, city=city))
+            Property.objects.bulk_create(homes, batch_size=1000)
+            # bulk_create doesn't send post_save so these wishes aren't matched
+            # yet, which is fine because only the new wishes below are timed
+            SwapWish.objects.bulk_create([random_wish(home.owner, home, towns) for home in homes], batch_size=1000)
+            made = size
+
+            new_wishes = []
+            for owner in rng.sample(owners, min(options["new_wishes"], len(owners))):
+                wish = random_wish(owner, Property.objects.filter(owner=owner).get(), towns)
+                SwapWish.objects.bulk_create([wish])
+                new_wishes.append(SwapWish.objects.filter(owner=owner).values_list(*matching.FIELDS, named=True).last())
+
+            pairs = 0
+            for new in new_wishes:
+                pairs += len(every_wish(new))
+            scan_ms = time_ms(lambda: [every_wish(new) for new in new_wishes], 1) / len(new_wishes)
+            found = []
+            match_ms = time_ms(lambda: found.append(sum(len(matching.match_wish(new.id)) for new in new_wishes)), 1)
+            match_ms /= len(new_wishes)
+            self.stdout.write(
+                f"{size:>6}   {len(towns):>5}   {pairs:>13}   {scan_ms:>15.2f}   {match_ms:>13.2f}   {found[0]:>7}"
+            )
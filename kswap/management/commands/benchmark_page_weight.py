@@ -0,0 +1,132 @@
+# Benchmark of what a browser downloads for one view of a page
+# It makes a property with some photos and their smaller copies, runs
+# collectstatic into a temporary folder with the real static files storage
+# (hashed names, gzip and brotli copies) and asks for the property detail
+# page.  Then every file the page names is counted as one request:
+#   - our static files are asked for through WhiteNoiseMiddleware, as a
+#     browser that accepts brotli and gzip would, and the bytes sent, the
+#     encoding and the Cache-Control header are shown
+#   - pictures are counted at the size srcset picks for --screen-width, and
+#     the lazy ones, that are only downloaded when the carousel gets near
+#     them, are added up on their own
+#   - files from other sites can't be measured here, they are listed with
+#     their host as each one needs its own connection
+# Everything is rolled back and the files are written to temporary folders
+# run it with
+# python manage.py benchmark_page_weight --images 6
+import random
+import re
+import tempfile
+from urllib.parse import urlparse
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+
+from kswap import variants
+from kswap.management.commands.benchmark_images import chosen_from_srcset, made_up_photo, size_of_url
+from kswap.management.seed import make_property, rolled_back
+from kswap.models import Image
+
+# the files a page makes the browser download, with the attribute their URL is in
+PAGE_FILES = re.compile(r"<(script|link|img|source)\b([^>]*)>")
+ATTRIBUTE = re.compile(r'([\w-]+)="([^"]*)"')
+
+
+class Command(BaseCommand):
+    help = "Count the requests and bytes of one view of the property detail page"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=6)
+        parser.add_argument("--screen-width", type=int, default=1200)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as media_root, tempfile.TemporaryDirectory() as static_root:
+            with override_settings(
+                MEDIA_ROOT=media_root,
+                MEDIA_URL="/media/",
+                STATIC_ROOT=static_root,
+                STATICFILES_STORAGE="whitenoise.storage.CompressedManifestStaticFilesStorage",
+            ), rolled_back():
+                call_command("collectstatic", interactive=False, verbosity=0)
+                self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owner = User.objects.create(username="benchmark_page_weight_owner")
+        home = make_property(owner, 1, rng)
+        home.save()
+        for number in range(options["images"]):
+            image = Image(property=home)
+            image.image.save(f"benchmark_{number}.jpg", ContentFile(made_up_photo(rng, 2400, 1800)), save=False)
+            image.save()
+            variants.make_variants(image)
+
+        # a new Client so WhiteNoiseMiddleware reads the new STATIC_ROOT
+        client = Client()
+        response = client.get(home.get_absolute_url())
+        if response.status_code != 200:
+            raise CommandError(f"The detail page answered {response.status_code}")
+        page = response.content.decode()
+        self.stdout.write(f"{'page':50} {len(page):>9} bytes")
+
+        requests = 1
+        sent = len(page)
+        lazy = 0
+        hosts = set()
+        for tag, attributes in PAGE_FILES.findall(page):
+            attributes = dict(ATTRIBUTE.findall(attributes))
+            if tag == "link" and attributes.get("rel") != "stylesheet":
+                continue
+            if tag == "source":
+                # the browser takes the WebP copy instead of the <img> after it
+                url = chosen_from_srcset(attributes["srcset"], options["screen_width"])
+                size = size_of_url(url)
+                loading = "lazy" if self.next_is_lazy(page, url) else ""
+                self.stdout.write(f"{url:50} {size:>9} bytes  {loading}")
+                if loading:
+                    lazy += size
+                else:
+                    requests += 1
+                    sent += size
+                continue
+            url = attributes.get("src") or attributes.get("href")
+            if not url or tag == "img" and "srcset" in attributes:
+                continue
+            if urlparse(url).netloc:
+                requests += 1
+                hosts.add(urlparse(url).netloc)
+                self.stdout.write(f"{url:50} {'?':>9}        another site")
+            elif url.startswith("/media/"):
+                size = size_of_url(url)
+                if attributes.get("loading") == "lazy":
+                    lazy += size
+                else:
+                    requests += 1
+                    sent += size
+                self.stdout.write(f"{url:50} {size:>9} bytes  {attributes.get('loading', '')}")
+            else:
+                response = client.get(url, headers={"Accept-Encoding": "br, gzip"})
+                size = len(b"".join(response.streaming_content))
+                response.close()
+                requests += 1
+                sent += size
+                self.stdout.write(
+                    f"{url:50} {size:>9} bytes  {response.get('Content-Encoding', 'not compressed')},"
+                    f" {response.get('Cache-Control', 'no Cache-Control')}"
+                )
+
+        self.stdout.write(f"{requests} requests, {sent / 1024:.0f} KB when the page opens")
+        self.stdout.write(f"{lazy / 1024:.0f} KB of lazy pictures, only downloaded when they are scrolled to")
+        if hosts:
+            self.stdout.write(f"and files from {len(hosts)} other sites, not counted: {', '.join(sorted(hosts))}")
+
+    # Whether the <img> that follows this <source> in the page is lazy
+    @staticmethod
+    def next_is_lazy(page, url):
+        after = page[page.index(url) :]
+        img = re.search(r"<img\b[^>]*>", after)
+        return bool(img) and 'loading="lazy"' in img.group(0)
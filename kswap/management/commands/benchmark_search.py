@@ -0,0 +1,72 @@
+# Benchmark for the keyword search on the property list
+# It compares the search index with the icontains scan that would be needed
+# without it, for growing numbers of properties.  The test data is rolled back
+# Every description has common words plus the name of one street out of a few
+# thousand, so searching for a street is like a real, selective search.
+# Searching only for common words matches a big part of the table and then
+# ranking all the matches costs about as much as a scan
+# run it with
+# python manage.py benchmark_search --sizes 1000 10000 100000
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from kswap import search
+from kswap.management.seed import make_property, rolled_back, time_ms
+from kswap.models import Property
+
+WORDS = (
+    "bright spacious garden balcony quiet street walking distance shul shops park "
+    "kosher kitchen two sinks ovens family friendly cot high chair victorian terrace "
+    "modern flat lift parking view sea mountains river station eruv synagogue "
+    "mikvah school playground bakery butcher succah passover heating air conditioning"
+).split()
+
+
+class Command(BaseCommand):
+    help = "Time the keyword search index against icontains scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+        parser.add_argument("--query", default="Street1234")
+        parser.add_argument("--repeats", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owner = User.objects.create(username="benchmark_search_owner")
+        words = search.words_in(options["query"])
+        scan = Property.objects.filter(owner=owner)
+        for word in words:
+            scan = scan.filter(
+                Q(home_description__icontains=word) | Q(city__icontains=word) | Q(address__icontains=word)
+            )
+
+        made = 0
+        self.stdout.write("properties   matches   icontains (ms)   index (ms)")
+        for size in sorted(options["sizes"]):
+            Property.objects.bulk_create(
+                [
+                    make_property(
+                        owner,
+                        i,
+                        rng,
+                        home_description=f"On Street{rng.randint(1, 5000)} " + " ".join(rng.choices(WORDS, k=40)),
+                    )
+                    for i in range(made, size)
+                ],
+                batch_size=1000,
+            )
+            made = size
+            # bulk_create does not send post_save so index everything in one go
+            search.rebuild(Property.objects.filter(owner=owner))
+
+            matches = len(search.ranked_ids(options["query"], limit=size))
+            scan_ms = time_ms(lambda: list(scan.values_list("id", flat=True)), options["repeats"])
+            index_ms = time_ms(lambda: search.ranked_ids(options["query"]), options["repeats"])
+            self.stdout.write(f"{size:>10}   {matches:>7}   {scan_ms:>14.2f}   {index_ms:>10.2f}")
@@ -0,0 +1,118 @@
+# Benchmark of the search results cache (kswap/search_cache.py)
+# It makes up a lot of homes and then sends the property search page the
+# kind of searches real visitors make: a few popular ones (London in the
+# summer holidays...) asked for again and again and a long tail of rarer
+# ones, with the n-th most popular asked for about 1/n as often (Zipf's
+# law).  Every --write-every searches a booking is made, which throws away
+# the searches with dates.  The same searches are timed with the cache off,
+# with only Django's cache, and with the local layer in front of it.
+# The made-up data is rolled back at the end
+# run it with
+# python manage.py benchmark_search_cache --properties 20000 --requests 2000
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from kswap import availability, facets, search_cache
+from kswap.management.seed import CITIES, make_property, rolled_back
+from kswap.models import Booking, Profile, Property
+
+# the start of the school holidays that people search for
+HOLIDAYS = [date(2030, 4, 1), date(2030, 7, 20), date(2030, 8, 3), date(2030, 12, 21)]
+
+
+class Command(BaseCommand):
+    help = "Time the property search with and without the search results cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--properties", type=int, default=20000)
+        parser.add_argument("--owners", type=int, default=2000)
+        parser.add_argument("--searches", type=int, default=300, help="how many different searches there are")
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--write-every", type=int, default=50)
+
+    def handle(self, *args, **options):
+        with rolled_back(), override_settings(
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+        ):
+            self.run(options)
+
+    def run(self, options):
+        rng = random.Random(1)
+        owners = User.objects.bulk_create([User(username=f"benchmark_search_{i}") for i in range(options["owners"])])
+        Profile.objects.bulk_create([Profile(user=owner) for owner in owners])
+        Property.objects.bulk_create(
+            [make_property(rng.choice(owners), i, rng) for i in range(options["properties"])], batch_size=1000
+        )
+        facets.rebuild()
+        self.homes = list(Property.objects.values_list("id", "owner_id"))
+
+        searches = [self.make_search(rng) for _ in range(options["searches"])]
+        weights = [1 / rank for rank in range(1, len(searches) + 1)]
+        workload = rng.choices(searches, weights, k=options["requests"])
+
+        self.stdout.write(f"{'cache':12} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'hit ratio':>10}")
+        modes = [("off", 0, 0), ("django only", 300, 0), ("two layers", 300, 100)]
+        for name, timeout, local_size in modes:
+            with override_settings(SEARCH_CACHE_TIMEOUT=timeout, SEARCH_CACHE_LOCAL_SIZE=local_size):
+                cache.clear()
+                search_cache.clear_local()
+                search_cache.metrics.clear()
+                self.measure(name, workload, options["write_every"], random.Random(2))
+
+    def make_search(self, rng):
+        params = {}
+        if rng.random() < 0.7:
+            params["city"] = rng.choice(CITIES)
+        if rng.random() < 0.3:
+            params["succah"] = "true"
+        if rng.random() < 0.2:
+            params["no_of_rooms"] = str(rng.randint(2, 5))
+        if rng.random() < 0.2:
+            params["q"] = rng.choice(["shul", "lovely", "shops"])
+        if rng.random() < 0.6:
+            start = rng.choice(HOLIDAYS) + timedelta(days=rng.choice([0, 7]))
+            params["start_date"] = start.isoformat()
+            params["end_date"] = (start + timedelta(days=6)).isoformat()
+        return params
+
+    # a booking between two random homes, which changes the searches with dates
+    def book(self, rng):
+        (home, owner_id), (guest_home, guest_id) = rng.sample(self.homes, 2)
+        start = rng.choice(HOLIDAYS) + timedelta(days=rng.randint(0, 14))
+        booking = Booking(
+            user_id=guest_id,
+            property_id=home,
+            my_property_id=guest_home,
+            date_from=start,
+            date_to=start + timedelta(days=3),
+        )
+        try:
+            availability.reserve(booking)
+        except availability.BookingConflict:
+            pass
+
+    def measure(self, name, workload, write_every, rng):
+        client = Client()
+        url = reverse("property_search")
+        timings = []
+        started = time.perf_counter()
+        for number, params in enumerate(workload, 1):
+            if number % write_every == 0:
+                self.book(rng)
+            begin = time.perf_counter()
+            client.get(url, params)
+            timings.append((time.perf_counter() - begin) * 1000)
+        rate = len(workload) / (time.perf_counter() - started)
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        ratio = search_cache.stats()["hit_ratio"]
+        self.stdout.write(f"{name:12} {rate:>8.1f} {p50:>9.2f} {p99:>9.2f} {ratio:>10.3f}")
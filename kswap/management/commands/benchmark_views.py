@@ -0,0 +1,154 @@
+# Benchmark of the main pages at several amounts of data
+# For each number of properties in --sizes it fills the database with
+# made-up data (see seed() in kswap/management/seed.py), logs in as the
+# busy user and asks for each page many times.  For every page it records
+# the number of queries, the size of the page and the median and 95th
+# percentile time.  The made-up data is rolled back after each size.
+#
+# The results are added as one line of JSON to --output (by default
+# benchmark_results.jsonl next to manage.py, which git ignores), and compared
+# with the last results saved for the same page and size.  A page that now
+# makes more queries, or is more than --tolerance slower, is shown as a
+# regression, and with --fail-on-regression the command fails so a deploy
+# script or CI can stop
+# python manage.py benchmark_views --sizes 1000 10000 --label "before the change"
+# python manage.py benchmark_views --sizes 1000 10000 --fail-on-regression
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from kswap import search_cache
+from kswap.management.seed import rolled_back, seed, sizes_for
+from kswap.models import Booking, Property
+
+
+class Command(BaseCommand):
+    help = "Time each page and count its queries at several amounts of data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+        parser.add_argument("--repeats", type=int, default=20)
+        parser.add_argument("--output", default=os.path.join(settings.BASE_DIR, "benchmark_results.jsonl"))
+        parser.add_argument("--label", default="", help="a note saved with the results")
+        parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower is a regression")
+        parser.add_argument("--fail-on-regression", action="store_true")
+
+    def handle(self, *args, **options):
+        results = []
+        # the search cache would make every repeat after the first a hit, and
+        # the placeholder picture seed() saves goes in a folder that is thrown away
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root,
+            STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+            SEARCH_CACHE_TIMEOUT=0,
+        ):
+            for size in options["sizes"]:
+                with rolled_back():
+                    results += self.run(size, options["repeats"])
+
+        previous = self.last_run(options["output"])
+        regressions = self.report(results, previous, options["tolerance"])
+        run = {
+            "time": timezone.now().isoformat(),
+            "label": options["label"],
+            "database": connection.vendor,
+            "results": results,
+        }
+        with open(options["output"], "a") as file:
+            file.write(json.dumps(run) + "\n")
+        self.stdout.write(f"Saved to {options['output']}")
+        if regressions and options["fail_on_regression"]:
+            raise CommandError(f"{regressions} pages got slower or make more queries")
+
+    def run(self, size, repeats):
+        self.stdout.write(f"Making the data for {size} properties...")
+        busy = seed(sizes_for(size), random.Random(1), prefix=f"benchmark_views_{size}")
+        client = Client()
+        client.force_login(busy)
+
+        home = Property.objects.filter(owner=busy).order_by("id").first()
+        start = date.today() + timedelta(days=60)
+        dates = {"start_date": start.isoformat(), "end_date": (start + timedelta(days=7)).isoformat()}
+        pages = [
+            ("home", reverse("home"), {}),
+            ("property search", reverse("property_search"), {}),
+            ("property search, dates", reverse("property_search"), {"city": "London", **dates}),
+            ("property detail", reverse("property_detail", args=[home.id]), {}),
+            ("pending bookings", reverse("pending_bookings"), {}),
+            ("your next escapes", reverse("your_next_escapes"), {}),
+            ("leave review", reverse("leave_review"), {}),
+            ("user dashboard", reverse("user_dashboard"), {}),
+            ("api properties", reverse("api_properties"), {"include": "owner,images"}),
+        ]
+        self.stdout.write(f"  {Booking.objects.filter(user=busy).count()} bookings made by the busy user")
+        results = []
+        for name, url, params in pages:
+            search_cache.clear_local()
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url, params)
+            # read now, every request empties Django's list of queries
+            query_count = len(queries)
+            if response.status_code != 200:
+                raise CommandError(f"{name} answered {response.status_code}")
+            timings = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                client.get(url, params)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results.append(
+                {
+                    "page": name,
+                    "size": size,
+                    "queries": query_count,
+                    "bytes": len(response.content),
+                    "p50_ms": round(statistics.median(timings), 2),
+                    "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+                }
+            )
+        return results
+
+    # The most recent result for each page and size from the runs saved before
+    def last_run(self, path):
+        previous = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    if line.strip():
+                        for result in json.loads(line)["results"]:
+                            previous[(result["page"], result["size"])] = result
+        return previous
+
+    def report(self, results, previous, tolerance):
+        self.stdout.write(
+            f"{'page':24} {'size':>7} {'queries':>8} {'bytes':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}  compared with last run"
+        )
+        regressions = 0
+        for result in results:
+            before = previous.get((result["page"], result["size"]))
+            note = ""
+            if before:
+                change = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0
+                note = f"{change:+.0%}"
+                if result["queries"] > before["queries"]:
+                    note += f", queries {before['queries']} -> {result['queries']}"
+                if result["queries"] > before["queries"] or change > tolerance:
+                    note += "  REGRESSION"
+                    regressions += 1
+            self.stdout.write(
+                f"{result['page']:24} {result['size']:>7} {result['queries']:>8} {result['bytes']:>8}"
+                f" {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f}  {note}"
+            )
+        return regressions
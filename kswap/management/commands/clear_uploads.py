@@ -0,0 +1,25 @@
+# Management command to throw away pictures that were started but never
+# used in a property registration, along with their half sent files
+# run it with
+# python manage.py clear_uploads --hours 24
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from kswap import uploads
+from kswap.models import ImageUpload
+
+
+class Command(BaseCommand):
+    help = "Delete picture uploads older than --hours that were never attached to a property"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["hours"])
+        old = list(ImageUpload.objects.filter(started__lt=cutoff))
+        for upload in old:
+            uploads.discard(upload)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(old)} unused uploads"))
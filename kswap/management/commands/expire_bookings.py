@@ -0,0 +1,37 @@
+# Management command to decline swap requests that start in less than a day
+# and were never answered - see kswap/expiry.py
+# run it once, for example from cron, with
+# python manage.py expire_bookings
+# or keep it running and let it check every 5 minutes with
+# python manage.py expire_bookings --loop --interval 300
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from kswap import expiry
+
+
+class Command(BaseCommand):
+    help = "Decline stale pending bookings in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=expiry.BATCH_SIZE)
+        parser.add_argument("--loop", action="store_true", help="Keep running, once every --interval seconds")
+        parser.add_argument("--interval", type=int, default=300)
+
+    def handle(self, *args, **options):
+        while True:
+            # count the wait from the start of each run so the runs
+            # stay on a fixed interval however long they take
+            started = time.monotonic()
+            run = expiry.expire(batch_size=options["batch_size"])
+            self.stdout.write(
+                f"Declined {run.declined} stale bookings in {run.batches} batches,"
+                f" {run.retries} retries, {run.seconds:.2f} s"
+            )
+            if not options["loop"]:
+                break
+            # a long running process should not hold on to a broken connection
+            close_old_connections()
+            time.sleep(max(0, options["interval"] - (time.monotonic() - started)))
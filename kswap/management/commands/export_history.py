@@ -0,0 +1,35 @@
+# Management command to write every booking or review to a CSV or JSON
+# Lines file, the same as /api/v1/bookings/export - see kswap/exports.py
+# run it with
+# python manage.py export_history bookings --output bookings.csv
+# python manage.py export_history reviews --format jsonl --user sarah > reviews.jsonl
+# Without --user it writes every row
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from kswap import exports
+
+
+class Command(BaseCommand):
+    help = "Export bookings or reviews as CSV or JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(exports.KINDS))
+        parser.add_argument("--format", choices=sorted(exports.FORMATS), default="csv")
+        parser.add_argument("--output", help="the file to write, the screen if not given")
+        parser.add_argument("--user", help="only the rows this username can see")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError(f"There is no user called {options['user']}")
+        lines = exports.lines(options["kind"], options["format"], user)
+        if not options["output"]:
+            for block in exports.blocks(lines):
+                self.stdout.write(block.decode(), ending="")
+            return
+        with open(options["output"], "wb") as file:
+            for block in exports.blocks(lines):
+                file.write(block)
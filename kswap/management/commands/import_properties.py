@@ -0,0 +1,50 @@
+# Management command to load many homes from a CSV or JSON Lines file
+# - see kswap/property_import.py for the columns and how it works
+# run it with
+# python manage.py import_properties homes.csv --images-dir photos/
+# If it stops, run it again with the same file and it carries on where it
+# stopped.  To load the whole file again from the top add --restart
+# The rows that couldn't be imported are in homes.csv.errors.jsonl, which
+# can be fixed and imported in the same way
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kswap import property_import
+
+
+class Command(BaseCommand):
+    help = "Import properties and their pictures from a CSV or JSON Lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--images-dir", default="", help="where the pictures are, the file's folder by default")
+        parser.add_argument("--batch-size", type=int, default=property_import.BATCH_SIZE)
+        parser.add_argument("--workers", type=int, default=property_import.WORKERS, help="threads copying pictures")
+        parser.add_argument("--restart", action="store_true", help="start from the first row again")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        importer = property_import.Importer(
+            options["path"],
+            images_dir=options["images_dir"],
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            log=self.stdout.write,
+        )
+        try:
+            record = importer.run(restart=options["restart"])
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Could not read {options['path']}: {error}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {record.imported} properties and {record.images} pictures"
+                f" in {time.perf_counter() - started:.1f} s"
+            )
+        )
+        if record.images:
+            self.stdout.write("Run python manage.py process_images to make the smaller copies of the pictures")
+        if record.failed:
+            self.stdout.write(
+                self.style.WARNING(f"{record.failed} rows failed, see {property_import.errors_path(options['path'])}")
+            )
@@ -0,0 +1,76 @@
+# A small load test for a running copy of the site
+# It sends --requests requests to each page, --concurrency at a time, and
+# prints how many requests a second were answered and the median and 99th
+# percentile times, e.g. with the site started as in the Procfile
+#   gunicorn HouseSwap.wsgi -w 4
+# then, in another window,
+#   python manage.py loadtest --url http://127.0.0.1:8000 --user someone
+# With --user the pages are asked for as that user, using a session made
+# here in the database (so it must be the same database the server uses)
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = "Send lots of requests at once to a running server and time them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument("--paths", nargs="+", default=["/", "/user_dashboard/"])
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--user", help="username to log in as")
+
+    def handle(self, *args, **options):
+        headers = {}
+        if options["user"]:
+            headers["Cookie"] = f"{settings.SESSION_COOKIE_NAME}={self.make_session(options['user'])}"
+
+        self.stdout.write(f"{'page':20} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'errors':>7}")
+        for path in options["paths"]:
+            url = options["url"].rstrip("/") + path
+            # a few requests first so that every worker has connected to the database
+            self.run(url, headers, options["concurrency"], options["concurrency"])
+            started = time.perf_counter()
+            timings, errors = self.run(url, headers, options["concurrency"], options["requests"])
+            seconds = time.perf_counter() - started
+            timings.sort()
+            if not timings:
+                raise CommandError(f"Every request to {url} failed")
+            p50 = timings[len(timings) // 2]
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            rate = len(timings) / seconds
+            self.stdout.write(f"{path:20} {rate:>8.1f} {p50:>9.1f} {p99:>9.1f} {errors:>7}")
+
+    def make_session(self, username):
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            raise CommandError(f"There is no user called {username}")
+        session = import_string(f"{settings.SESSION_ENGINE}.SessionStore")()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session.session_key
+
+    def run(self, url, headers, concurrency, requests):
+        def fetch(_):
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+                    response.read()
+            except OSError:
+                return None
+            return (time.perf_counter() - started) * 1000
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(fetch, range(requests)))
+        timings = [result for result in results if result is not None]
+        return timings, len(results) - len(timings)
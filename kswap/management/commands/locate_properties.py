@@ -0,0 +1,45 @@
+# Management command to look up the coordinates of every property's town
+# for the "homes near" search.  Run it after loading the cities_light data
+# (python manage.py cities_light) or after a bulk load of properties
+# Each town is only looked up once however many homes are in it
+# run it with
+# python manage.py locate_properties
+# or, to look up the properties that already have coordinates again
+# python manage.py locate_properties --all
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from kswap import geo, search_cache
+from kswap.models import Property
+
+
+class Command(BaseCommand):
+    help = "Fill in the latitude, longitude and grid cell of properties from the cities_light towns"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Also redo properties that already have coordinates")
+
+    def handle(self, *args, **options):
+        properties = Property.objects.all()
+        if not options["all"]:
+            properties = properties.filter(geo_cell__isnull=True)
+        towns = properties.order_by().values_list("country", "city").distinct()
+
+        located = missing = 0
+        with transaction.atomic():
+            for country, city in towns:
+                point = geo.locate(city, country)
+                # update() doesn't send the post_save signals, so the filter
+                # counts and keyword index are left alone, which is right
+                # because neither of them uses the coordinates
+                in_town = properties.filter(country=country, city=city)
+                if point is None:
+                    missing += in_town.update(latitude=None, longitude=None, geo_cell=None)
+                else:
+                    located += in_town.update(latitude=point[0], longitude=point[1], geo_cell=geo.grid_cell(*point))
+            # but the cached "homes near" searches do, and nothing else tells them
+            search_cache.changed("property")
+
+        self.stdout.write(self.style.SUCCESS(f"Located {located} properties"))
+        if missing:
+            self.stdout.write(self.style.WARNING(f"{missing} properties are in towns that were not found"))
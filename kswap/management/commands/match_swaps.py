@@ -0,0 +1,17 @@
+# Management command to find all the swap matches again from the start
+# The matches are normally kept up to date when wishes are saved, so this
+# is only needed after wishes were changed without save() (like with
+# bulk_create or update()) or when the rules in matching.py change
+# run it with
+# python manage.py match_swaps
+from django.core.management.base import BaseCommand
+
+from kswap import matching
+
+
+class Command(BaseCommand):
+    help = "Delete all the swap matches and find them again"
+
+    def handle(self, *args, **options):
+        found = matching.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Found {found} swap matches"))
@@ -0,0 +1,34 @@
+# Management command to make the smaller copies of property pictures
+# Pictures uploaded before the copies existed, or whose copies weren't
+# finished because the server stopped, are done here several at a time
+# run it with
+# python manage.py process_images
+# or, to make the copies of every picture again
+# python manage.py process_images --all --workers 8
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from kswap import variants
+from kswap.models import Image
+
+
+class Command(BaseCommand):
+    help = "Make the resized WebP and JPEG copies of property pictures"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Also redo pictures that already have copies")
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, **options):
+        images = Image.objects.order_by("id")
+        if not options["all"]:
+            images = images.filter(processed=False)
+        image_ids = list(images.values_list("id", flat=True))
+
+        with ThreadPoolExecutor(max_workers=max(1, options["workers"])) as pool:
+            results = list(pool.map(lambda image_id: variants.process(Image, image_id), image_ids))
+
+        self.stdout.write(self.style.SUCCESS(f"Made the copies of {results.count(True)} pictures"))
+        if results.count(False):
+            self.stdout.write(self.style.WARNING(f"{results.count(False)} pictures could not be read, see the log"))
@@ -0,0 +1,25 @@
+# Management command to rebuild the OccupiedDay availability store
+# run it with
+# python manage.py rebuild_availability
+from django.core.management.base import BaseCommand
+
+from kswap import availability
+
+
+class Command(BaseCommand):
+    help = "Rebuild the OccupiedDay availability table from the Booking table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created, clashes = availability.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {created} occupied days"))
+        if clashes:
+            # these were booked over an older booking, which kept the days
+            self.stdout.write(
+                self.style.WARNING(
+                    f"{len(clashes)} active bookings clash with an older one and are missing days: "
+                    + ", ".join(str(booking_id) for booking_id in clashes)
+                )
+            )
@@ -0,0 +1,14 @@
+# Management command to rebuild the FacetBitmap counts used by the search page
+# run it with
+# python manage.py rebuild_facets
+from django.core.management.base import BaseCommand
+
+from kswap import facets
+
+
+class Command(BaseCommand):
+    help = "Rebuild the FacetBitmap filter counts from the Property table"
+
+    def handle(self, *args, **options):
+        bitmaps = facets.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {bitmaps} facet bitmaps"))
@@ -0,0 +1,17 @@
+# Management command to work out the ratings of every property and owner
+# again from the reviews.  They are normally kept up to date when reviews are
+# saved, so this is only needed after reviews were changed without save()
+# (like with bulk_create or update())
+# run it with
+# python manage.py rebuild_ratings
+from django.core.management.base import BaseCommand
+
+from kswap.models import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = "Work out the rating count, sum and mean of every property and profile from the reviews"
+
+    def handle(self, *args, **options):
+        properties, profiles = rebuild_ratings()
+        self.stdout.write(self.style.SUCCESS(f"Rated {properties} properties and {profiles} profiles"))
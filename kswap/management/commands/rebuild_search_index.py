@@ -0,0 +1,15 @@
+# Management command to rebuild the keyword search index from the Property table
+# run it with
+# python manage.py rebuild_search_index
+from django.core.management.base import BaseCommand
+
+from kswap import search
+from kswap.models import Property
+
+
+class Command(BaseCommand):
+    help = "Rebuild the keyword search index (FTS5 on SQLite, tsvector on Postgres)"
+
+    def handle(self, *args, **options):
+        count = search.rebuild(Property.objects.all())
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} properties"))
@@ -0,0 +1,27 @@
+# Management command to count the properties, users and kashrut authorities
+# shown on the home page again - see SiteCounter in kswap/models.py
+# The counters are kept up to date as rows are added and deleted, but
+# bulk_create() and update() skip that, so run this every so often
+# python manage.py refresh_site_stats
+# or use Postgres' estimates instead of counting every row with
+# python manage.py refresh_site_stats --estimated
+from django.core.management.base import BaseCommand
+
+from kswap.models import SiteCounter
+
+
+class Command(BaseCommand):
+    help = "Count the numbers on the home page again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--estimated",
+            action="store_true",
+            default=None,
+            help="Use the table sizes Postgres estimates (the default is SITE_STATS_ESTIMATED)",
+        )
+
+    def handle(self, *args, **options):
+        numbers = SiteCounter.refresh(estimated=options["estimated"])
+        for name, value in numbers.items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,43 @@
+# Management command to fill the database with made-up users, kashrut
+# authorities, properties, pictures, bookings and reviews, for trying the
+# site out with lots of data - see seed() in kswap/management/seed.py
+# The numbers go up with --properties, and each one can be set on its own
+# python manage.py seed_data --properties 10000
+# python manage.py seed_data --properties 10000 --bookings 100000 --prefix more
+# Everyone's password is "password", and the first user (seed_0) is the busy one
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from kswap.management.seed import seed, sizes_for
+
+
+class Command(BaseCommand):
+    help = "Fill the database with made-up data using bulk_create"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--properties", type=int, default=1000)
+        for name in ("users", "kashrut", "images", "bookings", "reviews"):
+            parser.add_argument(f"--{name}", type=int, help="default: worked out from --properties")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--prefix", default="seed", help="start of the usernames, so the command can run again")
+        parser.add_argument("--seed", type=int, default=1, help="random seed, the same seed gives the same data")
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+            raise CommandError(f"There are already users called {options['prefix']}_..., use another --prefix")
+        sizes = sizes_for(options["properties"])
+        for name in sizes:
+            if options.get(name) is not None:
+                sizes[name] = options[name]
+        with transaction.atomic():
+            busy = seed(
+                sizes,
+                random.Random(options["seed"]),
+                options["batch_size"],
+                options["prefix"],
+                log=lambda message: self.stdout.write(f"  {message}"),
+            )
+        self.stdout.write(self.style.SUCCESS(f"Done.  The busy user is {busy.username}"))
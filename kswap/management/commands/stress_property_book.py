@@ -0,0 +1,98 @@
+# Stress test for property_book
+# It fires lots of booking requests at the same time from different threads.
+# Every request for the same property asks for the same dates, so exactly one
+# of them should win for each property and the rest should be told the dates
+# are taken.  The users and properties it makes are deleted again at the end
+# run it with
+# python manage.py stress_property_book --requests 300 --properties 10
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from kswap.management.seed import make_property
+from kswap.models import ACTIVE_STATUSES, Booking, Property
+
+PREFIX = "stress_property_book_"
+
+
+class Command(BaseCommand):
+    help = "Send many simultaneous booking requests and check nothing is double booked"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=300)
+        parser.add_argument("--properties", type=int, default=10)
+        parser.add_argument("--threads", type=int, default=50)
+
+    def handle(self, *args, **options):
+        User.objects.filter(username__startswith=PREFIX).delete()
+        try:
+            # the error page after a clash renders base_generic.html which uses
+            # {% static %} and that needs collectstatic with the manifest storage
+            with override_settings(
+                STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+            ):
+                self.run(options)
+        finally:
+            User.objects.filter(username__startswith=PREFIX).delete()
+
+    def run(self, options):
+        owner = User.objects.create(username=PREFIX + "owner")
+        targets = Property.objects.bulk_create(
+            [make_property(owner, i, address=f"Target {i}") for i in range(options["properties"])]
+        )
+
+        # every request comes from a different user offering their own home
+        requests = []
+        for i in range(options["requests"]):
+            user = User.objects.create(username=f"{PREFIX}{i}")
+            home = make_property(user, i)
+            home.save()
+            requests.append((user, home, targets[i % len(targets)]))
+
+        date_from = date.today() + timedelta(days=30)
+        date_to = date_from + timedelta(days=7)
+
+        def send(request):
+            user, home, target = request
+            client = Client()
+            client.force_login(user)
+            try:
+                response = client.post(
+                    reverse("property_book", args=[target.pk]),
+                    {"date_from": date_from, "date_to": date_to, "my_property": home.pk},
+                )
+                return response.status_code
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+            codes = list(pool.map(send, requests))
+        elapsed = time.perf_counter() - started
+
+        accepted = codes.count(302)
+        refused = codes.count(200)
+        self.stdout.write(
+            f"{len(codes)} requests in {elapsed:.2f}s "
+            f"({len(codes) / elapsed:.0f}/s): {accepted} booked, {refused} refused, "
+            f"{len(codes) - accepted - refused} errors"
+        )
+
+        # check the Booking table itself, not just the occupancy rows
+        double_booked = []
+        for target in targets:
+            active = Booking.objects.filter(property=target, status__in=ACTIVE_STATUSES)
+            if active.count() > 1:
+                double_booked.append(target.address)
+        if double_booked:
+            raise CommandError(f"Double booked: {', '.join(double_booked)}")
+        if accepted != len(targets):
+            raise CommandError(f"Expected {len(targets)} bookings to succeed, got {accepted}")
+        self.stdout.write(self.style.SUCCESS("No property was double booked"))
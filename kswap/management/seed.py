@@ -0,0 +1,190 @@
+# Helpers shared by the benchmark and stress test management commands
+# They make made-up users and properties so the commands can measure the
+# views with lots of data, without anyone having to type it in
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image as PillowImage
+
+from kswap import availability, facets, search
+from kswap.models import Booking, Image, Kashrut, Profile, Property, Review, SiteCounter, rebuild_ratings
+
+COUNTRIES = ["GB", "IL", "US", "FR", "BE", "CA"]
+CITIES = ["London", "Manchester", "Jerusalem", "Bnei Brak", "New York", "Paris", "Antwerp", "Toronto"]
+PROPERTY_TYPES = ["house", "flat", "cottage", "villa"]
+
+
+# A property with random but sensible values for all the required fields
+def make_property(owner, number, rng=None, **fields):
+    rng = rng or random
+    values = dict(
+        country=rng.choice(COUNTRIES),
+        city=rng.choice(CITIES),
+        postcode=f"N{rng.randint(1, 20)}",
+        address=f"{number} Example Road",
+        no_of_rooms=rng.randint(1, 8),
+        estimated_value=rng.randint(100, 2000) * 1000,
+        property_type=rng.choice(PROPERTY_TYPES),
+        pet_friendly=rng.random() < 0.3,
+        proximity_to_public_transport=rng.randint(1, 30),
+        succah=rng.random() < 0.5,
+        passover_kitchen=rng.random() < 0.2,
+        max_occupancy=rng.randint(1, 12),
+        smoking_allowed=rng.random() < 0.1,
+        home_description="A lovely home close to the shul and the shops",
+        owner=owner,
+    )
+    values.update(fields)
+    return Property(**values)
+
+
+class Rollback(Exception):
+    pass
+
+
+# Everything done inside this block is thrown away at the end, so a
+# benchmark can fill the database with test data and leave it as it was
+@contextmanager
+def rolled_back():
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+# Runs fn a few times and returns the median time in milliseconds
+def time_ms(fn, repeats=5):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+# How much of everything seed() makes for a number of properties, so that
+# the other tables grow in step: about two homes per user, two pictures
+# per home and three bookings per home
+def sizes_for(properties):
+    return {
+        "users": max(2, properties // 2),
+        "kashrut": 20,
+        "properties": properties,
+        "images": properties * 2,
+        "bookings": properties * 3,
+        "reviews": properties,
+    }
+
+
+# The one picture every made-up Image row points at, made the first time
+PLACEHOLDER_IMAGE = "images/seed_placeholder.jpg"
+
+
+def placeholder_image():
+    if not default_storage.exists(PLACEHOLDER_IMAGE):
+        data = BytesIO()
+        PillowImage.new("RGB", (800, 600), (200, 180, 150)).save(data, "JPEG")
+        default_storage.save(PLACEHOLDER_IMAGE, ContentFile(data.getvalue()))
+    return PLACEHOLDER_IMAGE
+
+
+# Fills the database with made-up data using bulk_create, batch_size rows
+# at a time, and returns the first user.  That user owns more homes and is
+# in far more bookings than anyone else, so the pages of a busy user can be
+# measured.  Everyone's password is "password".
+# bulk_create() skips the signals in models.py, so the tables they keep up
+# to date (filters, keyword search, free days, ratings, home page numbers)
+# are built again at the end.  The homes aren't given a latitude and
+# longitude, run the locate_properties command for that
+def seed(sizes, rng=None, batch_size=1000, prefix="seed", log=None):
+    rng = rng or random.Random(1)
+    log = log or (lambda message: None)
+
+    def save(model, rows, label):
+        model.objects.bulk_create(rows, batch_size=batch_size)
+        log(f"{len(rows)} {label}")
+
+    kashrut = [Kashrut(name=f"{prefix} kashrut {i}") for i in range(sizes["kashrut"])]
+    save(Kashrut, kashrut, "kashrut authorities")
+    kashrut = list(Kashrut.objects.filter(name__startswith=f"{prefix} kashrut "))
+
+    # hashing a password is slow on purpose, so it is only done once
+    password = make_password("password")
+    save(User, [User(username=f"{prefix}_{i}", password=password) for i in range(sizes["users"])], "users")
+    users = list(User.objects.filter(username__startswith=f"{prefix}_").order_by("id"))
+    busy = users[0]
+    profiles = [
+        Profile(user=user, telno_mobile="07700 900000", rabbi="Rabbi Cohen", kashrut=rng.choice(kashrut))
+        for user in users
+    ]
+    save(Profile, profiles, "profiles")
+
+    first_home = Property.objects.order_by("-id").values_list("id", flat=True).first() or 0
+    homes = [make_property(busy if i < 5 else rng.choice(users), i, rng) for i in range(sizes["properties"])]
+    save(Property, homes, "properties")
+    homes = list(Property.objects.filter(id__gt=first_home).order_by("id").values_list("id", "owner_id"))
+    busy_homes = [home for home in homes if home[1] == busy.id]
+
+    name = placeholder_image()
+    save(Image, [Image(property_id=rng.choice(homes)[0], image=name) for _ in range(sizes["images"])], "pictures")
+
+    # bookings from a year ago to a year from now, with one in twenty
+    # going to or from the busy user's homes
+    today = date.today()
+    bookings = []
+    for _ in range(sizes["bookings"]):
+        (home, owner_id), (my_home, user_id) = rng.sample(homes, 2)
+        if rng.random() < 0.05:
+            if rng.random() < 0.5:
+                home, owner_id = rng.choice(busy_homes)
+            else:
+                my_home, user_id = rng.choice(busy_homes)
+        if owner_id == user_id:
+            continue
+        date_from = today + timedelta(days=rng.randint(-365, 365))
+        bookings.append(
+            Booking(
+                user_id=user_id,
+                property_id=home,
+                my_property_id=my_home,
+                date_from=date_from,
+                date_to=date_from + timedelta(days=rng.randint(2, 14)),
+                status=rng.choices(["accepted", "pending", "declined"], [6, 2, 2])[0],
+            )
+        )
+    save(Booking, bookings, "bookings")
+
+    # reviews of some of the swaps that are over, by the guest
+    finished = Booking.objects.filter(property_id__gt=first_home, status="accepted", date_to__lt=today).values_list(
+        "id", "user_id", "property_id"
+    )
+    reviews = [
+        Review(
+            booking_id=booking_id,
+            reviewer_id=user_id,
+            property_reviewed_id=property_id,
+            text="Lovely stay",
+            stars=rng.randint(1, 5),
+        )
+        for booking_id, user_id, property_id in finished[: sizes["reviews"]]
+    ]
+    save(Review, reviews, "reviews")
+
+    log("building the filters, keyword search, free days, ratings and home page numbers")
+    facets.rebuild()
+    search.rebuild(Property.objects.all())
+    availability.rebuild()
+    rebuild_ratings()
+    SiteCounter.refresh()
+    return busy
@@ -0,0 +1,209 @@
+# Finding homes that can be swapped with each other
+# A SwapWish says "I would swap this home of mine for a home in this town
+# (or anywhere in this country) some time between these dates".  Wish A
+# "wants" wish B when B's home is where A would like to go and their dates
+# overlap.  Following the wants from wish to wish gives a graph, and a swap
+# is a ring in that graph that comes back to where it started:
+#   - A wants B and B wants A is a normal swap between two homes
+#   - A wants B, B wants C and C wants A is a 3 way swap where everybody
+#     goes to the next home round the ring, and the same for 4 homes
+# Every home in the ring must be free on the same days, so the dates of all
+# the wishes must overlap.
+#
+# Comparing every wish with every other one would get slower and slower as
+# people join, so matching is done one wish at a time, when it is added or
+# changed (see the receivers in models.py), and only looks at the wishes
+# that could possibly be in a ring with it:
+#   - the wishes whose home is where it wants to go, found with the
+#     (home_country, home_city, date_from) index
+#   - the wishes that want to go where its home is, found with the
+#     (country, city, date_from) index
+# both only for dates that overlap with the new wish.  A ring of 4 also
+# needs one wish in the middle, which is found with one more query that
+# asks for a home where the first group wants to go AND a wish to go where
+# the second group lives.  The rings found are saved in the SwapMatch table
+from collections import defaultdict
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Q
+
+from .models import SwapMatch, SwapWish
+
+# The most wishes read for each step, so that a very popular town can't make
+# matching one wish take too long.  The ones that start soonest are used
+MAX_CANDIDATES = 500
+# The most rings saved for one wish.  The smaller rings are found first
+MAX_MATCHES = 100
+
+FIELDS = ("id", "owner_id", "home_country", "home_city", "country", "city", "date_from", "date_to")
+
+
+def overlapping(date_from, date_to):
+    return Q(date_from__lte=date_to, date_to__gte=date_from)
+
+
+def read(wishes):
+    return list(wishes.order_by("date_from", "id").values_list(*FIELDS, named=True)[:MAX_CANDIDATES])
+
+
+# True when wish would like to go to the home of other
+def wants(wish, other):
+    return wish.country == other.home_country and wish.city in ("", other.home_city)
+
+
+# The days that all the wishes in a ring have in common, or None
+def shared_dates(ring):
+    date_from = max(wish.date_from for wish in ring)
+    date_to = min(wish.date_to for wish in ring)
+    if date_from > date_to:
+        return None
+    return date_from, date_to
+
+
+# The same ring can be written starting from any of its wishes, so it is
+# always written starting from the smallest id to store it only once
+def ring_key(ring):
+    ids = [wish.id for wish in ring]
+    start = ids.index(min(ids))
+    return ",".join(str(wish_id) for wish_id in ids[start:] + ids[:start])
+
+
+# Returns the rings of 2, 3 and 4 wishes that wish is in, each as a list of
+# wishes starting with wish.  With only_later=True the other wishes must
+# have bigger ids, so that when every wish is matched in turn (by the
+# match_swaps command) each ring is only found once, from its first wish
+def find_rings(wish, only_later=False):
+    others = SwapWish.objects.filter(overlapping(wish.date_from, wish.date_to)).exclude(owner_id=wish.owner_id)
+    if only_later:
+        others = others.filter(id__gt=wish.id)
+
+    # the homes wish wants to go to...
+    goes_to = others.filter(home_country=wish.country)
+    if wish.city:
+        goes_to = goes_to.filter(home_city=wish.city)
+    goes_to = read(goes_to)
+    # ...and the wishes that want to come to its home
+    comes_from = read(others.filter(country=wish.home_country, city__in=["", wish.home_city]))
+    if not goes_to or not comes_from:
+        return []
+
+    rings = []
+
+    def add(ring):
+        owners = {member.owner_id for member in ring}
+        if len(owners) == len(ring) and shared_dates(ring):
+            rings.append(ring)
+        return len(rings) >= MAX_MATCHES
+
+    # the wishes that come to wish's home, by the town they are in
+    by_home = defaultdict(list)
+    for other in comes_from:
+        by_home[(other.home_country, other.home_city)].append(other)
+        by_home[(other.home_country, "")].append(other)
+
+    # 2: wish -> other -> wish
+    coming = {other.id for other in comes_from}
+    for other in goes_to:
+        if other.id in coming and add([wish, other]):
+            return rings
+
+    # 3: wish -> second -> third -> wish
+    for second in goes_to:
+        for third in by_home[(second.country, second.city)]:
+            if third.id != second.id and add([wish, second, third]):
+                return rings
+
+    # 4: wish -> second -> middle -> fourth -> wish
+    # the middle wish has its home where one of goes_to wants to go
+    # and wants to go to the home of one of comes_from
+    # the query asks for homes in the right countries and towns, and for
+    # wishes to go to the right countries, and the places are matched up
+    # exactly in the loop.  Lots of (country AND city) ORs make a slow query
+    wanted_places = {(other.country, other.city) for other in goes_to}
+    home_places = {(other.home_country, other.home_city) for other in comes_from}
+    anywhere_in = {country for country, city in wanted_places if not city}
+    in_wanted_place = Q(
+        home_country__in={country for country, city in wanted_places},
+        home_city__in={city for country, city in wanted_places if city},
+    )
+    if anywhere_in:
+        in_wanted_place |= Q(home_country__in=anywhere_in)
+    middles = read(others.filter(in_wanted_place, country__in={country for country, city in home_places}))
+
+    by_wanted_place = defaultdict(list)
+    for other in goes_to:
+        by_wanted_place[(other.country, other.city)].append(other)
+    for middle in middles:
+        seconds = by_wanted_place[(middle.home_country, middle.home_city)] + by_wanted_place[(middle.home_country, "")]
+        for second in seconds:
+            for fourth in by_home[(middle.country, middle.city)]:
+                if len({second.id, middle.id, fourth.id}) == 3 and add([wish, second, middle, fourth]):
+                    return rings
+    return rings
+
+
+# Works out the matches of one wish again.  Called when a wish is saved
+# and when the home of a wish moves town
+def match_wish(wish_id):
+    wish = SwapWish.objects.filter(id=wish_id).values_list(*FIELDS, named=True).first()
+    if wish is None:
+        return []
+    rings = find_rings(wish)
+    with transaction.atomic():
+        # the old matches may not fit any more, the ones that still do are
+        # found again below
+        SwapMatch.objects.filter(wishes=wish_id).delete()
+        return save_rings(rings)
+
+
+# Works out the matches again for the wishes of some homes.  Used for homes
+# saved with bulk_create, which doesn't send the post_save that
+# rematch_moved_home in models.py listens for
+def match_homes(property_ids):
+    for wish_id in SwapWish.objects.filter(home_id__in=property_ids).values_list("id", flat=True):
+        match_wish(wish_id)
+
+
+# The keys of the rings that have been saved already
+def existing_keys(keys):
+    return set(SwapMatch.objects.filter(key__in=keys).values_list("key", flat=True))
+
+
+# Saves the rings that aren't saved yet and returns their new SwapMatches.
+# Two wishes saved at the same time can find the same ring, and both see
+# it isn't saved yet, so the rows that are already there are skipped with
+# ignore_conflicts instead of failing on the unique key
+def save_rings(rings):
+    by_key = {}
+    for ring in rings:
+        by_key.setdefault(ring_key(ring), ring)
+    existing = existing_keys(by_key)
+    matches = []
+    for key, ring in by_key.items():
+        if key not in existing:
+            date_from, date_to = shared_dates(ring)
+            matches.append(SwapMatch(key=key, size=len(ring), date_from=date_from, date_to=date_to))
+    if not matches:
+        return []
+    SwapMatch.objects.bulk_create(matches, ignore_conflicts=True)
+    # bulk_create doesn't set the ids on every database, or with
+    # ignore_conflicts, so read them back
+    ids = dict(SwapMatch.objects.filter(key__in=[match.key for match in matches]).values_list("key", "id"))
+    members = [
+        SwapMatch.wishes.through(swapmatch_id=ids[match.key], swapwish_id=int(wish_id))
+        for match in matches
+        for wish_id in match.key.split(",")
+    ]
+    SwapMatch.wishes.through.objects.bulk_create(members, ignore_conflicts=True)
+    return matches
+
+
+# Throws the matches away and finds them all again, a wish at a time
+def rebuild(wishes=None):
+    SwapMatch.objects.all().delete()
+    wishes = wishes if wishes is not None else SwapWish.objects.filter(date_to__gte=date.today())
+    found = 0
+    for wish in wishes.order_by("id").values_list(*FIELDS, named=True).iterator(chunk_size=500):
+        found += len(save_rings(find_rings(wish, only_later=True)))
+    return found
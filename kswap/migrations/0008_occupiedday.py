@@ -0,0 +1,71 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import timedelta
+
+
+# fill the new table from the bookings that already exist
+def fill_occupied_days(apps, schema_editor):
+    Booking = apps.get_model("kswap", "Booking")
+    OccupiedDay = apps.get_model("kswap", "OccupiedDay")
+    rows = []
+    active = Booking.objects.filter(status__in=("pending", "accepted"))
+    for booking in active.iterator():
+        day = booking.date_from
+        while day <= booking.date_to:
+            for property_id in {booking.property_id, booking.my_property_id}:
+                rows.append(
+                    OccupiedDay(property_id=property_id, booking_id=booking.id, day=day)
+                )
+            day += timedelta(days=1)
+    OccupiedDay.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0007_remove_booking_review_stars_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OccupiedDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                (
+                    "booking",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="occupied_days",
+                        to="kswap.booking",
+                    ),
+                ),
+                (
+                    "property",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="occupied_days",
+                        to="kswap.property",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["day", "property"], name="kswap_occday_day_prop_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill_occupied_days, migrations.RunPython.noop),
+    ]
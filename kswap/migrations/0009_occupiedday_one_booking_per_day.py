@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:52
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+# Before the constraint existed two active bookings could overlap on the
+# same home.  Keep the days of the earliest booking and drop the others
+# so that the constraint can be added
+def remove_double_bookings(apps, schema_editor):
+    OccupiedDay = apps.get_model("kswap", "OccupiedDay")
+    clashes = (
+        OccupiedDay.objects.values("property_id", "day")
+        .annotate(n=Count("id"), first_booking=Min("booking_id"))
+        .filter(n__gt=1)
+    )
+    for clash in list(clashes):
+        OccupiedDay.objects.filter(
+            property_id=clash["property_id"], day=clash["day"]
+        ).exclude(booking_id=clash["first_booking"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0008_occupiedday"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_double_bookings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="occupiedday",
+            constraint=models.UniqueConstraint(
+                fields=("property", "day"), name="kswap_occday_one_booking_per_day"
+            ),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 4.2.5 on 2026-10-18 14:59
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+FIELDS = [
+    "country",
+    "city",
+    "no_of_rooms",
+    "max_occupancy",
+    "property_type",
+    "owner__profile__kashrut",
+    "succah",
+    "passover_kitchen",
+    "pet_friendly",
+    "smoking_allowed",
+]
+
+
+def as_text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return "" if value is None else str(value)
+
+
+# build the bitmaps for the properties that already exist
+def fill_facet_bitmaps(apps, schema_editor):
+    Property = apps.get_model("kswap", "Property")
+    FacetBitmap = apps.get_model("kswap", "FacetBitmap")
+    bitmaps = defaultdict(int)
+    for row in Property.objects.values_list("id", *FIELDS).iterator():
+        for field, value in zip(FIELDS, row[1:]):
+            facet = "kashrut" if field == "owner__profile__kashrut" else field
+            bitmaps[(facet, as_text(value))] |= 1 << row[0]
+    FacetBitmap.objects.bulk_create(
+        [
+            FacetBitmap(
+                facet=facet,
+                value=value,
+                bits=bits.to_bytes((bits.bit_length() + 7) // 8, "little"),
+            )
+            for (facet, value), bits in bitmaps.items()
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0009_occupiedday_one_booking_per_day"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FacetBitmap",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("facet", models.CharField(max_length=30)),
+                ("value", models.CharField(max_length=50)),
+                ("bits", models.BinaryField(default=b"")),
+                ("version", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="property",
+            index=models.Index(
+                fields=["country", "city", "no_of_rooms"],
+                name="kswap_prop_country_city_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="property",
+            index=models.Index(
+                fields=["property_type", "max_occupancy"],
+                name="kswap_prop_type_occ_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="facetbitmap",
+            constraint=models.UniqueConstraint(
+                fields=("facet", "value"), name="kswap_facet_bitmap_unique"
+            ),
+        ),
+        migrations.RunPython(fill_facet_bitmaps, migrations.RunPython.noop),
+    ]
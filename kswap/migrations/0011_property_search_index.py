@@ -0,0 +1,60 @@
+# The keyword search index used by kswap/search.py
+# Django models can't describe an FTS5 table or a tsvector column on both
+# databases, so the tables are made with SQL for whichever database is in use
+
+from django.db import migrations
+
+SQLITE_CREATE = """
+CREATE VIRTUAL TABLE kswap_property_fts
+USING fts5(city, address, home_description, tokenize = 'porter unicode61')
+"""
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE kswap_property_search (
+        property_id bigint PRIMARY KEY
+            REFERENCES kswap_property (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX kswap_property_search_gin ON kswap_property_search USING GIN (document)",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(SQLITE_CREATE)
+        schema_editor.execute(
+            "INSERT INTO kswap_property_fts (rowid, city, address, home_description) "
+            "SELECT id, city, address, home_description FROM kswap_property"
+        )
+    elif vendor == "postgresql":
+        for statement in POSTGRES_CREATE:
+            schema_editor.execute(statement)
+        schema_editor.execute(
+            "INSERT INTO kswap_property_search (property_id, document) "
+            "SELECT id, setweight(to_tsvector('english', city), 'A') "
+            "|| setweight(to_tsvector('english', address), 'B') "
+            "|| setweight(to_tsvector('english', home_description), 'C') "
+            "FROM kswap_property"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE kswap_property_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE kswap_property_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0010_facetbitmap"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
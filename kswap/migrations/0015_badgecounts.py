@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("kswap", "0014_imageupload"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BadgeCounts",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="badge_counts",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("pending_requests", models.IntegerField(default=0)),
+                ("next_escapes", models.IntegerField(default=0)),
+            ],
+        ),
+    ]
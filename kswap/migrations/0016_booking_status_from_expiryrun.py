@@ -0,0 +1,41 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0015_badgecounts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ExpiryRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("started", models.DateTimeField()),
+                ("seconds", models.FloatField(default=0)),
+                ("declined", models.PositiveIntegerField(default=0)),
+                ("batches", models.PositiveIntegerField(default=0)),
+                ("retries", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "ordering": ["-started"],
+            },
+        ),
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["status", "date_from"], name="kswap_booking_status_from_idx"
+            ),
+        ),
+    ]
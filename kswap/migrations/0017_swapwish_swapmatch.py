@@ -0,0 +1,92 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django_countries.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("kswap", "0016_booking_status_from_expiryrun"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SwapWish",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "home_country",
+                    django_countries.fields.CountryField(editable=False, max_length=2),
+                ),
+                ("home_city", models.CharField(editable=False, max_length=20)),
+                ("country", django_countries.fields.CountryField(max_length=2)),
+                ("city", models.CharField(blank=True, max_length=20)),
+                ("date_from", models.DateField()),
+                ("date_to", models.DateField()),
+                (
+                    "home",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="swap_wishes",
+                        to="kswap.property",
+                    ),
+                ),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="swap_wishes",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SwapMatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=100, unique=True)),
+                ("size", models.PositiveSmallIntegerField()),
+                ("date_from", models.DateField()),
+                ("date_to", models.DateField()),
+                (
+                    "wishes",
+                    models.ManyToManyField(related_name="matches", to="kswap.swapwish"),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="swapwish",
+            index=models.Index(
+                fields=["home_country", "home_city", "date_from", "date_to"],
+                name="kswap_wish_home_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="swapwish",
+            index=models.Index(
+                fields=["country", "city", "date_from", "date_to"],
+                name="kswap_wish_wanted_idx",
+            ),
+        ),
+    ]
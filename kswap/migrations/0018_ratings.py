@@ -0,0 +1,83 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:31
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# work out the ratings from the reviews that already exist
+def fill_ratings(apps, schema_editor):
+    Property = apps.get_model("kswap", "Property")
+    Profile = apps.get_model("kswap", "Profile")
+    Review = apps.get_model("kswap", "Review")
+
+    def rated(reviews, group_by):
+        reviews = reviews.filter(stars__isnull=False).order_by().values(group_by)
+        return {
+            "rating_count": Coalesce(
+                models.Subquery(reviews.annotate(n=models.Count("id")).values("n")), 0
+            ),
+            "rating_sum": Coalesce(
+                models.Subquery(reviews.annotate(n=models.Sum("stars")).values("n")), 0
+            ),
+            "rating": models.Subquery(
+                reviews.annotate(n=models.Avg("stars")).values("n")
+            ),
+        }
+
+    Property.objects.update(
+        **rated(
+            Review.objects.filter(property_reviewed=models.OuterRef("pk")),
+            "property_reviewed",
+        )
+    )
+    Profile.objects.update(
+        **rated(
+            Review.objects.filter(property_reviewed__owner=models.OuterRef("user_id")),
+            "property_reviewed__owner",
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0017_swapwish_swapmatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="rating",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="rating_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="profile",
+            name="rating_sum",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="property",
+            name="rating",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="property",
+            name="rating_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="property",
+            name="rating_sum",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="property",
+            index=models.Index(fields=["rating", "id"], name="kswap_prop_rating_idx"),
+        ),
+        migrations.RunPython(fill_ratings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0018_ratings"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="review",
+            index=models.Index(
+                fields=["booking", "reviewer"], name="kswap_review_booking_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0019_review_booking_reviewer"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="booking",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="property",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="review",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
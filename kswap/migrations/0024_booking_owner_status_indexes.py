@@ -0,0 +1,27 @@
+# Generated by Django 4.2.5 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0023_request_profile"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["property", "status", "date_from"],
+                name="kswap_booking_prop_status_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="booking",
+            index=models.Index(
+                fields=["my_property", "status", "date_from"],
+                name="kswap_booking_mine_status_idx",
+            ),
+        ),
+    ]
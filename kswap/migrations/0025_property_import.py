@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0024_booking_owner_status_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PropertyImport",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("source", models.CharField(max_length=500, unique=True)),
+                ("started", models.DateTimeField()),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+                ("rows", models.PositiveIntegerField(default=0)),
+                ("imported", models.PositiveIntegerField(default=0)),
+                ("failed", models.PositiveIntegerField(default=0)),
+                ("images", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "ordering": ["-started"],
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.5 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+CHUNK_BITS = 65536
+
+
+# split the bitmaps that already exist into their chunks and count their bits
+def split_facet_bitmaps(apps, schema_editor):
+    FacetBitmap = apps.get_model("kswap", "FacetBitmap")
+    rows = []
+    for bitmap in FacetBitmap.objects.iterator():
+        bits = int.from_bytes(bitmap.bits, "little")
+        chunk = 0
+        while bits:
+            part = bits & ((1 << CHUNK_BITS) - 1)
+            if part:
+                rows.append(
+                    FacetBitmap(
+                        facet=bitmap.facet,
+                        value=bitmap.value,
+                        chunk=chunk,
+                        bits=part.to_bytes((part.bit_length() + 7) // 8, "little"),
+                        count=part.bit_count(),
+                        version=bitmap.version,
+                    )
+                )
+            bits >>= CHUNK_BITS
+            chunk += 1
+    FacetBitmap.objects.all().delete()
+    FacetBitmap.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("kswap", "0025_property_import"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="facetbitmap",
+            name="kswap_facet_bitmap_unique",
+        ),
+        migrations.AddField(
+            model_name="facetbitmap",
+            name="chunk",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="facetbitmap",
+            name="count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(split_facet_bitmaps, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="facetbitmap",
+            index=models.Index(
+                fields=["facet", "value", "count"], name="kswap_facet_value_count_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="facetbitmap",
+            constraint=models.UniqueConstraint(
+                fields=("facet", "value", "chunk"), name="kswap_facet_bitmap_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kswap', '0026_facet_bitmap_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='badgecounts',
+            name='counted_on',
+            field=models.DateField(null=True),
+        ),
+    ]
@@ -4,12 +4,12 @@
 # Property
 
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 
 # The following two imports are used in the code below to make sure that
 # any time a User is created an entry is also created in the Profile table
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
 # Used to generate URLs by reversing the URL patterns
@@ -17,9 +17,21 @@ from django.urls import reverse
 
 # uuid is a library that can generate random 128 bit objects for unqiue ids
 import uuid
+import os
+
+from django.conf import settings
+from django.utils import timezone
+
+from datetime import timedelta
 
 from django_countries.fields import CountryField
 
+from django.db.models.functions import Cast, Coalesce
+
+# the keyword search index for properties, the "homes near" search, the
+# search results cache and the smaller copies of the pictures
+from . import geo, search, search_cache, variants
+
 
 # Kashrut model contains list of kashrut authorities
 # maintained by admin
@@ -95,6 +107,14 @@ class Profile(models.Model):
     # user rating will need to be displayed by finding the mean of user reviews
     # from the reviews table
     # UserRating = models.FloatField(null=True, blank=True)
+    # Working out the mean every time a page shows it would mean reading
+    # all the reviews, so the number of stars and how many reviews gave them
+    # are kept here and changed whenever a review of one of the user's homes
+    # is added, changed or deleted (see the Review receivers below).  rating
+    # is the mean, and stays empty until there is a review with stars
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating = models.FloatField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.telno_mobile
@@ -154,8 +174,18 @@ class Property(models.Model):
     smoking_allowed = models.BooleanField()
     home_description = models.TextField()
 
+    # where the town is, looked up in the cities_light tables when the
+    # property is saved - see geo.py.  They stay empty if the town isn't found
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+    geo_cell = models.BigIntegerField(null=True, blank=True, editable=False)
+
     # property rating will need to come from an average of the reviews
     # property_rating = models.FloatField(null=True, blank=True)
+    # it is kept up to date in the same way as the rating on Profile
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating = models.FloatField(null=True, blank=True, editable=False)
 
     # the line below only allows one image per property
     # I change the models to have an image class - see below
@@ -164,6 +194,25 @@ class Property(models.Model):
     # Assuming each property is tied to a one user
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    # goes up by one every time the property, its rating or its pictures
+    # change.  The JSON API (api.py) uses it for the ETag
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # when the version last went up.  The property page uses the two of them
+    # to tell a browser that its copy hasn't changed (see PropertyDetailView)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # the search page filters on these columns most often
+        indexes = [
+            models.Index(fields=["country", "city", "no_of_rooms"], name="kswap_prop_country_city_idx"),
+            models.Index(fields=["property_type", "max_occupancy"], name="kswap_prop_type_occ_idx"),
+            # the "homes near" search reads the cells in ranges and then only needs
+            # the coordinates, which are in the index too so the table isn't read
+            models.Index(fields=["geo_cell", "latitude", "longitude"], name="kswap_prop_geo_cell_idx"),
+            # the search can show the best rated homes first
+            models.Index(fields=["rating", "id"], name="kswap_prop_rating_idx"),
+        ]
+
     def get_absolute_url(self):
         """Returns the url to access a detailed record for a property"""
         return reverse('property_detail', args=[str(self.id)])
@@ -175,6 +224,216 @@ class Property(models.Model):
         return self.address
 
 
+# The fields that can be chosen from drop downs on the search page
+# kashrut is not on Property, it comes from the owner's Profile
+FACET_FIELDS = ("country", "city", "no_of_rooms", "max_occupancy", "property_type",
+                "kashrut", "succah", "passover_kitchen", "pet_friendly", "smoking_allowed")
+
+
+# The values are stored as text, in the same way as they arrive in request.GET
+def facet_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if value is None:
+        return ""
+    return str(value)
+
+
+# FacetBitmap stores the counts shown next to each filter on the search page
+# There is one row for each value of each filter, for example
+# (country, GB) or (succah, true).  bits is a bitmap with bit number N set
+# when the property with id N has that value.  To count the homes for any
+# combination of filters the search ANDs the bitmaps together and counts the
+# bits, so the counts for every drop down come from one query on this table
+# instead of one COUNT on the Property table per choice.
+# A bitmap is split into rows of FACET_CHUNK_BITS ids each (chunk 0 holds ids
+# 0 to 65535, chunk 1 the next 65536...) so a row is never more than 8 KB,
+# and saving a new home only rewrites the small rows of its own chunk
+# instead of the whole bitmap of its country.  count is the number of bits
+# set in the row, so the cities with the most homes can be found without
+# reading the bitmaps.
+# The bitmaps are kept up to date by the signals below
+FACET_CHUNK_BITS = 65536
+
+
+class FacetBitmap(models.Model):
+    facet = models.CharField(max_length=30)
+    value = models.CharField(max_length=50)
+    chunk = models.PositiveIntegerField(default=0)
+    bits = models.BinaryField(default=b"")
+    count = models.PositiveIntegerField(default=0)
+    # goes up by one every time the bitmap changes
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["facet", "value", "chunk"], name="kswap_facet_bitmap_unique"),
+        ]
+        # the numbers of homes of each city are added up from this index
+        # alone, without reading the rows with their bitmaps
+        indexes = [
+            models.Index(fields=["facet", "value", "count"], name="kswap_facet_value_count_idx"),
+        ]
+
+    # The bits of this row, moved up to the ids they stand for
+    def as_int(self):
+        return int.from_bytes(self.bits, "little") << (self.chunk * FACET_CHUNK_BITS)
+
+    # Keeps the part of a bitmap of any ids that belongs in this row
+    def set_int(self, number):
+        number = number >> (self.chunk * FACET_CHUNK_BITS) & ((1 << FACET_CHUNK_BITS) - 1)
+        self.bits = number.to_bytes((number.bit_length() + 7) // 8, "little")
+        self.count = number.bit_count()
+
+    # The facet values of a property, apart from kashrut which is on the Profile
+    # Fields that were deferred with only() or defer() are left out, because
+    # reading them would cost a query each and save() won't change them anyway
+    @staticmethod
+    def values_for(property):
+        loaded = property.__dict__
+        return {field: facet_value(loaded[field]) for field in FACET_FIELDS if field in loaded}
+
+    # Moves the bits of some properties from their old values to their new ones
+    # old_values and new_values are {facet: value} and can be empty, for a
+    # property that has just been created or is being deleted
+    @classmethod
+    def move(cls, property_ids, old_values, new_values):
+        changes = {}
+        for facet in FACET_FIELDS:
+            old, new = old_values.get(facet), new_values.get(facet)
+            if old == new:
+                continue
+            if old is not None:
+                changes[(facet, old)] = False
+            if new is not None:
+                changes[(facet, new)] = True
+        if not changes or not property_ids:
+            return
+
+        # one mask for each chunk the properties are in
+        masks = {}
+        for property_id in property_ids:
+            chunk = property_id // FACET_CHUNK_BITS
+            masks[chunk] = masks.get(chunk, 0) | 1 << property_id
+
+        with transaction.atomic():
+            # bump the version first.  The UPDATE locks the row on Postgres and
+            # takes the write lock on SQLite before the bits are read, so two
+            # saves at the same time cannot lose each other's changes.
+            # Going through the rows in sorted order stops two saves deadlocking
+            rows = sorted((facet, value, chunk) for facet, value in changes for chunk in masks)
+            for facet, value, chunk in rows:
+                bumped = cls.objects.filter(facet=facet, value=value, chunk=chunk).update(
+                    version=models.F("version") + 1
+                )
+                if not bumped:
+                    cls.objects.get_or_create(facet=facet, value=value, chunk=chunk)
+            # only the rows that change are read
+            wanted = models.Q()
+            for facet, value, chunk in rows:
+                wanted |= models.Q(facet=facet, value=value, chunk=chunk)
+            for bitmap in cls.objects.filter(wanted):
+                bits = bitmap.as_int()
+                mask = masks[bitmap.chunk]
+                bitmap.set_int(bits | mask if changes[(bitmap.facet, bitmap.value)] else bits & ~mask)
+                bitmap.save(update_fields=["bits", "count"])
+
+
+# post_init remembers the values a property was loaded with, so that when it
+# is saved again we know which bitmaps it has to be taken out of
+@receiver(post_init, sender=Property)
+def remember_property_facets(sender, instance, **kwargs):
+    instance._facet_values = FacetBitmap.values_for(instance)
+
+
+def owner_kashrut_value(property):
+    kashrut_id = Profile.objects.filter(user_id=property.owner_id).values_list("kashrut_id", flat=True).first()
+    return facet_value(kashrut_id)
+
+
+@receiver(post_save, sender=Property)
+def sync_property_facets(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new_values = FacetBitmap.values_for(instance)
+    if created:
+        # the owner can't change after the property is made so kashrut
+        # only needs looking up the first time
+        new_values["kashrut"] = owner_kashrut_value(instance)
+        FacetBitmap.move([instance.id], {}, new_values)
+    else:
+        FacetBitmap.move([instance.id], instance._facet_values, new_values)
+    instance._facet_values = FacetBitmap.values_for(instance)
+
+
+# keep the keyword search index in search.py up to date
+@receiver(post_save, sender=Property)
+def index_property_text(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_property(instance)
+
+
+# look up the coordinates of the town when a property is added or its town
+# or country changes.  The locate_properties management command does the
+# same for many properties at once
+@receiver(pre_save, sender=Property)
+def locate_property(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not {"city", "country"} & set(update_fields):
+        return
+    old_values = getattr(instance, "_facet_values", {})
+    moved = (
+        instance._state.adding
+        or old_values.get("city") != facet_value(instance.city)
+        or old_values.get("country") != facet_value(instance.country)
+    )
+    if not moved:
+        return
+    point = geo.locate(instance.city, instance.country)
+    if point is None:
+        instance.latitude = instance.longitude = instance.geo_cell = None
+    else:
+        instance.latitude, instance.longitude = point
+        instance.geo_cell = geo.grid_cell(*point)
+
+
+@receiver(post_delete, sender=Property)
+def remove_property_text(sender, instance, **kwargs):
+    search.remove_property(instance.id)
+
+
+# pre_delete because the owner's Profile may be deleted too (when the user
+# is deleted) and it still exists at this point
+@receiver(pre_delete, sender=Property)
+def remove_property_facets(sender, instance, **kwargs):
+    old_values = FacetBitmap.values_for(instance)
+    old_values["kashrut"] = owner_kashrut_value(instance)
+    FacetBitmap.move([instance.id], old_values, {})
+
+
+# the same idea for the kashrut on a Profile.  Profile is saved every time
+# the User is saved (for example on login) so this only does anything when
+# the kashrut has really changed
+@receiver(post_init, sender=Profile)
+def remember_profile_kashrut(sender, instance, **kwargs):
+    instance._facet_kashrut_id = instance.kashrut_id
+
+
+@receiver(post_save, sender=Profile)
+def sync_profile_facets(sender, instance, raw=False, **kwargs):
+    if raw or instance.kashrut_id == instance._facet_kashrut_id:
+        return
+    property_ids = Property.objects.filter(owner_id=instance.user_id).values_list("id", flat=True)
+    FacetBitmap.move(
+        list(property_ids),
+        {"kashrut": facet_value(instance._facet_kashrut_id)},
+        {"kashrut": facet_value(instance.kashrut_id)},
+    )
+    instance._facet_kashrut_id = instance.kashrut_id
+    search_cache.changed("property")
+
+
 # Image table
 # based on help from
 # https://medium.com/@biswajitpanda973/creating-a-dynamic-product-gallery-in-django-a-guide-to-multi-image-uploads-1cefdb418201
@@ -194,6 +453,96 @@ class Property(models.Model):
 class Image(models.Model):
     property = models.ForeignKey(Property, on_delete=models.CASCADE)
     image = models.ImageField(upload_to="images/")
+    # size of the uploaded picture, and whether the smaller copies in
+    # ImageVariant have been made yet - see variants.py
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    processed = models.BooleanField(default=False, editable=False)
+
+    # The list of copies for the srcset attribute of an <img> or <source>,
+    # like "images/variants/1_400.webp 400w, images/variants/1_800.webp 800w"
+    # It uses variants.all() so that prefetch_related in the view is used
+    def srcset(self, format):
+        variants = sorted((v for v in self.variants.all() if v.format == format), key=lambda v: v.width)
+        return ", ".join(f"{variant.file.url} {variant.width}w" for variant in variants)
+
+    def webp_srcset(self):
+        return self.srcset("webp")
+
+    def jpeg_srcset(self):
+        return self.srcset("jpeg")
+
+    # the picture for browsers that don't understand srcset - the middle
+    # sized JPEG, or the original if the copies haven't been made yet
+    def fallback(self):
+        variants = sorted((v for v in self.variants.all() if v.format == "jpeg"), key=lambda v: v.width)
+        if variants:
+            return variants[len(variants) // 2]
+        return None
+
+
+# The smaller copies of each Image in WebP and JPEG, made in the background
+# by variants.py so that the detail page doesn't send the full size photos
+class ImageVariant(models.Model):
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="variants")
+    format = models.CharField(max_length=4)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    file = models.ImageField(upload_to="images/variants/")
+    size = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["image", "format", "width"], name="kswap_imagevariant_one_per_size"),
+        ]
+
+
+# A picture that is being uploaded in pieces - see uploads.py
+# The pieces are put together in a file in CHUNKED_UPLOAD_DIR and offset
+# is how many bytes of it have arrived so far
+class ImageUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True)
+    started = models.DateTimeField(auto_now_add=True)
+
+    def path(self):
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{self.id}.part")
+
+    @property
+    def complete(self):
+        return self.offset == self.size and self.sha256 != ""
+
+
+# make the copies of a new picture in the background after it is saved
+@receiver(post_save, sender=Image)
+def queue_image_variants(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        variants.queue(instance)
+
+
+# a new, changed or deleted picture is a change to its property
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def bump_image_property_version(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Property.objects.filter(id=instance.property_id).update(**property_changed())
+
+
+# and so is a smaller copy, which changes the picture's srcset
+@receiver(post_save, sender=ImageVariant)
+def bump_variant_property_version(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Property.objects.filter(image=instance.image_id).update(**property_changed())
+
+
+# the files aren't removed with the rows, so tidy them up
+@receiver(post_delete, sender=ImageVariant)
+def remove_variant_file(sender, instance, **kwargs):
+    instance.file.delete(save=False)
 
 
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -204,6 +553,13 @@ STATUS_CHOICES = (
         ('declined', 'Declined'),
     )
 
+# Pending bookings that start on or before this day are too late to accept,
+# so the pending_bookings page and the menu numbers leave them out until
+# expiry.py declines them
+def stale_cutoff(now=None):
+    return timezone.localdate(now) + timedelta(days=1)
+
+
 class Booking(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     property = models.ForeignKey(Property, on_delete=models.CASCADE)
@@ -213,6 +569,296 @@ class Booking(models.Model):
     status = models.CharField(max_length=10,
                               choices=STATUS_CHOICES,
                               default='pending')
+    # goes up by one every time the booking changes, see Property.version
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        # expiry.py looks for pending bookings that start soon.  The pages
+        # of a user look for the bookings of their homes with one status,
+        # on either side of the swap (see the audit_query_plans command)
+        indexes = [
+            models.Index(fields=["status", "date_from"], name="kswap_booking_status_from_idx"),
+            models.Index(fields=["property", "status", "date_from"], name="kswap_booking_prop_status_idx"),
+            models.Index(fields=["my_property", "status", "date_from"], name="kswap_booking_mine_status_idx"),
+        ]
+
+
+# A booking that is still pending or that has been accepted blocks its dates
+# for BOTH homes in the swap.  A declined booking frees the dates again
+ACTIVE_STATUSES = ('pending', 'accepted')
+
+
+# OccupiedDay is the availability store used by the property search
+# Every active booking writes one row for each night it covers, once for
+# property and once for my_property because during a swap both homes are in use.
+# The search only needs to look at the rows for the days it was asked about
+# using the (day, property) index, so it does not get slower as the number of
+# old bookings in the Booking table grows
+class OccupiedDay(models.Model):
+    property = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='occupied_days')
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='occupied_days')
+    day = models.DateField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['day', 'property'], name='kswap_occday_day_prop_idx'),
+        ]
+        # A home can only be in use by one active booking on any day.
+        # The database checks this when the rows are inserted, so two requests
+        # for the same dates cannot both get in even if they arrive together.
+        # Requests for different properties use different index entries and so
+        # they don't have to wait for each other
+        constraints = [
+            models.UniqueConstraint(fields=['property', 'day'], name='kswap_occday_one_booking_per_day'),
+        ]
+
+    # build (but don't save) one row per day per property for a booking
+    # date_from and date_to are both included, the same as the old search did
+    @classmethod
+    def rows_for_booking(cls, booking):
+        rows = []
+        if booking.status not in ACTIVE_STATUSES:
+            return rows
+        day = booking.date_from
+        while day <= booking.date_to:
+            for property_id in {booking.property_id, booking.my_property_id}:
+                rows.append(cls(property_id=property_id, booking_id=booking.id, day=day))
+            day += timedelta(days=1)
+        return rows
+
+    # make the store match the booking after it has been created or changed
+    # the old rows are thrown away and written again, which is cheap because
+    # a booking only covers a few weeks
+    @classmethod
+    def sync_booking(cls, booking):
+        cls.objects.filter(booking_id=booking.id).delete()
+        cls.objects.bulk_create(cls.rows_for_booking(booking))
+
+
+# This keeps OccupiedDay up to date every time a booking is saved,
+# for example when it is created or when its status changes.
+# raw is True while loading fixtures and then the related rows might not exist yet
+@receiver(post_save, sender=Booking)
+def sync_booking_occupancy(sender, instance, raw=False, **kwargs):
+    if not raw:
+        OccupiedDay.sync_booking(instance)
+
+
+# BadgeCounts holds the numbers shown next to "Swap requests" and "Your next
+# escapes" in the menu, so drawing a page reads one small row instead of
+# counting bookings every time.  The signals below change the numbers when a
+# booking is made, changes status or is deleted.  If a row is missing (a new
+# user, or after forget()) it is counted from the Booking table the next
+# time it is needed.  Pending bookings that are too late to accept (see
+# stale_cutoff) aren't counted, and as that changes each day a row counted
+# on an earlier day is counted again
+class BadgeCounts(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="badge_counts")
+    # pending bookings of the user's properties
+    pending_requests = models.IntegerField(default=0)
+    # accepted swaps the user is in, on either side
+    next_escapes = models.IntegerField(default=0)
+    # the day the numbers were last counted from scratch
+    counted_on = models.DateField(null=True)
+
+    # The row is made at zero before the bookings are counted, so that a
+    # booking changed while they are counted updates it (see move) rather
+    # than nothing.  The count is then added to the row under its lock, as
+    # the difference from what it held, which keeps any of those updates
+    @classmethod
+    def for_user(cls, user_id):
+        counts = cls.objects.filter(user_id=user_id).first()
+        today = timezone.localdate()
+        if counts is None:
+            # if another request made the row in the meantime, keep theirs
+            cls.objects.bulk_create([cls(user_id=user_id)], ignore_conflicts=True)
+        if counts is None or counts.counted_on != today:
+            with transaction.atomic():
+                rows = cls.objects.filter(user_id=user_id)
+                pending, escapes = rows.select_for_update().values_list("pending_requests", "next_escapes").get()
+                counted = cls.count(user_id)
+                rows.update(
+                    pending_requests=models.F("pending_requests") + counted.pending_requests - pending,
+                    next_escapes=models.F("next_escapes") + counted.next_escapes - escapes,
+                    counted_on=today,
+                )
+                counts = cls.objects.get(user_id=user_id)
+        return counts
+
+    # Counts the numbers from scratch.  The accepted swaps are found with
+    # the ids of the user's properties, rather than joining Property twice
+    @classmethod
+    def count(cls, user_id):
+        property_ids = Property.objects.filter(owner_id=user_id).values("id")
+        bookings = Booking.objects.order_by()
+        return cls(
+            user_id=user_id,
+            pending_requests=bookings.filter(
+                property_id__in=property_ids, status="pending", date_from__gt=stale_cutoff()
+            ).count(),
+            next_escapes=bookings.filter(
+                models.Q(property_id__in=property_ids) | models.Q(my_property_id__in=property_ids),
+                status="accepted",
+            ).count(),
+        )
+
+    # The numbers are counted again the next time these users load a page
+    # Used after changing bookings with update(), which sends no signals
+    @classmethod
+    def forget(cls, user_ids):
+        cls.objects.filter(user_id__in=user_ids).delete()
+
+    # What one booking adds to each user's numbers as {user id: [pending, escapes]}
+    @staticmethod
+    def booking_counts(state, owners, cutoff):
+        status, property_id, my_property_id, date_from = state
+        counts = {}
+        if status == "pending" and date_from > cutoff:
+            counts.setdefault(owners[property_id], [0, 0])[0] += 1
+        elif status == "accepted":
+            for owner_id in {owners[property_id], owners[my_property_id]}:
+                counts.setdefault(owner_id, [0, 0])[1] += 1
+        return counts
+
+    # Moves the numbers from a booking's old state to its new one.  A state
+    # is (status, property id, my_property id, date_from), or None before it
+    # is made or after it is deleted.  Rows that don't exist yet are left
+    # alone because they will be counted from scratch anyway
+    @classmethod
+    def move(cls, old_state, new_state):
+        if old_state == new_state:
+            return
+        states = [state for state in (old_state, new_state) if state is not None]
+        property_ids = {property_id for state in states for property_id in state[1:3]}
+        owners = dict(Property.objects.filter(id__in=property_ids).values_list("id", "owner_id"))
+        if len(owners) < len(property_ids):
+            # a property has gone, so let the owners be counted again
+            cls.forget(set(owners.values()))
+            return
+        cutoff = stale_cutoff()
+        changes = {}
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state is None:
+                continue
+            for user_id, (pending, escapes) in cls.booking_counts(state, owners, cutoff).items():
+                change = changes.setdefault(user_id, [0, 0])
+                change[0] += sign * pending
+                change[1] += sign * escapes
+        for user_id, (pending, escapes) in changes.items():
+            if pending or escapes:
+                cls.objects.filter(user_id=user_id).update(
+                    pending_requests=models.F("pending_requests") + pending,
+                    next_escapes=models.F("next_escapes") + escapes,
+                )
+
+
+def booking_badge_state(booking):
+    values = booking.__dict__
+    if any(field not in values for field in ("status", "property_id", "my_property_id", "date_from")):
+        return None
+    return (values["status"], values["property_id"], values["my_property_id"], values["date_from"])
+
+
+@receiver(post_init, sender=Booking)
+def remember_booking_badge_state(sender, instance, **kwargs):
+    instance._badge_state = booking_badge_state(instance) if instance.pk else None
+
+
+# One row for each time expiry.py declined the stale swap requests, so it is
+# easy to see in the admin pages that it is running and how much it does
+class ExpiryRun(models.Model):
+    started = models.DateTimeField()
+    seconds = models.FloatField(default=0)
+    declined = models.PositiveIntegerField(default=0)
+    batches = models.PositiveIntegerField(default=0)
+    retries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-started"]
+
+    def __str__(self):
+        return f"{self.started:%Y-%m-%d %H:%M} declined {self.declined}"
+
+
+# One request run under the profiler by a staff user (see profiling.py).
+# The results themselves are in two files in REQUEST_PROFILE_DIR, name.prof
+# and name.txt
+class RequestProfile(models.Model):
+    created = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=200, blank=True)
+    status = models.PositiveSmallIntegerField()
+    ms = models.FloatField()
+    allocated_kb = models.PositiveIntegerField(default=0)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"{self.created:%Y-%m-%d %H:%M} {self.view_name or self.path} {self.ms:.0f} ms"
+
+    def file_path(self, extension):
+        directory = getattr(settings, "REQUEST_PROFILE_DIR", os.path.join(settings.BASE_DIR, "profiles"))
+        return os.path.join(directory, f"{self.name}.{extension}")
+
+    def delete_files(self):
+        for extension in ["prof", "txt"]:
+            if os.path.exists(self.file_path(extension)):
+                os.remove(self.file_path(extension))
+
+
+# One file of homes loaded with the import_properties command (see
+# property_import.py).  rows is how many rows of the file are done, saved
+# in the same transaction as each batch of homes, so a stopped import
+# carries on from the first row that wasn't saved
+class PropertyImport(models.Model):
+    source = models.CharField(max_length=500, unique=True)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    rows = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    images = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["-started"]
+
+    def __str__(self):
+        return f"{self.source} {self.imported} imported, {self.failed} failed"
+
+
+def stored_badge_state(booking_id):
+    return (
+        Booking.objects.filter(pk=booking_id)
+        .values_list("status", "property_id", "my_property_id", "date_from")
+        .first()
+    )
+
+
+# If the booking was loaded without all four fields (with only() or
+# defer()) its state is read from the database before and after it changes
+@receiver(pre_save, sender=Booking)
+@receiver(pre_delete, sender=Booking)
+def load_booking_badge_state(sender, instance, raw=False, **kwargs):
+    if instance.pk and instance._badge_state is None and not raw:
+        instance._badge_state = stored_badge_state(instance.pk)
+
+
+@receiver(post_save, sender=Booking)
+def sync_booking_badges(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new_state = booking_badge_state(instance) or stored_badge_state(instance.pk)
+    BadgeCounts.move(None if created else instance._badge_state, new_state)
+    instance._badge_state = new_state
+
+
+@receiver(post_delete, sender=Booking)
+def remove_booking_badges(sender, instance, **kwargs):
+    BadgeCounts.move(instance._badge_state, None)
 
 
 # Review class
@@ -230,6 +876,315 @@ class Review(models.Model):
     reviewer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews_given')
     text = models.TextField(max_length=100, null=True, blank=True)
     stars = models.PositiveIntegerField(validators=[MaxValueValidator(5)], null=True, blank=True)
+    # goes up by one every time the review changes, see Property.version
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        # the leave review page looks for bookings without a review by the user
+        indexes = [
+            models.Index(fields=["booking", "reviewer"], name="kswap_review_booking_idx"),
+        ]
 
     def __str__(self):
-        return f'Review for property {self.property_reviewed.id} by {self.reviewer.username}'
+        return f'Review for property {self.property_reviewed_id} by {self.reviewer.username}'
+
+
+# What a review adds to the ratings: (property id, stars), or None when it
+# has no stars
+def review_rating(property_id, stars):
+    if property_id is None or stars is None:
+        return None
+    return (property_id, stars)
+
+
+def stored_review_rating(review_id):
+    values = Review.objects.filter(pk=review_id).values_list("property_reviewed_id", "stars").first()
+    return review_rating(*values) if values else None
+
+
+# The new count, sum and mean after adding count reviews with stars stars
+# between them (both are negative when taking reviews away).  They are
+# worked out by the database in one UPDATE from the values already in the
+# row, so two reviews saved at the same time can't lose one of the changes
+def rating_changes(count, stars):
+    new_count = models.F("rating_count") + count
+    new_sum = models.F("rating_sum") + stars
+    return {
+        "rating_count": new_count,
+        "rating_sum": new_sum,
+        "rating": models.Case(
+            models.When(rating_count=-count, then=None),
+            default=Cast(new_sum, models.FloatField()) / Cast(new_count, models.FloatField()),
+        ),
+    }
+
+
+def change_ratings(rating, sign):
+    if rating is None:
+        return
+    property_id, stars = rating
+    changes = rating_changes(sign, sign * stars)
+    with transaction.atomic():
+        Property.objects.filter(id=property_id).update(**property_changed(), **changes)
+        owner_id = Property.objects.filter(id=property_id).values_list("owner_id", flat=True).first()
+        Profile.objects.filter(user_id=owner_id).update(**changes)
+
+
+# the rating a review had before it is changed or deleted is read from the
+# database, because the one in memory may already have been changed
+@receiver(pre_save, sender=Review)
+@receiver(pre_delete, sender=Review)
+def load_review_rating(sender, instance, raw=False, **kwargs):
+    instance._old_rating = None if raw or instance._state.adding else stored_review_rating(instance.pk)
+
+
+@receiver(post_save, sender=Review)
+def sync_review_rating(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    new_rating = review_rating(instance.property_reviewed_id, instance.stars)
+    if new_rating != instance._old_rating:
+        change_ratings(instance._old_rating, -1)
+        change_ratings(new_rating, 1)
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, **kwargs):
+    change_ratings(instance._old_rating, -1)
+
+
+# Works out the ratings again from the reviews, with one UPDATE for the
+# properties and one for the profiles.  Used by the rebuild_ratings command
+# for everything, and after bulk_create() of reviews (which doesn't send
+# post_save) for only the properties that were reviewed and their owners
+def rebuild_ratings(property_ids=None):
+    def rated(reviews, group_by):
+        reviews = reviews.filter(stars__isnull=False).order_by().values(group_by)
+        return {
+            "rating_count": Coalesce(models.Subquery(reviews.annotate(n=models.Count("id")).values("n")), 0),
+            "rating_sum": Coalesce(models.Subquery(reviews.annotate(n=models.Sum("stars")).values("n")), 0),
+            "rating": models.Subquery(reviews.annotate(n=models.Avg("stars")).values("n")),
+        }
+
+    properties = Property.objects.all()
+    profiles = Profile.objects.all()
+    if property_ids is not None:
+        properties = properties.filter(id__in=property_ids)
+        profiles = profiles.filter(user_id__in=Property.objects.filter(id__in=property_ids).values("owner_id"))
+    with transaction.atomic():
+        properties = properties.update(
+            **property_changed(),
+            **rated(Review.objects.filter(property_reviewed=models.OuterRef("pk")), "property_reviewed")
+        )
+        profiles = profiles.update(
+            **rated(Review.objects.filter(property_reviewed__owner=models.OuterRef("user_id")), "property_reviewed__owner")
+        )
+    search_cache.changed("property")
+    return properties, profiles
+
+
+# A SwapWish is a user saying "I would swap this home of mine for a home in
+# this town (or anywhere in this country) some time between these dates"
+# matching.py looks for other wishes it can be swapped with and saves them
+# as SwapMatch rows
+class SwapWish(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='swap_wishes')
+    home = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='swap_wishes')
+    # where the home is, copied from the property when the wish is saved so
+    # that the matching can find wishes by their town with one index
+    home_country = CountryField(editable=False)
+    home_city = models.CharField(max_length=20, editable=False)
+    # where the owner would like to go.  A blank city means anywhere in the country
+    country = CountryField()
+    city = models.CharField(max_length=20, blank=True)
+    date_from = models.DateField()
+    date_to = models.DateField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["home_country", "home_city", "date_from", "date_to"], name="kswap_wish_home_idx"),
+            models.Index(fields=["country", "city", "date_from", "date_to"], name="kswap_wish_wanted_idx"),
+        ]
+
+    def __str__(self):
+        return f'{self.home} for {self.city or "anywhere"}, {self.country}'
+
+
+# A ring of 2, 3 or 4 wishes where each owner can go to the next home
+# key is the ids of the wishes in the order round the ring, like "3,17,9"
+class SwapMatch(models.Model):
+    key = models.CharField(max_length=100, unique=True)
+    wishes = models.ManyToManyField(SwapWish, related_name='matches')
+    size = models.PositiveSmallIntegerField()
+    # the days when all the homes in the ring are wanted
+    date_from = models.DateField()
+    date_to = models.DateField()
+
+    # the wishes in the order round the ring, from prefetched wishes
+    def ring(self):
+        by_id = {wish.id: wish for wish in self.wishes.all()}
+        return [by_id[int(wish_id)] for wish_id in self.key.split(",") if int(wish_id) in by_id]
+
+
+@receiver(pre_save, sender=SwapWish)
+def copy_wish_home_town(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance.home_country = instance.home.country
+        instance.home_city = instance.home.city
+
+
+# matching.py is imported here, not at the top, because it imports the models
+@receiver(post_save, sender=SwapWish)
+def match_swap_wish(sender, instance, raw=False, **kwargs):
+    if not raw:
+        from . import matching
+        matching.match_wish(instance.id)
+
+
+# a ring with a wish missing isn't a swap any more
+@receiver(pre_delete, sender=SwapWish)
+def remove_swap_matches(sender, instance, **kwargs):
+    SwapMatch.objects.filter(wishes=instance).delete()
+
+
+# when a home moves town its wishes are matched again
+@receiver(post_save, sender=Property)
+def rematch_moved_home(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    moved = SwapWish.objects.filter(home=instance).exclude(home_country=instance.country, home_city=instance.city)
+    for wish in moved:
+        wish.save()
+
+
+# The cached search results (see search_cache.py) are for the properties
+# and bookings as they were.  A change to a property or its rating starts
+# a new generation of property searches, and a change to a booking a new
+# generation of the searches with dates
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def forget_property_searches(sender, instance, **kwargs):
+    search_cache.changed("property")
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def forget_dated_searches(sender, instance, **kwargs):
+    search_cache.changed("booking")
+
+
+# Every save of a property, booking or review gives it the next version.
+# When only some fields are saved (save(update_fields=...)) the version
+# isn't one of them, so it is added to the row with its own UPDATE.  Code
+# that changes these rows with update() adds one to the version itself
+@receiver(pre_save, sender=Property)
+@receiver(pre_save, sender=Booking)
+@receiver(pre_save, sender=Review)
+def next_version(sender, instance, raw=False, **kwargs):
+    if not raw and not instance._state.adding:
+        instance.version += 1
+
+
+@receiver(post_save, sender=Property)
+@receiver(post_save, sender=Booking)
+@receiver(post_save, sender=Review)
+def save_next_version(sender, instance, raw=False, update_fields=None, **kwargs):
+    if not raw and update_fields is not None and "version" not in update_fields:
+        changes = {"version": instance.version}
+        if sender is Property:
+            instance.updated_at = changes["updated_at"] = timezone.now()
+        sender.objects.filter(pk=instance.pk).update(**changes)
+
+
+# What to give update() when a property, its rating or its pictures are
+# changed without calling Property.save(), so its version and updated_at
+# still change
+def property_changed():
+    return {"version": models.F("version") + 1, "updated_at": timezone.now()}
+
+
+# SiteCounter holds the numbers on the home page (how many properties,
+# users and kashrut authorities there are), one row for each, so the home
+# page reads one tiny table instead of counting three big ones every time.
+# The receivers below add or take one away when a row is made or deleted.
+# bulk_create() and update() don't send signals, so the refresh_site_stats
+# command counts everything again - run it every so often, e.g. from cron.
+# With SITE_STATS_ESTIMATED in settings.py it asks Postgres for its own
+# estimate of the size of each table instead of counting, which is much
+# quicker on big tables but only roughly right
+class SiteCounter(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    # The tables that are counted, by the name of their counter
+    @staticmethod
+    def counted():
+        return {"properties": Property, "users": User, "kashrut": Kashrut}
+
+    # All the numbers as {name: value}.  Any that are missing (on a new site
+    # or after the table was emptied) are counted now and saved.  As in
+    # BadgeCounts.for_user, the rows are made at zero first so that add()
+    # has something to update while the tables are counted
+    @classmethod
+    def numbers(cls):
+        numbers = dict(cls.objects.values_list("name", "value"))
+        missing = {name: model for name, model in cls.counted().items() if name not in numbers}
+        if missing:
+            # if another request made them in the meantime, keep theirs
+            cls.objects.bulk_create([cls(name=name) for name in missing], ignore_conflicts=True)
+            with transaction.atomic():
+                held = dict(cls.objects.select_for_update().filter(name__in=missing).values_list("name", "value"))
+                for name, model in missing.items():
+                    cls.objects.filter(name=name).update(value=models.F("value") + count_rows(model) - held[name])
+                numbers.update(cls.objects.filter(name__in=missing).values_list("name", "value"))
+        return numbers
+
+    @classmethod
+    def add(cls, model, change):
+        for name, counted_model in cls.counted().items():
+            if counted_model is model:
+                cls.objects.filter(name=name).update(value=models.F("value") + change)
+
+    # Counts every table again and saves the numbers
+    @classmethod
+    def refresh(cls, estimated=None):
+        counters = [cls(name=name, value=count_rows(model, estimated)) for name, model in cls.counted().items()]
+        cls.objects.bulk_create(counters, update_conflicts=True, unique_fields=["name"], update_fields=["value"])
+        return {counter.name: counter.value for counter in counters}
+
+
+# The number of rows in a model's table.  When estimated (by default the
+# SITE_STATS_ESTIMATED setting) and the database is Postgres, this is the
+# planner's estimate kept by ANALYZE, which doesn't read the table at all.
+# Other databases, and tables Postgres hasn't analyzed yet, are counted
+def count_rows(model, estimated=None):
+    if estimated is None:
+        estimated = getattr(settings, "SITE_STATS_ESTIMATED", False)
+    if estimated and connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [model._meta.db_table])
+            row = cursor.fetchone()
+        # reltuples is -1 (or 0 on old versions) before the first ANALYZE
+        if row and row[0] > 0:
+            return int(row[0])
+    return model.objects.count()
+
+
+@receiver(post_save, sender=Property)
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Kashrut)
+def count_new_row(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        SiteCounter.add(sender, 1)
+
+
+@receiver(post_delete, sender=Property)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Kashrut)
+def count_deleted_row(sender, instance, **kwargs):
+    SiteCounter.add(sender, -1)
@@ -0,0 +1,117 @@
+# Profiling one request on the live site
+# When a page is slow in production it is hard to find out why from the
+# outside.  With REQUEST_PROFILING = True in settings.py a staff user can
+# add ?profile=1 to the address of the page (or send the header
+# X-Profile: 1) and that one request is run under:
+#   - cProfile, which records the time spent in every function
+#   - tracemalloc, which records where memory was allocated
+# The results are saved in REQUEST_PROFILE_DIR and listed, newest first, on
+# the "Request profiles" page in the admin, with the view and how long it
+# took.  Each one has a text summary and the .prof file, which can be opened
+# with pstats or snakeviz.  Only the last REQUEST_PROFILE_KEEP are kept.
+#
+# Requests that don't ask for a profile only pay for looking at one query
+# parameter and one header, and when REQUEST_PROFILING is off the middleware
+# removes itself when the site starts.  tracemalloc sees every thread, so on
+# a busy server the memory numbers include other requests running at the
+# same time
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import RequestProfile
+
+TRIGGER = "profile"
+HEADER = "X-Profile"
+# how many lines of each list go in the summary
+TOP = 40
+
+
+def profile_dir():
+    return getattr(settings, "REQUEST_PROFILE_DIR", os.path.join(settings.BASE_DIR, "profiles"))
+
+
+def wants_profile(request):
+    return TRIGGER in request.GET or request.headers.get(HEADER) == "1"
+
+
+def summary(request, stats, memory, ms):
+    text = io.StringIO()
+    text.write(f"{request.method} {request.get_full_path()} took {ms:.1f} ms\n\n")
+    text.write("Time, by cumulative time in each function\n")
+    pstats.Stats(stats, stream=text).sort_stats("cumulative").print_stats(TOP)
+    text.write("Memory allocated during the request, by line\n")
+    for stat in memory[:TOP]:
+        text.write(f"{stat}\n")
+    return text.getvalue()
+
+
+# Keeps the newest REQUEST_PROFILE_KEEP profiles and deletes the rest
+def prune():
+    keep = getattr(settings, "REQUEST_PROFILE_KEEP", 50)
+    old = RequestProfile.objects.order_by("-created")[keep:]
+    for profile in old:
+        profile.delete_files()
+    RequestProfile.objects.filter(id__in=[profile.id for profile in old]).delete()
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, "REQUEST_PROFILING", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not wants_profile(request) or not request.user.is_staff:
+            return self.get_response(request)
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+            ms = (time.perf_counter() - started) * 1000
+            after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+
+        memory = after.compare_to(before, "lineno")
+        allocated = sum(stat.size_diff for stat in memory if stat.size_diff > 0)
+        match = request.resolver_match
+        view_name = match.view_name if match else ""
+
+        os.makedirs(profile_dir(), exist_ok=True)
+        now = timezone.now()
+        name = get_valid_filename(f"{now:%Y%m%d_%H%M%S_%f}_{view_name or 'no_view'}_{ms:.0f}ms")
+        profiler.dump_stats(os.path.join(profile_dir(), f"{name}.prof"))
+        with open(os.path.join(profile_dir(), f"{name}.txt"), "w") as file:
+            file.write(summary(request, profiler, memory, ms))
+
+        profile = RequestProfile.objects.create(
+            created=now,
+            user=request.user,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=view_name,
+            status=response.status_code,
+            ms=ms,
+            allocated_kb=allocated // 1024,
+            name=name,
+        )
+        prune()
+        response["X-Profile-Id"] = str(profile.id)
+        return response
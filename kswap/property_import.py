@@ -0,0 +1,319 @@
+# Importing many homes at once
+# When a whole community joins, its homes arrive as one big file instead
+# of being typed into property_registration one at a time.  The file is
+# CSV with a header row, or JSON Lines (one JSON object per line), with the
+# same fields as PropertyForm plus:
+#   - owner: the username of a user who already has an account
+#   - kashrut (optional): the name of a Kashrut for the owner's profile,
+#     only used when the profile doesn't have one yet
+#   - images (optional): picture files to copy in, relative to the images
+#     folder, separated by | in a CSV file or as a list in JSON Lines
+#
+# The file is read a row at a time and handled BATCH_SIZE rows at a time,
+# so memory use doesn't grow with the size of the file:
+#   - every row is checked by PropertyForm, the same as the registration page
+#   - the owners and kashrut of the whole batch are looked up in one query each
+#   - the pictures are copied by a pool of threads
+#   - the homes and their Images are saved with bulk_create, in one
+#     transaction with the number of rows done so far (PropertyImport.rows).
+#     If the import stops it carries on after the last batch that was saved
+#
+# A row with a problem isn't saved.  It is written to the errors file (the
+# import file's name + ".errors.jsonl") with its row number and errors, in
+# a form that can be fixed and imported again.  A JSON Lines line that
+# can't be read is written there too, as it was, under "_line".  bulk_create doesn't send the
+# signals in models.py, so each batch does their work for its own homes in
+# the same transaction: the coordinates, the search filters, the keyword
+# index, the home page numbers and the swap matching.  A batch that is
+# saved can be searched for straight away, even if a later batch fails.
+# The smaller copies of the pictures are left to the process_images command
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django import forms
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django_countries import countries
+
+from . import facets, geo, matching, search, search_cache
+from .forms import PropertyForm
+from .models import FacetBitmap, Image, Kashrut, Profile, Property, PropertyImport, SiteCounter, facet_value
+
+BATCH_SIZE = 1000
+WORKERS = 8
+
+# how a CSV file can say no to a yes/no field, anything else is yes
+FALSE_WORDS = {"", "0", "false", "no", "n", "off"}
+BOOLEAN_FIELDS = {"pet_friendly", "succah", "passover_kitchen", "smoking_allowed"}
+
+
+def errors_path(path):
+    return path + ".errors.jsonl"
+
+
+# A line of a JSON Lines file that isn't a JSON object, or whose owner,
+# kashrut or images aren't the right type.  It takes its place among the
+# rows so that it is counted and written to the errors file like any other
+# failed row, and a stopped import carries on after it
+class BadLine:
+    def __init__(self, line, problem):
+        self.line = line
+        self.problem = problem
+
+
+# The rows of the file, one dict at a time, in the same shape for CSV and
+# JSON Lines.  Rows written to an errors file come back in without their
+# row number and errors
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if path.endswith((".jsonl", ".json")):
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as error:
+                    yield BadLine(line.strip(), f"The line is not JSON: {error}")
+                    continue
+                if not isinstance(row, dict):
+                    yield BadLine(line.strip(), "The line is not a JSON object")
+                    continue
+                row.pop("_row", None)
+                row.pop("_errors", None)
+                row.pop("_line", None)
+                problem = json_row_problem(row)
+                if problem:
+                    yield BadLine(line.strip(), problem)
+                    continue
+                yield row
+        else:
+            for row in csv.DictReader(file):
+                images = row.get("images") or ""
+                row["images"] = [name.strip() for name in images.split("|") if name.strip()]
+                for field in BOOLEAN_FIELDS & row.keys():
+                    row[field] = row[field].strip().lower() not in FALSE_WORDS
+                yield row
+
+
+# JSON can give any field any type, but the owner and kashrut are looked
+# up by name and the images are a list of file names.  Returns what is
+# wrong with the row, if anything, and makes its images a list
+def json_row_problem(row):
+    for field in ("owner", "kashrut"):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            return f"{field} must be a name"
+    images = row.get("images")
+    if images is None:
+        images = []
+    elif isinstance(images, str):
+        images = [images]
+    if not isinstance(images, list) or not all(isinstance(name, str) for name in images):
+        return "images must be a list of file names"
+    row["images"] = images
+    return None
+
+
+# PropertyForm checks the country against the list of every country, which
+# django-countries makes again, translating each name, for every form and
+# again when the Property is checked.  With thousands of rows that was most
+# of the time of an import, so this form checks the code against a set made
+# once and leaves the rest of PropertyForm as it is
+def form_class():
+    codes = frozenset(code for code, name in countries)
+
+    class ImportPropertyForm(PropertyForm):
+        country = forms.CharField()
+
+        class Meta(PropertyForm.Meta):
+            exclude = PropertyForm.Meta.exclude + ("country",)
+
+        def clean_country(self):
+            code = self.cleaned_data["country"].strip().upper()
+            if code not in codes:
+                raise forms.ValidationError(f"{code} is not a country code")
+            return code
+
+    return ImportPropertyForm
+
+
+# Checks one row with the form and returns (property, errors)
+def check_row(form_class, row, owners, kashrut):
+    errors = []
+    owner = owners.get(row.get("owner"))
+    if owner is None:
+        errors.append(f"There is no user called {row.get('owner')!r}")
+    if row.get("kashrut") and row["kashrut"] not in kashrut:
+        errors.append(f"There is no kashrut called {row['kashrut']!r}")
+    form = form_class(data=row)
+    if not form.is_valid():
+        for field, messages in form.errors.items():
+            errors += [f"{field}: {message}" for message in messages]
+    if errors:
+        return None, errors
+    home = form.save(commit=False)
+    home.country = form.cleaned_data["country"]
+    home.owner = owner
+    return home, []
+
+
+class Importer:
+    def __init__(self, path, images_dir="", batch_size=BATCH_SIZE, workers=WORKERS, log=None):
+        self.path = path
+        self.images_dir = os.path.realpath(images_dir or os.path.dirname(os.path.abspath(path)))
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.form_class = form_class()
+        self.log = log or (lambda message: None)
+
+    # Starts, or carries on with, the import of the file and returns its
+    # PropertyImport with the numbers.  restart=True starts from the top again
+    def run(self, restart=False):
+        source = os.path.abspath(self.path)
+        if restart:
+            PropertyImport.objects.filter(source=source).delete()
+        record, created = PropertyImport.objects.get_or_create(source=source, defaults={"started": timezone.now()})
+        if record.rows:
+            self.log(f"Carrying on after row {record.rows}")
+        # a fresh start empties the errors file, carrying on adds to it
+        mode = "a" if record.rows else "w"
+
+        rows = enumerate(read_rows(self.path), 1)
+        # skip the rows that were saved last time
+        for _ in islice(rows, record.rows):
+            pass
+        with open(errors_path(self.path), mode) as errors, ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="property-import"
+        ) as self.pool:
+            while True:
+                batch = list(islice(rows, self.batch_size))
+                if not batch:
+                    break
+                self.save_batch(record, batch, errors)
+                self.log(f"{record.rows} rows: {record.imported} imported, {record.failed} failed")
+
+        record.finished = timezone.now()
+        record.save(update_fields=["finished"])
+        return record
+
+    def save_batch(self, record, batch, errors):
+        # the lines that couldn't be read go to the errors file as they were
+        failed = [(number, {"_line": row.line}, [row.problem]) for number, row in batch if isinstance(row, BadLine)]
+        rows = [(number, row) for number, row in batch if not isinstance(row, BadLine)]
+        owners = {
+            user.username: user for user in User.objects.filter(username__in={row.get("owner") for _, row in rows})
+        }
+        kashrut = dict(
+            Kashrut.objects.filter(name__in={row.get("kashrut") for _, row in rows}).values_list("name", "id")
+        )
+
+        checked = []
+        for number, row in rows:
+            home, problems = check_row(self.form_class, row, owners, kashrut)
+            if problems:
+                failed.append((number, row, problems))
+            else:
+                checked.append((number, row, home))
+
+        # the pictures of the good rows, copied all at once by the pool
+        copies = self.copy_images([(number, name) for number, row, home in checked for name in row.get("images", [])])
+        saved = []
+        homes = []
+        pictures = []
+        for number, row, home in checked:
+            names = [copies[(number, name)] for name in row.get("images", [])]
+            missing = [
+                f"Could not copy the picture {name!r}" for name in row.get("images", []) if not copies[(number, name)]
+            ]
+            if missing:
+                # the pictures of the row that were copied aren't needed now
+                for name in names:
+                    if name:
+                        default_storage.delete(name)
+                failed.append((number, row, missing))
+            else:
+                saved.append((number, row, home))
+                homes.append(home)
+                pictures.append(names)
+
+        self.locate(homes)
+        with transaction.atomic():
+            # the kashrut first, so the new homes get the owner's new one
+            self.set_kashrut(saved, owners, kashrut)
+            Property.objects.bulk_create(homes)
+            Image.objects.bulk_create(
+                [Image(property=home, image=name) for home, names in zip(homes, pictures) for name in names]
+            )
+            self.index(homes)
+            record.rows = batch[-1][0]
+            record.imported += len(homes)
+            record.failed += len(failed)
+            record.images += sum(len(names) for names in pictures)
+            record.save(update_fields=["rows", "imported", "failed", "images"])
+
+        for number, row, problems in sorted(failed, key=lambda failure: failure[0]):
+            errors.write(json.dumps({"_row": number, "_errors": problems, **row}, default=str) + "\n")
+        errors.flush()
+
+    # Returns {(row number, name): the name in storage}, or None for a
+    # picture that couldn't be copied
+    def copy_images(self, names):
+        return dict(zip(names, self.pool.map(self.copy_image, [name for number, name in names])))
+
+    def copy_image(self, name):
+        path = os.path.realpath(os.path.join(self.images_dir, name))
+        # a file name like ../../etc/passwd mustn't read outside the folder
+        if not path.startswith(self.images_dir + os.sep) or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as file:
+                return default_storage.save(f"images/{os.path.basename(path)}", File(file))
+        except OSError:
+            return None
+
+    # Owners without a kashrut get the one in their first row that has one
+    def set_kashrut(self, saved, owners, kashrut):
+        wanted = {}
+        for number, row, home in saved:
+            if row.get("kashrut"):
+                wanted.setdefault(owners[row["owner"]].id, kashrut[row["kashrut"]])
+        if not wanted:
+            return
+        profiles = list(Profile.objects.filter(user_id__in=wanted, kashrut__isnull=True))
+        for profile in profiles:
+            profile.kashrut_id = wanted[profile.user_id]
+        Profile.objects.bulk_update(profiles, ["kashrut"])
+        # bulk_update doesn't send post_save either, so the homes the owners
+        # already had are moved to their new kashrut here
+        for kashrut_id in {profile.kashrut_id for profile in profiles}:
+            user_ids = [profile.user_id for profile in profiles if profile.kashrut_id == kashrut_id]
+            property_ids = list(Property.objects.filter(owner_id__in=user_ids).values_list("id", flat=True))
+            FacetBitmap.move(property_ids, {"kashrut": facet_value(None)}, {"kashrut": facet_value(kashrut_id)})
+
+    # The coordinates the locate_property signal would have filled in.  Each
+    # town is only looked up once
+    def locate(self, homes):
+        towns = {}
+        for home in homes:
+            town = (str(home.country), home.city)
+            if town not in towns:
+                towns[town] = geo.locate(home.city, home.country)
+            point = towns[town]
+            if point is not None:
+                home.latitude, home.longitude = point
+                home.geo_cell = geo.grid_cell(*point)
+
+    # What the post_save signals would have done for the new homes, for
+    # these homes only
+    def index(self, homes):
+        facets.add(homes)
+        for home in homes:
+            search.index_property(home)
+        SiteCounter.add(Property, len(homes))
+        matching.match_homes([home.id for home in homes])
+        search_cache.changed("property")
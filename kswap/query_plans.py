@@ -0,0 +1,150 @@
+# Reading the query plans of the SQL the pages run
+# The database decides how to run each query: with an index, or by reading
+# every row of a table (a "full scan"), and whether it has to sort the rows
+# itself in a temporary table.  A full scan is fine for a table of twenty
+# kashrut authorities and very slow for the bookings table once it has a
+# million rows, so these are found with EXPLAIN (EXPLAIN QUERY PLAN on
+# SQLite) and listed by the audit_query_plans command, with the columns of
+# the table the query filters on as a hint for an index.
+#
+# On SQLite it also finds a "weak index": an index that is used, but only
+# on a column with a few different values, like status, so the database
+# still reads a big share of the table.  That needs the statistics ANALYZE
+# keeps in sqlite_stat1.  Only SQLite and PostgreSQL are understood
+import re
+
+from django.db import connection
+
+# what the plans say for each kind of problem
+SQLITE_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+SQLITE_SEARCH = re.compile(r"^SEARCH (\w+)(?: AS \w+)? USING (?:COVERING )?INDEX (\w+) \((.*)\)$")
+SQLITE_TEMP_SORT = re.compile(r"USE TEMP B-TREE FOR (?:ORDER BY|GROUP BY|DISTINCT)")
+POSTGRES_SCAN = re.compile(r"Seq Scan on (\w+)")
+POSTGRES_SORT = re.compile(r"^(?:->\s*)?Sort\b")
+
+# the statements worth explaining, not SAVEPOINT, INSERT...
+EXPLAINED = ("SELECT", "UPDATE", "DELETE")
+# an index that leaves more than this share of a table to read is weak,
+# once the table has at least WEAK_INDEX_MIN_ROWS rows
+WEAK_INDEX_SHARE = 0.1
+WEAK_INDEX_MIN_ROWS = 1000
+
+
+def explain(sql):
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return [row[-1] for row in cursor.fetchall()]
+        if connection.vendor == "postgresql":
+            cursor.execute("EXPLAIN " + sql)
+            return [row[0] for row in cursor.fetchall()]
+    raise ValueError(f"Can't read the query plans of {connection.vendor}")
+
+
+# Django gives a table a short name (U0, T4...) when it is in a query twice
+# and the plans use that name, so it is turned back into the table's name
+def table_names(sql):
+    names = dict(re.findall(r'"(\w+)" ([A-Z]\d+)\b', sql))
+    return {alias: table for table, alias in names.items()}
+
+
+# How many rows sqlite_stat1 thinks an index finds for each value of its
+# first `columns` columns, and how many rows the table has
+def index_rows(index, columns):
+    with connection.cursor() as cursor:
+        # the table is only there once ANALYZE has been run
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            return None, None
+        cursor.execute("SELECT stat FROM sqlite_stat1 WHERE idx = %s", [index])
+        row = cursor.fetchone()
+    if row is None:
+        return None, None
+    numbers = [int(number) for number in row[0].split() if number.isdigit()]
+    return numbers[min(columns, len(numbers) - 1)], numbers[0]
+
+
+def weak_index(index, condition):
+    # "status=?" uses one column, "property_id=? AND status=?" two, and a
+    # range like "date_from>?" only narrows the rows a little more
+    columns = len(re.findall(r"\w+=\?", condition))
+    if not columns:
+        return False
+    rows, total = index_rows(index, columns)
+    return bool(total) and total >= WEAK_INDEX_MIN_ROWS and rows > total * WEAK_INDEX_SHARE
+
+
+# The problems in a plan as a set of (kind, table), kind is "full scan",
+# "weak index" or "temp sort".  The plan doesn't say which table a sort is
+# for, so it is given the first table in the FROM of the query
+def problems(plan, sql):
+    names = table_names(sql)
+    found = set()
+    for line in plan:
+        line = line.strip()
+        if connection.vendor == "sqlite":
+            scan = SQLITE_SCAN.match(line)
+            search = SQLITE_SEARCH.match(line)
+            sort = SQLITE_TEMP_SORT.search(line)
+        else:
+            scan = POSTGRES_SCAN.search(line)
+            search = None
+            sort = POSTGRES_SORT.match(line)
+        if scan:
+            found.add(("full scan", names.get(scan.group(1), scan.group(1))))
+        if search and weak_index(search.group(2), search.group(3)):
+            found.add(("weak index", names.get(search.group(1), search.group(1))))
+        if sort:
+            table = re.search(r' FROM "?(\w+)"?', sql)
+            found.add(("temp sort", table.group(1) if table else "?"))
+    return found
+
+
+# The columns of table that the WHERE of the query compares with something,
+# in the order they first appear.  Django always writes "table"."column"
+def filtered_columns(sql, table):
+    where = sql.split(" WHERE ", 1)[1] if " WHERE " in sql else ""
+    where = re.split(r" (?:GROUP BY|ORDER BY|LIMIT) ", where)[0]
+    aliases = [f'"{table}"'] + [alias for alias, name in table_names(sql).items() if name == table]
+    columns = []
+    for alias in aliases:
+        for column in re.findall(rf'{re.escape(alias)}\."(\w+)" (?:=|IN|<|>|<=|>=|IS|BETWEEN)', where):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+# The columns an index could be made of: the filtered columns, unless the
+# first of them already starts an index, in which case the database chose to
+# scan anyway (usually because the table is small)
+def index_hint(sql, table):
+    columns = filtered_columns(sql, table)
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    leading = {details["columns"][0] for details in constraints.values() if details["index"] or details["primary_key"]}
+    if not columns or columns[0] in leading:
+        return []
+    return columns
+
+
+def row_count(table):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {connection.ops.quote_name(table)}")
+        return cursor.fetchone()[0]
+
+
+# Every problem in the SQL run by one page, as a dict of "kind table" ->
+# {"sql": the first query with it, "rows": rows in the table, "columns": the
+# index hint}
+def audit(queries):
+    found = {}
+    for sql in dict.fromkeys(query["sql"] for query in queries):
+        if not sql.lstrip().upper().startswith(EXPLAINED):
+            continue
+        for kind, table in sorted(problems(explain(sql), sql)):
+            key = f"{kind} {table}"
+            if key not in found:
+                columns = index_hint(sql, table) if kind == "full scan" else []
+                rows = row_count(table) if table != "?" else 0
+                found[key] = {"sql": sql, "rows": rows, "columns": columns}
+    return found
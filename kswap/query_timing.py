@@ -0,0 +1,153 @@
+# Measuring where the time goes in each request
+# QueryTimingMiddleware records every SQL query a request makes and how long
+# it took, and how long the templates took to draw, and sends the numbers
+# back in a Server-Timing header which the browser's developer tools show
+# in the Network tab (under Timing).  It also counts duplicate queries: the
+# same SQL run again and again with different values is usually a loop that
+# asks for one row at a time (an "N+1" query) which could be one query.
+#
+# Requests slower than QUERY_TIMING_SLOW_MS, or with more than
+# QUERY_TIMING_MAX_DUPLICATES duplicates, are written to the log with the
+# slowest and most repeated SQL.  Only QUERY_TIMING_SAMPLE_RATE of them
+# are logged so a busy site doesn't fill its log.
+#
+# It is only switched on with QUERY_TIMING = True in settings.py.  When it
+# is off the middleware removes itself when the site starts (by raising
+# MiddlewareNotUsed), so it costs nothing at all
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import Template
+
+logger = logging.getLogger(__name__)
+
+# the longest piece of SQL put in the log
+MAX_SQL_LENGTH = 500
+
+# the Timings of the request being handled, if it is being measured
+current = ContextVar("kswap_query_timing", default=None)
+
+
+class Timings:
+    def __init__(self):
+        # (sql, milliseconds) for every query
+        self.queries = []
+        self.template_ms = 0.0
+        # more than zero while a template is being drawn
+        self.rendering = 0
+
+    def db_ms(self):
+        return sum(ms for sql, ms in self.queries)
+
+    # the same SQL run more than once: {sql: times run}
+    def repeated(self):
+        counts = Counter(sql for sql, ms in self.queries)
+        return {sql: count for sql, count in counts.items() if count > 1}
+
+    def duplicates(self):
+        return sum(count - 1 for count in self.repeated().values())
+
+
+def record_queries(timings):
+    def wrapper(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings.queries.append((sql, (time.perf_counter() - started) * 1000))
+
+    return wrapper
+
+
+# Wraps Template.render to add up the time spent drawing templates.  Pages
+# often run queries while they are drawn (a {% for %} over a queryset), and
+# that time is already counted as database time, so it is taken off
+def timed(render):
+    @wraps(render)
+    def timed_render(self, context=None, request=None):
+        timings = current.get()
+        if timings is None or timings.rendering:
+            return render(self, context, request)
+        timings.rendering += 1
+        started = time.perf_counter()
+        db_before = timings.db_ms()
+        try:
+            return render(self, context, request)
+        finally:
+            timings.rendering -= 1
+            took = (time.perf_counter() - started) * 1000
+            timings.template_ms += took - (timings.db_ms() - db_before)
+
+    timed_render.is_timed = True
+    return timed_render
+
+
+def server_timing(timings, total_ms):
+    return ", ".join(
+        [
+            f'db;dur={timings.db_ms():.1f};desc="{len(timings.queries)} queries"',
+            f'dup;desc="{timings.duplicates()} duplicate queries"',
+            f"tpl;dur={timings.template_ms:.1f}",
+            f"total;dur={total_ms:.1f}",
+        ]
+    )
+
+
+# Long SQL is mostly the list of columns, which says little about where
+# the query came from, so that is left out first
+def shorten(sql):
+    if len(sql) > MAX_SQL_LENGTH:
+        sql = re.sub(r"^SELECT .*? FROM ", "SELECT ... FROM ", sql, count=1)
+    return sql if len(sql) <= MAX_SQL_LENGTH else sql[:MAX_SQL_LENGTH] + "..."
+
+
+def log_slow_request(request, timings, total_ms):
+    slow = total_ms >= getattr(settings, "QUERY_TIMING_SLOW_MS", 500)
+    repeated = timings.duplicates() > getattr(settings, "QUERY_TIMING_MAX_DUPLICATES", 10)
+    if not (slow or repeated) or random.random() >= getattr(settings, "QUERY_TIMING_SAMPLE_RATE", 0.1):
+        return
+    match = request.resolver_match
+    lines = [
+        f"{request.method} {request.path} ({match.view_name if match else 'no view'}) took {total_ms:.0f} ms:"
+        f" {len(timings.queries)} queries in {timings.db_ms():.0f} ms,"
+        f" {timings.duplicates()} duplicates, templates {timings.template_ms:.0f} ms"
+    ]
+    for sql, count in sorted(timings.repeated().items(), key=lambda item: -item[1])[:3]:
+        lines.append(f"  run {count} times: {shorten(sql)}")
+    for sql, ms in sorted(timings.queries, key=lambda query: -query[1])[:3]:
+        lines.append(f"  {ms:.1f} ms: {shorten(sql)}")
+    logger.warning("\n".join(lines))
+
+
+class QueryTimingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, "QUERY_TIMING", False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if not getattr(Template.render, "is_timed", False):
+            Template.render = timed(Template.render)
+
+    def __call__(self, request):
+        timings = Timings()
+        token = current.set(timings)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_queries(timings)))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        total_ms = (time.perf_counter() - started) * 1000
+        response["Server-Timing"] = server_timing(timings, total_ms)
+        log_slow_request(request, timings, total_ms)
+        return response
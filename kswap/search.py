@@ -0,0 +1,111 @@
+# Keyword search over the address, city and description of each property
+# The search index is a separate table which the database itself knows how
+# to search quickly:
+#   - on SQLite it is an FTS5 virtual table
+#   - on Postgres it is a table of tsvector documents with a GIN index
+# Both are created by migration 0011.  The signals in models.py keep it up to
+# date and the rebuild_search_index management command builds it from scratch
+import re
+
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+SQLITE_TABLE = "kswap_property_fts"
+POSTGRES_TABLE = "kswap_property_search"
+
+# the most homes a search for the nearest homes to a place returns
+MAX_RESULTS = 1000
+
+
+def words_in(text):
+    return re.findall(r"\w+", text.lower())
+
+
+# Turns what the user typed into an FTS5 query.  Each word is put in quotes
+# so characters like " or - can't break the query syntax, and the * lets
+# "kosh" find "kosher".  Words next to each other must all match
+def sqlite_query(text):
+    return " ".join(f'"{word}"*' for word in words_in(text))
+
+
+def index_property(property):
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                f"""INSERT INTO {POSTGRES_TABLE} (property_id, document)
+                VALUES (%s, setweight(to_tsvector('english', %s), 'A')
+                         || setweight(to_tsvector('english', %s), 'B')
+                         || setweight(to_tsvector('english', %s), 'C'))
+                ON CONFLICT (property_id) DO UPDATE SET document = EXCLUDED.document""",
+                [property.id, property.city, property.address, property.home_description],
+            )
+        else:
+            cursor.execute(f"DELETE FROM {SQLITE_TABLE} WHERE rowid = %s", [property.id])
+            cursor.execute(
+                f"INSERT INTO {SQLITE_TABLE} (rowid, city, address, home_description) VALUES (%s, %s, %s, %s)",
+                [property.id, property.city, property.address, property.home_description],
+            )
+
+
+def remove_property(property_id):
+    with connection.cursor() as cursor:
+        table = POSTGRES_TABLE if connection.vendor == "postgresql" else SQLITE_TABLE
+        column = "property_id" if connection.vendor == "postgresql" else "rowid"
+        cursor.execute(f"DELETE FROM {table} WHERE {column} = %s", [property_id])
+
+
+# Returns the ids of the properties that match, best match first
+# A match in the city counts for more than one in the address, and that
+# counts for more than one in the description.  Every match is returned
+# unless a limit is given: the search page combines them with its other
+# filters afterwards, and cutting them off first would lose homes that
+# match everything and make the counts wrong
+def ranked_ids(text, limit=None):
+    if not words_in(text):
+        return []
+    # LIMIT NULL on Postgres and LIMIT -1 on SQLite are no limit
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                f"""SELECT property_id FROM {POSTGRES_TABLE}, websearch_to_tsquery('english', %s) query
+                WHERE document @@ query
+                ORDER BY ts_rank(document, query) DESC, property_id
+                LIMIT %s""",
+                [text, limit],
+            )
+        else:
+            # bm25 gives better matches a lower score
+            cursor.execute(
+                f"""SELECT rowid FROM {SQLITE_TABLE}
+                WHERE {SQLITE_TABLE} MATCH %s
+                ORDER BY bm25({SQLITE_TABLE}, 10.0, 5.0, 1.0), rowid
+                LIMIT %s""",
+                [sqlite_query(text), -1 if limit is None else limit],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+# The ids of the properties that match, as a subquery to use with id__in,
+# so the database combines the keyword search with the other filters itself
+# instead of being sent a list of thousands of ids
+def matching(text):
+    if not words_in(text):
+        return []
+    if connection.vendor == "postgresql":
+        return RawSQL(
+            f"SELECT property_id FROM {POSTGRES_TABLE} WHERE document @@ websearch_to_tsquery('english', %s)", [text]
+        )
+    return RawSQL(f"SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s", [sqlite_query(text)])
+
+
+# Empties the index and adds every property in the queryset again
+def rebuild(properties):
+    table = POSTGRES_TABLE if connection.vendor == "postgresql" else SQLITE_TABLE
+    count = 0
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table}")
+        for property in properties.only("id", "city", "address", "home_description").iterator(chunk_size=2000):
+            index_property(property)
+            count += 1
+    return count
@@ -0,0 +1,178 @@
+# A cache of the results of the property search page
+# Lots of visitors make exactly the same search (the same dates in the
+# school holidays, the same town...) and each of them used to be worked out
+# from scratch.  Now the results of a search are kept, under a key made from
+# the search with the filters in a fixed order, so two links with the same
+# filters in a different order share one entry.  What is kept is everything
+# PropertyListView works out before drawing a page: the matching homes in
+# order, the counts next to each filter and the distances for a "near"
+# search.  The homes are kept as the matching bitmap (see facets.py), which
+# is the list of ids in id order but much smaller, plus the ids in their
+# order for keyword, near and rating searches.
+#
+# Nothing is ever deleted from the cache when a home or a booking changes.
+# Instead there are two generation numbers, one for properties and one for
+# bookings, which the signals in models.py add one to, and they are part of
+# the key.  After a change the old entries are simply never asked for again
+# and run out after SEARCH_CACHE_TIMEOUT seconds.  Only searches with dates
+# use the booking number, so a new booking doesn't throw away every search.
+#
+# There are two layers:
+#   - Django's cache (see CACHES in settings.py).  With the default
+#     local memory cache every web server process has its own, generation
+#     numbers included, so a change made through one process wouldn't be
+#     seen by the others until their entries ran out.  So the search cache
+#     is off unless CACHES is one every process shares (memcached, redis or
+#     the database) or SEARCH_CACHE_TIMEOUT is set - see timeout()
+#   - in front of it a small least-recently-used dict in this process
+#     (SEARCH_CACHE_LOCAL_SIZE entries) which saves unpickling the results.
+#     The generation numbers are still read from Django's cache for every
+#     search, so it never gives out results another process has changed
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "kswap:search:generation:%s"
+RESULTS_KEY = "kswap:search:results:%s"
+# how often the hit ratio is written to the log
+LOG_EVERY = 1000
+
+_local = OrderedDict()
+_lock = threading.Lock()
+# the lookups made by this process: "local" and "shared" hits, and misses
+metrics = Counter()
+
+
+# the caches that every process has its own copy of, or that keep nothing
+PER_PROCESS_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def shared_cache():
+    return settings.CACHES["default"]["BACKEND"] not in PER_PROCESS_CACHES
+
+
+def timeout():
+    configured = getattr(settings, "SEARCH_CACHE_TIMEOUT", None)
+    if configured is not None:
+        return configured
+    return 300 if shared_cache() else 0
+
+
+def local_size():
+    return getattr(settings, "SEARCH_CACHE_LOCAL_SIZE", 100)
+
+
+# A generation that has gone missing from the cache (it was evicted, or the
+# cache was restarted) starts again from the time, never from a number that
+# could have been used before
+def new_generation():
+    return time.time_ns()
+
+
+def generations(kinds):
+    keys = [GENERATION_KEY % kind for kind in kinds]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, new_generation(), None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(kind):
+    key = GENERATION_KEY % kind
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, new_generation(), None)
+
+
+# Called when something that changes search results is saved, with "property"
+# or "booking".  It is done straight away, and again when the transaction
+# commits in case another request cached the old results in between
+def changed(kind):
+    bump(kind)
+    transaction.on_commit(lambda: bump(kind))
+
+
+# The cache key for a search.  params is a dict of everything that changes
+# the results, already read from the request
+def key_for(params, kinds):
+    text = json.dumps(params, sort_keys=True, default=str)
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    stamp = "-".join(str(generation) for generation in generations(kinds))
+    return RESULTS_KEY % f"{stamp}:{digest}"
+
+
+def count(kind):
+    metrics[kind] += 1
+    lookups = metrics["local"] + metrics["shared"] + metrics["miss"]
+    if lookups % LOG_EVERY == 0:
+        logger.info("Search cache: %s", stats())
+
+
+# The results for a search, from the cache if they are there and otherwise
+# from work(), which are then saved.  Searches that depend on the bookings
+# (the ones with dates) pass dated=True
+def get_or_work(params, work, dated=False):
+    if not timeout():
+        return work()
+    key = key_for(params, ["property", "booking"] if dated else ["property"])
+
+    now = time.monotonic()
+    with _lock:
+        entry = _local.get(key)
+        if entry is not None and entry[0] > now:
+            _local.move_to_end(key)
+            count("local")
+            return entry[1]
+
+    results = cache.get(key)
+    if results is None:
+        count("miss")
+        results = work()
+        cache.set(key, results, timeout())
+    else:
+        count("shared")
+    remember(key, results, now + timeout())
+    return results
+
+
+def remember(key, results, expires):
+    if not local_size():
+        return
+    with _lock:
+        _local[key] = (expires, results)
+        _local.move_to_end(key)
+        while len(_local) > local_size():
+            _local.popitem(last=False)
+
+
+def clear_local():
+    with _lock:
+        _local.clear()
+
+
+# The numbers of lookups so far in this process and the share that were hits
+def stats():
+    lookups = metrics["local"] + metrics["shared"] + metrics["miss"]
+    hits = metrics["local"] + metrics["shared"]
+    return {
+        "lookups": lookups,
+        "local_hits": metrics["local"],
+        "shared_hits": metrics["shared"],
+        "misses": metrics["miss"],
+        "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+    }
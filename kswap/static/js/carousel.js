@@ -0,0 +1,76 @@
+// The picture carousel on the property detail page
+// It used to be slick-carousel, loaded with jQuery from two CDNs on every
+// detail page.  The page only used it to show one picture at a time with
+// dots under it, so this does the same in plain JavaScript.  The sliding
+// itself is the browser's scroll snapping (see .carousel in styles.css), so
+// the pictures can be swiped before this has run, or if it never does.
+// This adds:
+//   - a dot for each picture, the dot of the picture shown is darker
+//   - the height of the carousel follows the picture shown, like slick's
+//     adaptiveHeight, so a short picture has no gap under it
+//   - the left and right arrow keys, going round from the last picture to
+//     the first like slick's infinite
+(function () {
+  function setUp(carousel) {
+    var slides = carousel.children;
+    if (slides.length < 2) {
+      return;
+    }
+    var dots = document.createElement("ul");
+    dots.className = "carousel-dots";
+    for (var i = 0; i < slides.length; i++) {
+      var dot = document.createElement("li");
+      var button = document.createElement("button");
+      button.type = "button";
+      button.setAttribute("aria-label", "Picture " + (i + 1) + " of " + slides.length);
+      button.addEventListener("click", show.bind(null, i));
+      dot.appendChild(button);
+      dots.appendChild(dot);
+    }
+    carousel.after(dots);
+    carousel.tabIndex = 0;
+
+    function current() {
+      return Math.round(carousel.scrollLeft / carousel.clientWidth);
+    }
+
+    function show(number) {
+      carousel.scrollTo({ left: number * carousel.clientWidth });
+    }
+
+    function update() {
+      var number = current();
+      for (var i = 0; i < dots.children.length; i++) {
+        dots.children[i].firstChild.classList.toggle("active", i === number);
+      }
+      carousel.style.height = slides[number].offsetHeight + "px";
+    }
+
+    // scroll events come many times a second, the page is only updated
+    // once per frame
+    var waiting = false;
+    carousel.addEventListener("scroll", function () {
+      if (!waiting) {
+        waiting = true;
+        requestAnimationFrame(function () {
+          waiting = false;
+          update();
+        });
+      }
+    });
+    // a picture without a width and height on its <img> only has a height
+    // once it has loaded.  load doesn't bubble, so it is caught on the way down
+    carousel.addEventListener("load", update, true);
+    window.addEventListener("resize", update);
+    carousel.addEventListener("keydown", function (event) {
+      if (event.key === "ArrowRight" || event.key === "ArrowLeft") {
+        var step = event.key === "ArrowRight" ? 1 : -1;
+        show((current() + step + slides.length) % slides.length);
+        event.preventDefault();
+      }
+    });
+    update();
+  }
+
+  document.querySelectorAll(".carousel").forEach(setUp);
+})();
@@ -1,3 +1,2017 @@
-from django.test import TestCase
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from cities_light.models import City, Country
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import serializers
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.forms.models import model_to_dict
+from django.http import HttpResponse
+from django.templatetags.static import static
+from django.test import AsyncClient, AsyncRequestFactory, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image as PillowImage
+
+from . import (
+    availability,
+    expiry,
+    exports,
+    facets,
+    geo,
+    history,
+    matching,
+    models,
+    property_import,
+    query_plans,
+    search,
+    search_cache,
+    uploads,
+    variants,
+)
+from .history import NavigationHistoryMiddleware
+from .management.seed import make_property, seed
+from .models import (
+    BadgeCounts,
+    Booking,
+    ExpiryRun,
+    FACET_CHUNK_BITS,
+    FacetBitmap,
+    Image,
+    ImageUpload,
+    Kashrut,
+    OccupiedDay,
+    Profile,
+    Property,
+    PropertyImport,
+    RequestProfile,
+    Review,
+    SiteCounter,
+    SwapMatch,
+    SwapWish,
+    rebuild_ratings,
+)
+
+
+# the pages are drawn without running collectstatic first
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search_cache.clear_local()
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.home = make_property(self.owner, 0)
+        self.home.save()
+        self.guest_home = make_property(self.guest, 1)
+        self.guest_home.save()
+        self.free_home = make_property(self.owner, 2)
+        self.free_home.save()
+
+    def book(self, start, end, status="pending"):
+        return Booking.objects.create(
+            user=self.guest,
+            property=self.home,
+            my_property=self.guest_home,
+            date_from=start,
+            date_to=end,
+            status=status,
+        )
+
+    def search(self, start, end):
+        params = {"start_date": start.isoformat(), "end_date": end.isoformat()}
+        response = self.client.get(reverse("property_search"), params)
+        return {home.id for home in response.context["property_list"]}
+
+    def test_both_homes_of_a_swap_are_taken_on_every_night(self):
+        self.book(date(2030, 7, 3), date(2030, 7, 5))
+        self.assertEqual(OccupiedDay.objects.filter(property=self.home).count(), 3)
+        self.assertEqual(OccupiedDay.objects.filter(property=self.guest_home).count(), 3)
+        # the first and last days of the booking are both in use
+        self.assertEqual(self.search(date(2030, 7, 5), date(2030, 7, 9)), {self.free_home.id})
+        self.assertEqual(self.search(date(2030, 7, 1), date(2030, 7, 3)), {self.free_home.id})
+        self.assertEqual(
+            self.search(date(2030, 7, 6), date(2030, 7, 9)), {self.home.id, self.guest_home.id, self.free_home.id}
+        )
+
+    def test_declining_a_booking_frees_its_days(self):
+        booking = self.book(date(2030, 7, 3), date(2030, 7, 5), status="accepted")
+        self.assertEqual(
+            set(availability.unavailable_property_ids(date(2030, 7, 1), date(2030, 7, 31))),
+            {self.home.id, self.guest_home.id},
+        )
+        booking.status = "declined"
+        booking.save()
+        self.assertFalse(OccupiedDay.objects.exists())
+        self.assertEqual(len(self.search(date(2030, 7, 1), date(2030, 7, 31))), 3)
+
+    def test_rebuild_writes_the_days_of_the_active_bookings_again(self):
+        self.book(date(2030, 7, 3), date(2030, 7, 5))
+        self.book(date(2030, 8, 1), date(2030, 8, 1), status="declined")
+        expected = set(OccupiedDay.objects.values_list("property_id", "booking_id", "day"))
+        # bookings loaded in bulk don't send post_save
+        OccupiedDay.objects.all().delete()
+        self.assertEqual(availability.rebuild(batch_size=2), (6, []))
+        self.assertEqual(set(OccupiedDay.objects.values_list("property_id", "booking_id", "day")), expected)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class DoubleBookingTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.home = make_property(self.owner, 0)
+        self.home.save()
+        self.guests = []
+        for number in range(1, 3):
+            guest = User.objects.create_user(f"guest{number}", password="password")
+            guest.home = make_property(guest, number)
+            guest.home.save()
+            self.guests.append(guest)
+
+    def book(self, guest, status="pending"):
+        return Booking.objects.create(
+            user=guest,
+            property=self.home,
+            my_property=guest.home,
+            date_from=date(2030, 7, 1),
+            date_to=date(2030, 7, 7),
+            status=status,
+        )
+
+    def test_booking_page_refuses_days_that_are_taken(self):
+        self.book(self.guests[0])
+        self.client.login(username="guest2", password="password")
+        response = self.client.post(
+            reverse("property_book", args=[self.home.id]),
+            {"date_from": "2030-07-05", "date_to": "2030-07-10", "my_property": self.guests[1].home.id},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("already booked", str(response.context["form"].non_field_errors()))
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_accepting_a_declined_booking_whose_days_were_taken(self):
+        declined = self.book(self.guests[0], status="declined")
+        self.book(self.guests[1])
+        self.client.login(username="owner", password="password")
+        response = self.client.post(reverse("pending_bookings"), {"booking_id": declined.id, "action": "accept"})
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("already booked", response.context["error"])
+        declined.refresh_from_db()
+        self.assertEqual(declined.status, "declined")
+
+        response = self.client.patch(
+            reverse("api_booking", args=[declined.id]),
+            json.dumps({"status": "accepted"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 409)
+        declined.refresh_from_db()
+        self.assertEqual(declined.status, "declined")
+        self.assertEqual(OccupiedDay.objects.filter(booking=declined).count(), 0)
+
+    def test_admin_shows_taken_days_as_a_form_error(self):
+        declined = self.book(self.guests[0], status="declined")
+        self.book(self.guests[1])
+        User.objects.create_superuser("staff", password="password")
+        self.client.login(username="staff", password="password")
+        url = reverse("admin:kswap_booking_change", args=[declined.id])
+        data = {
+            "user": declined.user_id,
+            "property": declined.property_id,
+            "my_property": declined.my_property_id,
+            "date_from": "2030-07-01",
+            "date_to": "2030-07-07",
+            "status": "accepted",
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("already booked", str(response.context["adminform"].form.non_field_errors()))
+        declined.refresh_from_db()
+        self.assertEqual(declined.status, "declined")
+        self.assertFalse(OccupiedDay.objects.filter(booking=declined).exists())
+
+        # with free days it is saved, with its days
+        response = self.client.post(url, {**data, "date_from": "2030-08-01", "date_to": "2030-08-03"})
+        self.assertRedirects(response, reverse("admin:kswap_booking_changelist"), fetch_redirect_response=False)
+        self.assertEqual(OccupiedDay.objects.filter(booking=declined).count(), 6)
+
+    def test_only_the_owner_can_accept(self):
+        booking = self.book(self.guests[0])
+        self.client.login(username="guest2", password="password")
+        response = self.client.post(reverse("pending_bookings"), {"booking_id": booking.id, "action": "accept"})
+        self.assertEqual(response.status_code, 404)
+        booking.refresh_from_db()
+        self.assertEqual(booking.status, "pending")
+
+    def test_rebuild_reports_clashing_bookings(self):
+        first = self.book(self.guests[0])
+        # bookings loaded in bulk don't go through reserve()
+        OccupiedDay.objects.all().delete()
+        second = self.book(self.guests[1])
+        created, clashes = availability.rebuild()
+        self.assertEqual(clashes, [second.id])
+        self.assertEqual(created, OccupiedDay.objects.count())
+        self.assertEqual(
+            set(OccupiedDay.objects.filter(property=self.home).values_list("booking", flat=True)), {first.id}
+        )
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search_cache.clear_local()
+        self.owner = User.objects.create_user("owner", password="password")
+
+    def add(self, number, **fields):
+        home = make_property(self.owner, number, **fields)
+        home.save()
+        return home
+
+    def test_counts_follow_the_filters_and_changes(self):
+        london = self.add(0, country="GB", city="London", succah=True)
+        self.add(1, country="GB", city="Manchester", succah=False)
+        self.add(2, country="IL", city="Jerusalem", succah=True)
+        matching, counts = facets.count_facets({"country": "GB"})
+        self.assertEqual(matching.bit_count(), 2)
+        self.assertEqual(counts["succah"], {"true": 1, "false": 1})
+        self.assertEqual(counts["country"]["IL"], 0)
+
+        london.city = "Paris"
+        london.country = "FR"
+        london.save()
+        matching, counts = facets.count_facets({"succah": True})
+        self.assertEqual(counts["city"]["London"], 0)
+        self.assertEqual(counts["city"]["Paris"], 1)
+        self.assertEqual(counts["country"], {"GB": 0, "IL": 1, "FR": 1})
+
+        kashrut = Kashrut.objects.create(name="Beth Din")
+        profile = Profile.objects.get(user=self.owner)
+        profile.kashrut = kashrut
+        profile.save()
+        self.assertEqual(facets.count_facets({"kashrut": kashrut.id})[0].bit_count(), 3)
+
+    def test_homes_far_apart_are_kept_in_chunks_and_rebuild_gives_the_same(self):
+        near = self.add(0, country="GB", city="London")
+        far = self.add(1, id=FACET_CHUNK_BITS * 2 + 5, country="GB", city="London")
+        self.assertEqual(
+            set(FacetBitmap.objects.filter(facet="city", value="London").values_list("chunk", "count")),
+            {(0, 1), (2, 1)},
+        )
+        # no row is bigger than a chunk
+        for bitmap in FacetBitmap.objects.all():
+            self.assertLessEqual(len(bitmap.bits), FACET_CHUNK_BITS // 8)
+        before = facets.count_facets({"city": "London"})
+        self.assertEqual(facets.ids_in_bitmap(before[0], 0, 10), [near.id, far.id])
+        facets.rebuild()
+        self.assertEqual(facets.count_facets({"city": "London"}), before)
+
+        far.delete()
+        self.assertEqual(facets.count_facets({"city": "London"})[0].bit_count(), 1)
+
+    @override_settings(FACET_CITY_OPTIONS=2)
+    def test_only_the_biggest_cities_and_the_chosen_one_are_read(self):
+        for number, city in enumerate(["London", "London", "London", "Paris", "Paris", "Rome"]):
+            self.add(number, city=city)
+        matching, counts = facets.count_facets({})
+        self.assertEqual(set(counts["city"]), {"London", "Paris"})
+        self.assertEqual(matching.bit_count(), 6)
+
+        with CaptureQueriesContext(connection) as queries:
+            matching, counts = facets.count_facets({"city": "Rome"})
+        self.assertEqual(counts["city"], {"London": 0, "Paris": 0, "Rome": 1})
+        self.assertEqual(matching.bit_count(), 1)
+        self.assertEqual(len(queries), 2)
+
+    def test_search_pages_through_the_matching_homes(self):
+        homes = [self.add(number, country="GB" if number % 2 else "IL") for number in range(50)]
+        gb = [home.id for home in homes if home.country == "GB"]
+        response = self.client.get(reverse("property_search"), {"country": "GB"})
+        self.assertEqual([home.id for home in response.context["property_list"]], gb[:20])
+        self.assertEqual(response.context["paginator"].count, 25)
+        response = self.client.get(reverse("property_search"), {"country": "GB", "page": "2"})
+        self.assertEqual([home.id for home in response.context["property_list"]], gb[20:])
+
+        # a keyword or near search gives the order
+        matching, counts = facets.count_facets({"country": "GB"})
+        results = facets.FacetResults(matching, Property.objects.all(), [gb[3], homes[0].id, gb[1]])
+        self.assertEqual(results.count(), 2)
+        self.assertEqual([home.id for home in results[0:20]], [gb[3], gb[1]])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class KeywordSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search_cache.clear_local()
+        owner = User.objects.create_user("owner", password="password")
+        # more homes with the word than the keyword search used to return,
+        # and the ones in Israel are the last of them
+        homes = [make_property(owner, number, country="GB") for number in range(1100)]
+        homes += [make_property(owner, number, country="IL", city="Jerusalem") for number in range(1100, 1105)]
+        Property.objects.bulk_create(homes)
+        search.rebuild(Property.objects.all())
+        facets.rebuild()
+
+    def test_every_match_is_combined_with_the_filters(self):
+        response = self.client.get(reverse("property_search"), {"q": "shul", "country": "IL"})
+        self.assertEqual(response.context["paginator"].count, 5)
+        response = self.client.get(reverse("property_search"), {"q": "shul"})
+        country = next(facet for facet in response.context["facets"] if facet["name"] == "country")
+        self.assertEqual({option["value"]: option["count"] for option in country["options"]}, {"GB": 1100, "IL": 5})
+
+    def test_best_rated_keyword_matches(self):
+        best = Property.objects.filter(country="IL").first()
+        Property.objects.filter(id=best.id).update(rating=5, rating_count=1, rating_sum=5)
+        response = self.client.get(reverse("property_search"), {"q": "shul", "sort": "rating", "country": "IL"})
+        self.assertEqual(response.context["property_list"][0].id, best.id)
+        self.assertEqual(response.context["paginator"].count, 5)
+        everything = search.ranked_ids("shul")
+        self.assertEqual(len(everything), 1105)
+        self.assertEqual(search.ranked_ids("shul", limit=3), everything[:3])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class GeoTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user("owner", password="password")
+        # homes going north from Manchester, about 11 km apart, and one in Jerusalem
+        points = [(53.48 + number / 10, -2.24) for number in range(10)] + [(31.77, 35.21)]
+        homes = []
+        for number, (latitude, longitude) in enumerate(points):
+            home = make_property(owner, number, latitude=latitude, longitude=longitude)
+            home.geo_cell = geo.grid_cell(latitude, longitude)
+            homes.append(home)
+        self.homes = Property.objects.bulk_create(homes)
+
+    def test_within(self):
+        found = geo.within(Property.objects.all(), 53.48, -2.24, 30)
+        self.assertEqual([property_id for property_id, km in found], [home.id for home in self.homes[:3]])
+        self.assertEqual([round(km) for property_id, km in found], [0, 11, 22])
+
+    def test_within_is_no_bigger_than_max_km(self):
+        found = geo.within(Property.objects.all(), 53.48, -2.24, 20000)
+        self.assertEqual(len(found), 10)
+        self.assertTrue(all(km <= geo.MAX_KM for property_id, km in found))
+
+    def test_near_the_pole_the_circle_is_made_smaller(self):
+        km = geo.bounded_km(89.9, 0, 200)
+        self.assertLess(km, 200)
+        self.assertLessEqual(geo.cell_count(geo.cell_ranges(89.9, 0, km)), geo.MAX_CELLS)
+
+    def test_nearest(self):
+        found = geo.nearest(Property.objects.all(), 53.7, -2.24, 3)
+        self.assertEqual(
+            [property_id for property_id, km in found], [self.homes[2].id, self.homes[3].id, self.homes[1].id]
+        )
+
+    def test_locating_the_homes_clears_the_cached_searches(self):
+        before = search_cache.generations(["property"])
+        call_command("locate_properties", stdout=StringIO())
+        self.assertNotEqual(search_cache.generations(["property"]), before)
+
+    def test_nearest_stops_at_max_cells(self):
+        # Jerusalem is thousands of km away, too far for the biggest circle
+        found = geo.nearest(Property.objects.all(), 53.48, -2.24, 20)
+        self.assertEqual(len(found), 10)
+        self.assertNotIn(self.homes[-1].id, [property_id for property_id, km in found])
+
+
+@override_settings(IMAGE_WORKERS=0, STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        # the pictures and their copies are saved in a folder that is thrown away
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        owner = User.objects.create_user("owner", password="password")
+        self.home = make_property(owner, 0)
+        self.home.save()
+
+    # saves a picture and makes its copies the way the on_commit callback does
+    def upload(self, width, height, exif=None):
+        data = BytesIO()
+        PillowImage.new("RGB", (width, height), "red").save(data, "JPEG", exif=exif or PillowImage.Exif())
+        image = Image(property=self.home)
+        with self.captureOnCommitCallbacks(execute=True):
+            image.image.save("photo.jpg", ContentFile(data.getvalue()))
+        image.refresh_from_db()
+        return image
+
+    def test_copies_are_made_in_every_width_and_format(self):
+        image = self.upload(1600, 1000)
+        self.assertTrue(image.processed)
+        self.assertEqual((image.width, image.height), (1600, 1000))
+        copies = sorted(image.variants.values_list("format", "width", "height"))
+        self.assertEqual(
+            copies,
+            [("jpeg", 400, 250), ("jpeg", 800, 500), ("jpeg", 1200, 750)]
+            + [("webp", 400, 250), ("webp", 800, 500), ("webp", 1200, 750)],
+        )
+        for variant in image.variants.all():
+            with PillowImage.open(variant.file.path) as picture:
+                self.assertEqual(picture.size, (variant.width, variant.height))
+                self.assertEqual(picture.format, variant.format.upper())
+                # no EXIF data is copied
+                self.assertFalse(picture.getexif())
+
+    def test_small_picture_gets_a_copy_of_its_own_size(self):
+        image = self.upload(500, 300)
+        self.assertEqual(sorted(set(image.variants.values_list("width", flat=True))), [400, 500])
+
+    def test_sideways_photo_is_turned(self):
+        exif = PillowImage.Exif()
+        # orientation 6 means the camera was turned a quarter of the way round
+        exif[0x0112] = 6
+        image = self.upload(800, 400, exif)
+        self.assertEqual((image.width, image.height), (400, 800))
+        self.assertEqual(image.variants.get(format="jpeg", width=400).height, 800)
+
+    def test_making_copies_again_replaces_them(self):
+        image = self.upload(900, 600)
+        self.assertEqual(variants.make_variants(image), 6)
+        self.assertEqual(image.variants.count(), 6)
+        # the old files were deleted, so the new ones got the same names
+        folder = os.path.dirname(image.variants.first().file.path)
+        self.assertEqual(sorted(os.listdir(folder)), sorted(v.file.name.split("/")[-1] for v in image.variants.all()))
+
+    def test_srcset_and_fallback_on_the_detail_page(self):
+        image = self.upload(1600, 1000)
+        webp = image.webp_srcset()
+        self.assertEqual([part.split()[1] for part in webp.split(", ")], ["400w", "800w", "1200w"])
+        self.assertTrue(all(part.split()[0].endswith(".webp") for part in webp.split(", ")))
+        self.assertEqual(image.fallback().width, 800)
+        page = self.client.get(reverse("property_detail", args=[self.home.id])).content.decode()
+        self.assertIn(f'srcset="{webp}"', page)
+        self.assertIn(f'srcset="{image.jpeg_srcset()}"', page)
+        self.assertIn(f'src="{image.fallback().file.url}"', page)
+
+
+@override_settings(IMAGE_WORKERS=0, STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        # the pieces and the pictures are saved in a folder that is thrown away
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.upload_dir = os.path.join(folder.name, "uploads")
+        settings = self.settings(MEDIA_ROOT=folder.name, CHUNKED_UPLOAD_DIR=self.upload_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create_user("owner", password="password")
+        self.client.login(username="owner", password="password")
+        data = BytesIO()
+        PillowImage.new("RGB", (300, 200), "blue").save(data, "JPEG")
+        self.picture = data.getvalue()
+
+    def start(self):
+        response = self.client.post(
+            reverse("image_upload_start"), {"filename": "../front door.jpg", "size": len(self.picture)}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def send(self, url, offset, piece):
+        return self.client.patch(
+            url, piece, content_type="application/octet-stream", headers={"Upload-Offset": str(offset)}
+        )
+
+    def upload(self):
+        started = self.start()
+        half = len(self.picture) // 2
+        self.assertEqual(self.send(started["url"], 0, self.picture[:half]).json()["offset"], half)
+        self.assertEqual(self.send(started["url"], half, self.picture[half:]).json()["complete"], True)
+        return started["id"]
+
+    # the fields of the registration form for a new home
+    def form(self, **fields):
+        home = make_property(self.user, 0)
+        data = {
+            name: value for name, value in model_to_dict(home, exclude=("id", "owner")).items() if value is not None
+        }
+        data["country"] = str(home.country)
+        data.update(fields)
+        return data
+
+    def test_pieces_are_put_together_and_a_lost_piece_is_sent_again(self):
+        started = self.start()
+        upload = ImageUpload.objects.get(id=started["id"])
+        self.assertEqual(upload.filename, "front_door.jpg")
+        self.send(started["url"], 0, self.picture[:100])
+        # the reply to the second piece was lost, so the page asks where to carry on from
+        response = self.send(started["url"], 50, self.picture[50:200])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 100)
+        self.assertEqual(self.client.get(started["url"]).json()["offset"], 100)
+        response = self.send(started["url"], 100, self.picture[100:])
+        self.assertEqual(
+            response.json(),
+            {"id": started["id"], "offset": len(self.picture), "size": len(self.picture), "complete": True},
+        )
+        upload.refresh_from_db()
+        self.assertEqual(upload.sha256, hashlib.sha256(self.picture).hexdigest())
+        with open(upload.path(), "rb") as file:
+            self.assertEqual(file.read(), self.picture)
+
+    def test_a_file_that_is_not_a_picture_is_thrown_away(self):
+        self.picture = b"not a picture" * 10
+        started = self.start()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.send(started["url"], 0, self.picture)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImageUpload.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_registration_attaches_the_uploads(self):
+        upload_id = self.upload()
+        # the same picture twice is only added once
+        again = self.upload()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("property_registration"), self.form(uploads=[upload_id, again]))
+        self.assertRedirects(response, reverse("home"), fetch_redirect_response=False)
+        image = Image.objects.get(property__owner=self.user)
+        self.assertTrue(image.processed)
+        self.assertEqual(image.image.read(), self.picture)
+        self.assertFalse(ImageUpload.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_an_upload_id_that_is_not_a_uuid_is_a_form_error(self):
+        response = self.client.post(reverse("property_registration"), self.form(uploads=["not-a-uuid"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Some of the pictures could not be found", response.content.decode())
+        self.assertFalse(Property.objects.exists())
+
+    def test_no_property_is_saved_if_the_pictures_are_not(self):
+        upload_id = self.upload()
+        with mock.patch.object(uploads.default_storage, "save", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError), self.assertLogs("django.request", "ERROR"):
+                self.client.post(reverse("property_registration"), self.form(uploads=[upload_id]))
+        self.assertFalse(Property.objects.exists())
+        # the upload can be used again
+        self.assertTrue(os.path.exists(ImageUpload.objects.get(id=upload_id).path()))
+
+    def test_picture_files_are_deleted_if_the_images_are_not_saved(self):
+        upload_id = self.upload()
+        sent = SimpleUploadedFile("back.jpg", self.picture, content_type="image/jpeg")
+        with mock.patch.object(Image.objects, "bulk_create", side_effect=OperationalError("database is locked")):
+            with self.assertRaises(OperationalError), self.assertLogs("django.request", "ERROR"):
+                self.client.post(reverse("property_registration"), {**self.form(uploads=[upload_id]), "images": sent})
+        self.assertFalse(Property.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(os.path.dirname(self.upload_dir), "images")), [])
+        self.assertTrue(os.path.exists(ImageUpload.objects.get(id=upload_id).path()))
+
+    def test_only_the_last_hashes_are_kept(self):
+        with mock.patch.object(uploads, "HASHES_KEPT", 1):
+            first = self.start()
+            self.send(first["url"], 0, self.picture[:100])
+            second = self.start()
+            self.send(second["url"], 0, self.picture[:100])
+            self.assertEqual(list(uploads._hashes), [ImageUpload.objects.get(id=second["id"]).id])
+            # the first one's hash is worked out from the file instead
+            self.send(first["url"], 100, self.picture[100:])
+        self.assertEqual(ImageUpload.objects.get(id=first["id"]).sha256, hashlib.sha256(self.picture).hexdigest())
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class BadgeCountsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.home = make_property(self.owner, 1)
+        self.home.save()
+        self.guest_home = make_property(self.guest, 2)
+        self.guest_home.save()
+
+    # each booking is for a different week so they don't overlap
+    def book(self, status="pending"):
+        start = date(2030, 1, 1) + timedelta(weeks=Booking.objects.count())
+        return Booking.objects.create(
+            user=self.guest,
+            property=self.home,
+            my_property=self.guest_home,
+            date_from=start,
+            date_to=start + timedelta(days=6),
+            status=status,
+        )
+
+    def counts(self, user):
+        counts = BadgeCounts.for_user(user.id)
+        return counts.pending_requests, counts.next_escapes
+
+    def assert_counts_match_bookings(self):
+        for user in (self.owner, self.guest):
+            counted = BadgeCounts.count(user.id)
+            self.assertEqual(self.counts(user), (counted.pending_requests, counted.next_escapes))
+
+    def test_counts_follow_booking_changes(self):
+        booking = self.book()
+        self.assertEqual(self.counts(self.owner), (1, 0))
+        self.assertEqual(self.counts(self.guest), (0, 0))
+
+        booking.status = "accepted"
+        booking.save()
+        self.assertEqual(self.counts(self.owner), (0, 1))
+        self.assertEqual(self.counts(self.guest), (0, 1))
+
+        booking.status = "declined"
+        booking.save()
+        self.assertEqual(self.counts(self.owner), (0, 0))
+        self.assertEqual(self.counts(self.guest), (0, 0))
+
+        self.book(status="accepted")
+        self.book().delete()
+        self.assert_counts_match_bookings()
+
+    def test_next_escapes_page_queries_dont_grow_with_the_bookings(self):
+        self.book(status="accepted")
+        self.client.login(username="guest", password="password")
+        # the first visit saves the history and the menu numbers
+        self.client.get(reverse("your_next_escapes"))
+        with CaptureQueriesContext(connection) as one:
+            self.client.get(reverse("your_next_escapes"))
+        for _ in range(5):
+            self.book(status="accepted")
+        with CaptureQueriesContext(connection) as six:
+            response = self.client.get(reverse("your_next_escapes"))
+        self.assertEqual(len(one), len(six))
+        # for the guest, their own home is the one the owner wants
+        wanted = re.findall(r'Your Property They Want:</strong>\s*<a href="([^"]*)"', response.content.decode())
+        self.assertEqual(wanted, [reverse("property_detail", args=[self.guest_home.id])] * 6)
+
+    def test_changes_to_loaded_bookings(self):
+        self.book()
+        booking = Booking.objects.get()
+        booking.status = "accepted"
+        booking.save()
+        self.assert_counts_match_bookings()
+
+        # only() doesn't load all the fields the counts need
+        booking = Booking.objects.only("id", "status").get()
+        booking.status = "declined"
+        booking.save()
+        self.assert_counts_match_bookings()
+        booking.status = "pending"
+        booking.save(update_fields=["status"])
+        self.assertEqual(self.counts(self.owner), (1, 0))
+
+        booking = Booking.objects.only("id").get()
+        booking.delete()
+        self.assertEqual(self.counts(self.owner), (0, 0))
+        self.assert_counts_match_bookings()
+
+    def test_deleting_a_property_deletes_its_bookings_from_the_counts(self):
+        self.book(status="accepted")
+        self.counts(self.guest)
+        self.home.delete()
+        self.assertEqual(self.counts(self.guest), (0, 0))
+
+    def test_a_booking_made_while_counting_is_kept(self):
+        count = BadgeCounts.count
+
+        def count_then_book(user_id):
+            counted = count(user_id)
+            self.book()
+            return counted
+
+        with mock.patch.object(BadgeCounts, "count", side_effect=count_then_book):
+            self.assertEqual(self.counts(self.owner), (1, 0))
+        self.assert_counts_match_bookings()
+
+    def test_pending_bookings_too_late_to_accept_are_not_counted(self):
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        booking = Booking.objects.create(
+            user=self.guest,
+            property=self.home,
+            my_property=self.guest_home,
+            date_from=tomorrow,
+            date_to=tomorrow + timedelta(days=6),
+        )
+        self.book()
+        self.assertEqual(self.counts(self.owner), (1, 0))
+        booking.status = "declined"
+        booking.save()
+        self.assertEqual(self.counts(self.owner), (1, 0))
+
+    def test_numbers_counted_on_an_earlier_day_are_counted_again(self):
+        booking = self.book()
+        self.assertEqual(self.counts(self.owner), (1, 0))
+        # a day later the booking is too late to accept
+        later = timezone.now() + (booking.date_from - timezone.localdate())
+        with mock.patch.object(timezone, "now", return_value=later):
+            self.assertEqual(self.counts(self.owner), (0, 0))
+
+    def test_forget_counts_again(self):
+        self.book()
+        self.counts(self.owner)
+        Booking.objects.update(status="accepted")
+        BadgeCounts.forget([self.owner.id, self.guest.id])
+        self.assertEqual(self.counts(self.owner), (0, 1))
+
+    def test_page_draws_without_counting_bookings(self):
+        self.book()
+        self.client.login(username="owner", password="password")
+        # the first page counts the bookings and keeps the numbers
+        self.client.get(reverse("home"))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.context["pending_requests_count"], 1)
+        self.assertEqual(response.context["your_next_escapes_count"], 0)
+        sql = [query["sql"] for query in queries]
+        self.assertFalse([query for query in sql if "kswap_booking" in query])
+        # both numbers come from one lookup
+        self.assertEqual(len([query for query in sql if "kswap_badgecounts" in query]), 1)
+
+
+@override_settings(
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+    NAVIGATION_HISTORY_SIZE=3,
+)
+class NavigationHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("visitor", password="password")
+
+    def test_visitors_who_are_not_logged_in_get_no_session(self):
+        response = self.client.get(reverse("home"))
+        self.assertNotIn("sessionid", response.cookies)
+        self.assertNotIn("visited_links", response.cookies)
+        self.assertFalse(Session.objects.exists())
+
+    def test_back_link_goes_to_the_page_before(self):
+        self.client.login(username="visitor", password="password")
+        self.client.get(reverse("home"))
+        self.client.get(reverse("property_search"))
+        response = self.client.get(reverse("go_back"), HTTP_REFERER="http://testserver" + reverse("property_search"))
+        self.assertRedirects(response, reverse("home") + "?back=true", fetch_redirect_response=False)
+
+    def test_only_the_last_pages_are_kept(self):
+        self.client.login(username="visitor", password="password")
+        for name in ("home", "update_profile", "property_search", "user_dashboard"):
+            self.client.get(reverse(name))
+        # the browser says which page the Back link was clicked on
+        page = reverse("user_dashboard")
+        for name in ("property_search", "update_profile"):
+            response = self.client.get(reverse("go_back"), HTTP_REFERER="http://testserver" + page)
+            page = reverse(name)
+            self.assertEqual(response.url, page + "?back=true")
+        # home was the oldest page so it was dropped
+        response = self.client.get(reverse("go_back"), HTTP_REFERER="http://testserver" + page)
+        self.assertEqual(response.url, reverse("home"))
+
+    def test_history_is_only_saved_when_it_changes(self):
+        self.client.login(username="visitor", password="password")
+        response = self.client.get(reverse("home"))
+        self.assertIn("visited_links", response.cookies)
+        response = self.client.get(reverse("home"))
+        self.assertNotIn("visited_links", response.cookies)
+
+    @override_settings(NAVIGATION_HISTORY_STORE="session")
+    def test_session_store_is_only_written_when_the_history_changes(self):
+        self.client.login(username="visitor", password="password")
+        self.client.get(reverse("home"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("home"))
+        self.assertFalse([query for query in queries if query["sql"].startswith('UPDATE "django_session"')])
+        response = self.client.get(reverse("go_back"))
+        self.assertEqual(response.url, reverse("home") + "?back=true")
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ExpiryTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.home = make_property(self.owner, 1)
+        self.home.save()
+        self.guest_home = make_property(self.guest, 2)
+        self.guest_home.save()
+
+    def book(self, days_away, status="pending"):
+        start = timezone.localdate() + timedelta(days=days_away)
+        return Booking.objects.create(
+            user=self.guest,
+            property=self.home,
+            my_property=self.guest_home,
+            date_from=start,
+            date_to=start + timedelta(days=2),
+            status=status,
+        )
+
+    def test_stale_requests_are_declined_in_batches(self):
+        soon = [self.book(0), self.book(-10), self.book(-20)]
+        accepted = self.book(-30, status="accepted")
+        later = self.book(10)
+        # the stale ones aren't in the menu even before they are declined
+        self.assertEqual(BadgeCounts.for_user(self.owner.id).pending_requests, 1)
+
+        run = expiry.expire(batch_size=2)
+        self.assertEqual((run.declined, run.batches), (3, 2))
+        self.assertEqual(ExpiryRun.objects.get().declined, 3)
+        for booking in soon:
+            booking.refresh_from_db()
+            self.assertEqual(booking.status, "declined")
+            self.assertFalse(booking.occupied_days.exists())
+        accepted.refresh_from_db()
+        self.assertEqual(accepted.status, "accepted")
+        self.assertTrue(later.occupied_days.exists())
+        self.assertEqual(BadgeCounts.for_user(self.owner.id).pending_requests, 1)
+
+        # running again finds nothing left to do
+        self.assertEqual(expiry.expire().declined, 0)
+
+    def test_pending_bookings_page_only_reads(self):
+        self.book(0)
+        later = self.book(10)
+        self.client.login(username="owner", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("pending_bookings"))
+        self.assertEqual(response.context["bookings"], [later])
+        writes = [query["sql"] for query in queries if query["sql"].split()[0] in ("UPDATE", "DELETE", "INSERT")]
+        self.assertFalse([sql for sql in writes if "kswap_booking" in sql or "kswap_occupiedday" in sql])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class SwapMatchingTests(TestCase):
+    def setUp(self):
+        self.homes = {}
+        for number, (country, city) in enumerate(
+            [("GB", "London"), ("IL", "Jerusalem"), ("FR", "Paris"), ("US", "New York"), ("GB", "Manchester")]
+        ):
+            owner = User.objects.create_user(f"owner{number}", password="password")
+            self.homes[city] = make_property(owner, number, country=country, city=city)
+            self.homes[city].save()
+
+    def wish(self, home, country, city="", start=date(2030, 7, 1), days=14):
+        home = self.homes[home]
+        return SwapWish.objects.create(
+            owner=home.owner,
+            home=home,
+            country=country,
+            city=city,
+            date_from=start,
+            date_to=start + timedelta(days=days),
+        )
+
+    def rings(self):
+        return sorted(SwapMatch.objects.values_list("key", flat=True))
+
+    def key(self, *wishes):
+        return matching.ring_key(wishes)
+
+    def test_two_homes_that_want_each_other(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        self.assertEqual(self.rings(), [])
+        # anywhere in Britain includes London
+        jerusalem = self.wish("Jerusalem", "GB", start=date(2030, 7, 10))
+        match = SwapMatch.objects.get()
+        self.assertEqual(match.key, self.key(london, jerusalem))
+        self.assertEqual((match.date_from, match.date_to), (date(2030, 7, 10), date(2030, 7, 15)))
+
+    def test_rings_of_three_and_four(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        jerusalem = self.wish("Jerusalem", "FR", "Paris")
+        paris = self.wish("Paris", "GB", "London")
+        self.assertEqual(self.rings(), [self.key(london, jerusalem, paris)])
+
+        paris_to_manchester = self.wish("Paris", "GB", "Manchester")
+        manchester = self.wish("Manchester", "GB", "London")
+        self.assertEqual(
+            self.rings(),
+            sorted([self.key(london, jerusalem, paris), self.key(london, jerusalem, paris_to_manchester, manchester)]),
+        )
+        # the same rings are found when they are all worked out again
+        self.assertEqual(matching.rebuild(SwapWish.objects.all()), 2)
+        self.assertEqual(len(self.rings()), 2)
+
+    def test_dates_must_overlap_and_owners_must_differ(self):
+        self.wish("London", "IL", "Jerusalem")
+        self.wish("Jerusalem", "GB", "London", start=date(2030, 8, 1))
+        self.assertEqual(self.rings(), [])
+        # a user can't swap with their own other home
+        owner = self.homes["London"].owner
+        other_home = make_property(owner, 9, country="IL", city="Jerusalem")
+        other_home.save()
+        SwapWish.objects.create(
+            owner=owner, home=other_home, country="GB", date_from=date(2030, 7, 1), date_to=date(2030, 7, 5)
+        )
+        self.assertEqual(self.rings(), [])
+
+    def test_matches_follow_changes(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        jerusalem = self.wish("Jerusalem", "GB", "London")
+        self.assertEqual(len(self.rings()), 1)
+
+        # the London home moves to Manchester so it isn't wanted any more
+        home = self.homes["London"]
+        home.city = "Manchester"
+        home.save()
+        self.assertEqual(self.rings(), [])
+
+        jerusalem.city = ""
+        jerusalem.save()
+        self.assertEqual(self.rings(), [self.key(london, jerusalem)])
+        london.delete()
+        self.assertEqual(self.rings(), [])
+
+    def test_page_shows_the_matches(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        self.wish("Jerusalem", "GB", "London")
+        self.client.login(username="owner0", password="password")
+        response = self.client.get(reverse("swap_matches"))
+        self.assertEqual(list(response.context["wishes"]), [london])
+        self.assertEqual([match.size for match in response.context["matches"]], [2])
+        self.assertContains(response, self.homes["Jerusalem"].address)
+
+        response = self.client.post(
+            reverse("swap_matches"),
+            {
+                "home": self.homes["London"].id,
+                "country": "FR",
+                "city": "Paris",
+                "date_from": "2030-09-01",
+                "date_to": "2030-08-01",
+            },
+        )
+        self.assertFormError(response.context["form"], None, "The end date must be on or after the start date.")
+
+    def test_deleting_a_wish(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        self.wish("Jerusalem", "GB", "London")
+        self.client.login(username="owner0", password="password")
+        url = reverse("swap_matches")
+        self.assertEqual(self.client.post(url, {"action": "delete", "wish_id": "abc"}).status_code, 404)
+        # another user's wish can't be deleted
+        self.client.login(username="owner1", password="password")
+        self.assertEqual(self.client.post(url, {"action": "delete", "wish_id": london.id}).status_code, 404)
+        self.client.login(username="owner0", password="password")
+        self.assertRedirects(self.client.post(url, {"action": "delete", "wish_id": london.id}), url)
+        self.assertFalse(SwapWish.objects.filter(id=london.id).exists())
+        self.assertEqual(self.rings(), [])
+
+    def test_a_ring_saved_at_the_same_time_is_skipped(self):
+        london = self.wish("London", "IL", "Jerusalem")
+        jerusalem = self.wish("Jerusalem", "GB", "London")
+        rings = matching.find_rings(SwapWish.objects.filter(id=london.id).values_list(*matching.FIELDS, named=True)[0])
+        # the other request hadn't saved the ring when this one looked
+        with mock.patch.object(matching, "existing_keys", return_value=set()):
+            matching.save_rings(rings)
+        match = SwapMatch.objects.get()
+        self.assertEqual(match.key, self.key(london, jerusalem))
+        self.assertEqual(match.wishes.count(), 2)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class RatingTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.homes = []
+        for number in range(3):
+            home = make_property(self.owner, number)
+            home.save()
+            self.homes.append(home)
+        self.guest_home = make_property(self.guest, 9)
+        self.guest_home.save()
+        self.booking = Booking.objects.create(
+            user=self.guest,
+            property=self.homes[0],
+            my_property=self.guest_home,
+            date_from=date(2030, 1, 1),
+            date_to=date(2030, 1, 7),
+        )
+
+    def review(self, home, stars):
+        return Review.objects.create(booking=self.booking, property_reviewed=home, reviewer=self.guest, stars=stars)
+
+    def rating(self, home):
+        home = Property.objects.get(id=home.id)
+        return home.rating_count, home.rating_sum, home.rating
+
+    def owner_rating(self):
+        profile = Profile.objects.get(user=self.owner)
+        return profile.rating_count, profile.rating_sum, profile.rating
+
+    def test_ratings_follow_reviews(self):
+        first = self.review(self.homes[0], 4)
+        self.review(self.homes[0], 5)
+        self.review(self.homes[1], 3)
+        self.assertEqual(self.rating(self.homes[0]), (2, 9, 4.5))
+        self.assertEqual(self.owner_rating(), (3, 12, 4.0))
+
+        first.stars = 2
+        first.save()
+        self.assertEqual(self.rating(self.homes[0]), (2, 7, 3.5))
+        # a review without stars doesn't count
+        first.stars = None
+        first.save()
+        self.assertEqual(self.rating(self.homes[0]), (1, 5, 5.0))
+        first.stars = 1
+        first.property_reviewed = self.homes[1]
+        first.save()
+        self.assertEqual(self.rating(self.homes[1]), (2, 4, 2.0))
+
+        for review in Review.objects.filter(property_reviewed=self.homes[1]):
+            review.delete()
+        self.assertEqual(self.rating(self.homes[1]), (0, 0, None))
+        self.assertEqual(self.owner_rating(), (1, 5, 5.0))
+
+        # the command works out the same numbers from scratch
+        Property.objects.update(rating_count=0, rating_sum=0, rating=None)
+        rebuild_ratings()
+        self.assertEqual(self.rating(self.homes[0]), (1, 5, 5.0))
+        self.assertEqual(self.rating(self.homes[1]), (0, 0, None))
+        self.assertEqual(self.owner_rating(), (1, 5, 5.0))
+
+    def test_search_by_rating(self):
+        self.review(self.homes[1], 5)
+        self.review(self.homes[2], 3)
+        response = self.client.get(reverse("property_search"), {"sort": "rating"})
+        ids = [home.id for home in response.context["property_list"]]
+        self.assertEqual(ids, [self.homes[1].id, self.homes[2].id, self.homes[0].id, self.guest_home.id])
+
+        response = self.client.get(reverse("property_search"), {"min_rating": "4"})
+        self.assertEqual([home.id for home in response.context["property_list"]], [self.homes[1].id])
+
+    def test_best_rated_pages_are_read_from_the_database(self):
+        cache.clear()
+        search_cache.clear_local()
+        homes = [make_property(self.owner, number) for number in range(10, 40)]
+        Property.objects.bulk_create(homes)
+        # 25 homes with a rating, so the second page has rated and unrated ones
+        for number, home in enumerate(Property.objects.order_by("id")[:25]):
+            Property.objects.filter(id=home.id).update(rating=1 + number % 5, rating_count=1, rating_sum=1)
+        facets.rebuild()
+        rated = list(
+            Property.objects.filter(rating__isnull=False).order_by("-rating", "-id").values_list("id", flat=True)
+        )
+        unrated = list(Property.objects.filter(rating__isnull=True).order_by("id").values_list("id", flat=True))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("property_search"), {"sort": "rating", "page": 2})
+        self.assertEqual(response.context["paginator"].count, 34)
+        self.assertEqual([home.id for home in response.context["property_list"]], rated[20:] + unrated[:9])
+        # no query reads the id of every home
+        reads_ids = [query["sql"] for query in queries if 'SELECT "kswap_property"."id" FROM' in query["sql"]]
+        self.assertEqual(reads_ids, [])
+
+        response = self.client.get(reverse("property_search"), {"sort": "rating", "country": "GB"})
+        gb = set(Property.objects.filter(country="GB").values_list("id", flat=True))
+        expected = [home_id for home_id in rated + unrated if home_id in gb]
+        self.assertEqual([home.id for home in response.context["property_list"]], expected[:20])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class LeaveReviewTests(TestCase):
+    def setUp(self):
+        self.guest = User.objects.create_user("guest", password="password")
+        self.guest_home = make_property(self.guest, 0)
+        self.guest_home.save()
+        self.homes = []
+
+    # each swap is with a different owner's home
+    def swap(self):
+        number = len(self.homes) + 1
+        owner = User.objects.create_user(f"owner{number}", password="password")
+        home = make_property(owner, number)
+        home.save()
+        self.homes.append(home)
+        start = date(2030, 1, 1) + timedelta(weeks=number)
+        return Booking.objects.create(
+            user=self.guest,
+            property=home,
+            my_property=self.guest_home,
+            date_from=start,
+            date_to=start + timedelta(days=6),
+        )
+
+    def page_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("leave_review"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_page_query_count_does_not_grow_with_bookings(self):
+        self.client.login(username="guest", password="password")
+        self.swap()
+        self.page_queries()
+        one = self.page_queries()
+        for _ in range(5):
+            self.swap()
+        self.assertEqual(self.page_queries(), one)
+
+    def test_reviews_are_saved_together(self):
+        bookings = [self.swap() for _ in range(4)]
+        self.client.login(username="guest", password="password")
+        data = {f"stars-{booking.id}": "4" for booking in bookings[:3]}
+        data[f"text-{bookings[0].id}"] = "Lovely"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse("leave_review"), data)
+        self.assertRedirects(response, reverse("home"), fetch_redirect_response=False)
+        self.assertEqual([query["sql"].split()[0] for query in queries].count("INSERT"), 1)
+        self.assertEqual(Review.objects.count(), 3)
+        self.assertEqual(Review.objects.get(booking=bookings[0]).text, "Lovely")
+        self.assertEqual(Property.objects.get(id=self.homes[0].id).rating, 4.0)
+        self.assertEqual(Profile.objects.get(user=self.homes[1].owner).rating_count, 1)
+
+        # only the booking without a review is left, and sending the form
+        # again doesn't make the reviews twice
+        response = self.client.get(reverse("leave_review"))
+        self.assertEqual(response.context["bookings"], [bookings[3]])
+        self.client.post(reverse("leave_review"), data)
+        self.assertEqual(Review.objects.count(), 3)
+
+        # the owner can review the guest's home for the same booking
+        self.client.login(username="owner4", password="password")
+        response = self.client.get(reverse("leave_review"))
+        self.assertEqual(response.context["bookings"][0].property_to_review, self.guest_home)
+
+    def test_wrong_stars_save_nothing(self):
+        bookings = [self.swap() for _ in range(2)]
+        self.client.login(username="guest", password="password")
+        response = self.client.post(
+            reverse("leave_review"), {f"stars-{bookings[0].id}": "5", f"stars-{bookings[1].id}": "9"}
+        )
+        self.assertEqual(response.context["error"], "Stars must be a number from 1 to 5.")
+        self.assertFalse(Review.objects.exists())
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ApiTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.homes = []
+        for number in range(5):
+            home = make_property(self.owner if number % 2 else self.guest, number)
+            home.save()
+            self.homes.append(home)
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=headers)
+
+    def send(self, method, url, data, **headers):
+        return getattr(self.client, method)(url, json.dumps(data), content_type="application/json", headers=headers)
+
+    def test_properties_are_paged_with_a_cursor(self):
+        url = reverse("api_properties") + "?limit=2"
+        ids = []
+        while url:
+            data = self.get(url).json()
+            ids += [row["id"] for row in data["results"]]
+            url = data["next"]
+        self.assertEqual(ids, [home.id for home in self.homes])
+
+    def test_includes_cost_the_same_queries_for_any_number_of_properties(self):
+        url = reverse("api_properties") + "?include=owner,images&limit="
+        with CaptureQueriesContext(connection) as one:
+            data = self.get(url + "1").json()
+        self.assertEqual(data["results"][0]["owner"]["username"], "guest")
+        self.assertEqual(data["results"][0]["images"], [])
+        with CaptureQueriesContext(connection) as five:
+            self.get(url + "5")
+        self.assertEqual(len(one), len(five))
+        self.assertEqual(self.get(reverse("api_properties") + "?include=bookings").status_code, 400)
+
+    def test_etag_changes_with_the_version(self):
+        url = reverse("api_property", args=[self.homes[0].id])
+        response = self.get(url)
+        etag = response["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(url, if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+        self.homes[0].city = "Manchester"
+        self.homes[0].save()
+        response = self.get(url, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["city"], "Manchester")
+
+        # a change made with update() elsewhere also changes the ETag of the list
+        list_etag = self.get(reverse("api_properties"))["ETag"]
+        Review.objects.create(
+            booking=Booking.objects.create(
+                user=self.owner,
+                property=self.homes[0],
+                my_property=self.homes[1],
+                date_from=date(2030, 1, 1),
+                date_to=date(2030, 1, 5),
+            ),
+            property_reviewed=self.homes[0],
+            reviewer=self.owner,
+            stars=5,
+        )
+        self.assertEqual(self.get(reverse("api_properties"), if_none_match=list_etag).status_code, 200)
+
+    def test_owner_can_change_their_property(self):
+        url = reverse("api_property", args=[self.homes[1].id])
+        self.assertEqual(self.send("patch", url, {"city": "Leeds"}).status_code, 401)
+        self.client.login(username="guest", password="password")
+        self.assertEqual(self.send("patch", url, {"city": "Leeds"}).status_code, 404)
+
+        self.client.login(username="owner", password="password")
+        etag = self.get(url)["ETag"]
+        response = self.send("patch", url, {"city": "Leeds"}, if_match=etag)
+        self.assertEqual(response.json()["city"], "Leeds")
+        # the ETag is out of date now
+        response = self.send("patch", url, {"city": "York"}, if_match=etag)
+        self.assertEqual(response.status_code, 412)
+        response = self.send("patch", url, {"no_of_rooms": "many"})
+        self.assertIn("no_of_rooms", response.json()["fields"])
+
+    def test_book_accept_and_review(self):
+        self.client.login(username="guest", password="password")
+        data = {"property": self.homes[1].id, "my_property": self.homes[0].id, "date_from": "2030-03-01"}
+        response = self.send("post", reverse("api_bookings"), {**data, "date_to": "2030-03-07"})
+        self.assertEqual(response.status_code, 201)
+        booking_id = response.json()["id"]
+        response = self.send("post", reverse("api_bookings"), {**data, "date_to": "2030-03-03"})
+        self.assertEqual(response.status_code, 409)
+        # true is not the property with id 1
+        response = self.send("post", reverse("api_bookings"), {**data, "property": True, "date_to": "2030-04-07"})
+        self.assertEqual(response.status_code, 404)
+
+        # only the owner of the home that was asked for can accept
+        url = reverse("api_booking", args=[booking_id])
+        self.assertEqual(self.send("patch", url, {"status": "accepted"}).status_code, 404)
+        self.client.login(username="owner", password="password")
+        response = self.send("patch", url, {"status": "accepted"})
+        self.assertEqual(response.json()["status"], "accepted")
+        response = self.get(reverse("api_bookings") + "?include=property")
+        self.assertEqual(response.json()["results"][0]["my_property"]["id"], self.homes[0].id)
+
+        self.assertEqual(
+            [row["id"] for row in self.get(reverse("api_reviews_to_leave")).json()["results"]], [booking_id]
+        )
+        response = self.send("post", reverse("api_reviews"), {"booking": booking_id, "stars": 4, "text": "Very clean"})
+        self.assertEqual(response.json()["property_reviewed_id"], self.homes[0].id)
+        self.assertEqual(
+            self.send("post", reverse("api_reviews"), {"booking": booking_id, "stars": 4}).status_code, 404
+        )
+        response = self.get(reverse("api_reviews") + f"?property={self.homes[0].id}")
+        self.assertEqual([row["stars"] for row in response.json()["results"]], [4])
+
+    def test_new_property(self):
+        self.client.login(username="owner", password="password")
+        home = make_property(self.owner, 10)
+        data = {
+            field: getattr(home, field)
+            for field in (
+                "city",
+                "postcode",
+                "address",
+                "no_of_rooms",
+                "estimated_value",
+                "property_type",
+                "pet_friendly",
+                "proximity_to_public_transport",
+                "succah",
+                "passover_kitchen",
+                "max_occupancy",
+                "smoking_allowed",
+                "home_description",
+            )
+        }
+        data["country"] = "GB"
+        response = self.send("post", reverse("api_properties"), data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Property.objects.get(id=response.json()["id"]).owner, self.owner)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class SiteCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("owner", password="password")
+        make_property(self.user, 0).save()
+
+    def test_counters_follow_new_and_deleted_rows(self):
+        self.assertEqual(SiteCounter.numbers(), {"properties": 1, "users": 1, "kashrut": 0})
+        make_property(self.user, 1).save()
+        Kashrut.objects.create(name="KLBD")
+        User.objects.create_user("guest")
+        Property.objects.first().delete()
+        self.assertEqual(SiteCounter.numbers(), {"properties": 1, "users": 2, "kashrut": 1})
+
+    def test_home_page_reads_the_counters_without_counting(self):
+        SiteCounter.numbers()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(response.context["num_properties"], 1)
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"]])
+
+    def test_rows_added_while_counting_are_kept(self):
+        count_rows = models.count_rows
+
+        def count_then_add(model, estimated=None):
+            counted = count_rows(model, estimated)
+            if model is Kashrut:
+                Kashrut.objects.create(name="KLBD")
+            return counted
+
+        with mock.patch.object(models, "count_rows", side_effect=count_then_add):
+            self.assertEqual(SiteCounter.numbers()["kashrut"], 1)
+        self.assertEqual(SiteCounter.numbers(), {"properties": 1, "users": 1, "kashrut": 1})
+
+    def test_rows_loaded_from_a_fixture_are_not_counted(self):
+        SiteCounter.numbers()
+        fixture = json.dumps([{"model": "kswap.kashrut", "pk": 99, "fields": {"name": "KLBD"}}])
+        for item in serializers.deserialize("json", fixture):
+            item.save()
+        self.assertEqual(SiteCounter.numbers()["kashrut"], 0)
+
+    def test_refresh_counts_rows_added_without_signals(self):
+        SiteCounter.numbers()
+        Property.objects.bulk_create([make_property(self.user, number) for number in range(1, 4)])
+        self.assertEqual(SiteCounter.numbers()["properties"], 1)
+        # SQLite has no estimates, so it counts either way
+        self.assertEqual(SiteCounter.refresh(estimated=True)["properties"], 4)
+        self.assertEqual(SiteCounter.numbers()["properties"], 4)
+
+
+@override_settings(
+    SEARCH_CACHE_TIMEOUT=300, STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+)
+class SearchCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        search_cache.clear_local()
+        search_cache.metrics.clear()
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.home = make_property(self.owner, 0, country="GB", city="London", succah=True)
+        self.home.save()
+        self.guest_home = make_property(self.guest, 1, country="GB", city="London", succah=True)
+        self.guest_home.save()
+
+    def search(self, params):
+        response = self.client.get(reverse("property_search"), params)
+        return [home.id for home in response.context["property_list"]]
+
+    def test_the_same_search_in_a_different_order_is_read_from_the_cache(self):
+        self.search({"city": "London", "succah": "true"})
+        with CaptureQueriesContext(connection) as queries:
+            ids = self.search({"succah": "true", "city": "London", "page": "1"})
+        self.assertEqual(ids, [self.home.id, self.guest_home.id])
+        self.assertFalse([query for query in queries if "kswap_facetbitmap" in query["sql"]])
+        self.assertEqual(search_cache.stats()["local_hits"], 1)
+
+    @override_settings(SEARCH_CACHE_TIMEOUT=None)
+    def test_the_cache_is_off_unless_it_is_shared_by_every_process(self):
+        self.assertEqual(search_cache.timeout(), 0)
+        self.search({"city": "London"})
+        self.search({"city": "London"})
+        self.assertEqual(search_cache.stats()["lookups"], 0)
+        shared = {"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "search_cache"}}
+        with self.settings(CACHES=shared):
+            self.assertEqual(search_cache.timeout(), 300)
+
+    def test_saving_a_property_starts_a_new_generation(self):
+        self.search({"city": "London"})
+        self.home.city = "Paris"
+        self.home.save()
+        self.assertEqual(self.search({"city": "London"}), [self.guest_home.id])
+
+    def test_bookings_only_change_searches_with_dates(self):
+        dates = {"start_date": "2030-07-01", "end_date": "2030-07-07"}
+        self.search({})
+        self.search(dates)
+        availability.reserve(
+            Booking(
+                user=self.guest,
+                property=self.home,
+                my_property=self.guest_home,
+                date_from=date(2030, 7, 3),
+                date_to=date(2030, 7, 5),
+            )
+        )
+        self.search({})
+        self.assertEqual(self.search(dates), [])
+        self.assertEqual(search_cache.stats()["misses"], 3)
+
+    def test_keyword_searches_with_different_operators_are_cached_apart(self):
+        for q in ("kosher pets", "kosher -pets", '"old shul"', "old shul"):
+            self.search({"q": q})
+        self.assertEqual(search_cache.stats()["misses"], 4)
+
+    @override_settings(SEARCH_CACHE_LOCAL_SIZE=0)
+    def test_without_the_local_layer_the_shared_cache_is_used(self):
+        self.search({"q": "Lovely  home"})
+        self.search({"q": "lovely home"})
+        self.assertEqual(search_cache.stats()["shared_hits"], 1)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class PropertyPageRevalidationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.home = make_property(self.owner, 0)
+        self.home.save()
+        self.url = reverse("property_detail", args=[self.home.id])
+
+    def test_unchanged_page_is_answered_with_one_query(self):
+        etag = self.client.get(self.url)["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"kswap_property"."id" = ', queries[0]["sql"])
+
+    def test_last_modified_is_used_without_an_etag(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        response = self.client.get(self.url, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_property_and_picture_changes_change_the_etag(self):
+        etags = [self.client.get(self.url)["ETag"]]
+        self.home.city = "Paris"
+        self.home.save()
+        etags.append(self.client.get(self.url)["ETag"])
+        Image.objects.bulk_create([Image(property=self.home, image="images/missing.jpg")])
+        Image.objects.filter(property=self.home).delete()
+        etags.append(self.client.get(self.url)["ETag"])
+        self.assertEqual(len(set(etags)), 3)
+        response = self.client.get(self.url, headers={"If-None-Match": etags[0]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_each_user_gets_their_own_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.login(username="owner", password="password")
+        response = self.client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url, headers={"If-None-Match": response["ETag"]}).status_code, 304)
+
+
+class SeedTests(TestCase):
+    def setUp(self):
+        # the placeholder picture is saved in a folder that is thrown away
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_seed_makes_every_table_and_the_tables_built_from_them(self):
+        sizes = {"users": 10, "kashrut": 2, "properties": 20, "images": 5, "bookings": 30, "reviews": 5}
+        busy = seed(sizes, random.Random(1), batch_size=7)
+        self.assertEqual(Property.objects.count(), 20)
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(Profile.objects.exclude(kashrut=None).count(), 10)
+        self.assertGreaterEqual(Property.objects.filter(owner=busy).count(), 5)
+        self.assertGreater(Booking.objects.count(), 20)
+        self.assertEqual(SiteCounter.numbers()["properties"], 20)
+        matching, counts = facets.count_facets({})
+        self.assertEqual(matching.bit_count(), 20)
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class QueryTimingTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        home = make_property(self.owner, 0)
+        home.save()
+        guest_home = make_property(self.guest, 1)
+        guest_home.save()
+        for week in range(3):
+            Booking.objects.create(
+                user=self.guest,
+                property=home,
+                my_property=guest_home,
+                date_from=date(2030, 1, 1) + timedelta(weeks=week),
+                date_to=date(2030, 1, 3) + timedelta(weeks=week),
+                status="accepted",
+            )
+        self.client.login(username="guest", password="password")
+
+    def test_off_unless_switched_on(self):
+        response = self.client.get(reverse("home"))
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(QUERY_TIMING=True)
+    def test_server_timing_header_counts_the_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("property_search"))
+        timing = response["Server-Timing"]
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+        self.assertIn("tpl;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    @override_settings(QUERY_TIMING=True, QUERY_TIMING_SLOW_MS=0, QUERY_TIMING_SAMPLE_RATE=1)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.assertLogs("kswap.query_timing", "WARNING") as logs:
+            self.client.get(reverse("your_next_escapes"))
+        self.assertIn("your_next_escapes", logs.output[0])
+        # the page reads the bookings with their homes in one query
+        self.assertIn("0 duplicates", logs.output[0])
+        self.assertRegex(logs.output[0], r"ms: SELECT \.\.\. FROM \"kswap_booking\" INNER JOIN \"kswap_property\"")
+
+    @override_settings(QUERY_TIMING=True, QUERY_TIMING_SLOW_MS=100000, QUERY_TIMING_SAMPLE_RATE=0)
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs("kswap.query_timing", "WARNING"):
+            self.client.get(reverse("home"))
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ProfilingTests(TestCase):
+    def setUp(self):
+        profiles = tempfile.TemporaryDirectory()
+        self.addCleanup(profiles.cleanup)
+        settings = self.settings(REQUEST_PROFILING=True, REQUEST_PROFILE_DIR=profiles.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.staff = User.objects.create_user("staff", password="password", is_staff=True, is_superuser=True)
+        self.visitor = User.objects.create_user("visitor", password="password")
+        make_property(self.visitor, 0).save()
+
+    def test_staff_can_profile_a_page(self):
+        self.client.login(username="staff", password="password")
+        response = self.client.get(reverse("property_search"), {"profile": "1"})
+        profile = RequestProfile.objects.get()
+        self.assertEqual(response["X-Profile-Id"], str(profile.id))
+        self.assertEqual(profile.view_name, "property_search")
+        self.assertEqual(profile.user, self.staff)
+        self.assertGreater(profile.ms, 0)
+        with open(profile.file_path("txt")) as file:
+            summary = file.read()
+        self.assertIn("cumulative time", summary)
+        self.assertIn("Memory allocated", summary)
+        self.assertTrue(os.path.exists(profile.file_path("prof")))
+
+    def test_the_header_works_too(self):
+        self.client.login(username="staff", password="password")
+        self.client.get(reverse("home"), headers={"X-Profile": "1"})
+        self.assertEqual(RequestProfile.objects.get().view_name, "home")
+
+    def test_only_staff_and_only_when_asked(self):
+        self.client.login(username="visitor", password="password")
+        response = self.client.get(reverse("home"), {"profile": "1"})
+        self.assertNotIn("X-Profile-Id", response)
+        self.client.login(username="staff", password="password")
+        self.client.get(reverse("home"))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(REQUEST_PROFILING=False)
+    def test_off_unless_switched_on(self):
+        self.client.login(username="staff", password="password")
+        self.client.get(reverse("home"), {"profile": "1"})
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(REQUEST_PROFILE_KEEP=2)
+    def test_old_profiles_are_deleted(self):
+        self.client.login(username="staff", password="password")
+        for _ in range(2):
+            self.client.get(reverse("home"), {"profile": "1"})
+        oldest = RequestProfile.objects.last()
+        self.client.get(reverse("home"), {"profile": "1"})
+        self.assertEqual(RequestProfile.objects.count(), 2)
+        self.assertFalse(RequestProfile.objects.filter(pk=oldest.pk).exists())
+        self.assertFalse(os.path.exists(oldest.file_path("prof")))
+
+    def test_admin_lists_the_profiles(self):
+        self.client.login(username="staff", password="password")
+        self.client.get(reverse("home"), {"profile": "1"})
+        profile = RequestProfile.objects.get()
+        response = self.client.get(reverse("admin:kswap_requestprofile_changelist"))
+        self.assertContains(response, reverse("admin:kswap_requestprofile_download", args=[profile.pk]))
+        response = self.client.get(reverse("admin:kswap_requestprofile_change", args=[profile.pk]))
+        self.assertContains(response, "cumulative time")
+        response = self.client.get(reverse("admin:kswap_requestprofile_download", args=[profile.pk]))
+        self.assertEqual(response["Content-Disposition"], f'attachment; filename="{profile.name}.prof"')
+        response.close()
+
+
+class QueryPlanTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings = self.settings(MEDIA_ROOT=media.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    # the SQL Django runs for a queryset, with the values filled in
+    def sql(self, queryset):
+        with CaptureQueriesContext(connection) as queries:
+            list(queryset)
+        return queries[0]["sql"]
+
+    def test_a_filter_without_an_index_is_a_full_scan(self):
+        sql = self.sql(Booking.objects.filter(version=3))
+        self.assertIn(("full scan", "kswap_booking"), query_plans.problems(query_plans.explain(sql), sql))
+        found = query_plans.audit([{"sql": sql}])
+        self.assertEqual(found["full scan kswap_booking"]["columns"], ["version"])
+
+    def test_the_owner_and_status_index_is_used(self):
+        sql = self.sql(Booking.objects.filter(property_id=1, status="pending"))
+        self.assertEqual(query_plans.audit([{"sql": sql}]), {})
+
+    def test_short_table_names_are_turned_back(self):
+        sql = self.sql(Booking.objects.filter(property__in=Property.objects.filter(owner_id=1).values("id")))
+        self.assertEqual(query_plans.table_names(sql), {"U0": "kswap_property"})
+
+    def test_new_problems_fail_the_command(self):
+        with tempfile.TemporaryDirectory() as folder:
+            baseline = os.path.join(folder, "baseline.json")
+            call_command("audit_query_plans", properties=20, baseline=baseline, update_baseline=True, stdout=StringIO())
+            call_command("audit_query_plans", properties=20, baseline=baseline, stdout=StringIO())
+            with open(baseline, "w") as file:
+                file.write("{}")
+            with self.assertRaises(CommandError):
+                call_command("audit_query_plans", properties=20, baseline=baseline, stdout=StringIO())
+
+
+class PropertyImportTests(TestCase):
+    HEADER = (
+        "owner,kashrut,country,city,postcode,address,no_of_rooms,estimated_value,property_type,pet_friendly,"
+        "proximity_to_public_transport,succah,passover_kitchen,max_occupancy,smoking_allowed,home_description,images\n"
+    )
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        settings = self.settings(MEDIA_ROOT=os.path.join(self.folder, "media"))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.owner = User.objects.create_user("owner", password="password")
+        Kashrut.objects.create(name="Kedassia")
+        os.makedirs(os.path.join(self.folder, "photos"))
+        PillowImage.new("RGB", (40, 30)).save(os.path.join(self.folder, "photos", "front.jpg"))
+
+    def write(self, name, text):
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def row(self, owner="owner", rooms="3", images="", kashrut=""):
+        return f"{owner},{kashrut},GB,London,N1,1 Road,{rooms},250000,house,no,5,yes,0,6,no,Lovely,{images}\n"
+
+    def json_row(self):
+        row = {"owner": "owner", "country": "IL", "city": "Jerusalem", "postcode": "1", "address": "2 Street"}
+        row.update(no_of_rooms=2, estimated_value=1, property_type="flat", pet_friendly=False, succah=True)
+        row.update(proximity_to_public_transport=1, passover_kitchen=False, max_occupancy=4, smoking_allowed=False)
+        row.update(home_description="Near the shuk")
+        return row
+
+    def errors(self, path):
+        with open(property_import.errors_path(path)) as file:
+            return [json.loads(line) for line in file]
+
+    def test_rows_are_checked_like_the_registration_form(self):
+        path = self.write(
+            "homes.csv",
+            self.HEADER + self.row(kashrut="Kedassia") + self.row(rooms="lots") + self.row(owner="nobody"),
+        )
+        record = property_import.Importer(path, batch_size=2).run()
+        self.assertEqual((record.rows, record.imported, record.failed), (3, 1, 2))
+        home = Property.objects.get()
+        self.assertEqual(
+            (home.owner, home.country.code, home.succah, home.pet_friendly), (self.owner, "GB", True, False)
+        )
+        self.assertEqual(Profile.objects.get(user=self.owner).kashrut.name, "Kedassia")
+        # the tables the signals keep up to date were built again
+        self.assertEqual(facets.count_facets({"city": "London"})[0].bit_count(), 1)
+        errors = self.errors(path)
+        self.assertEqual([error["_row"] for error in errors], [2, 3])
+        self.assertIn("no_of_rooms", errors[0]["_errors"][0])
+        self.assertIn("no user called 'nobody'", errors[1]["_errors"][0])
+
+    def test_pictures_are_copied_from_the_images_folder(self):
+        path = self.write("homes.csv", self.HEADER + self.row(images="front.jpg") + self.row(images="../homes.csv"))
+        record = property_import.Importer(path, images_dir=os.path.join(self.folder, "photos")).run()
+        self.assertEqual((record.imported, record.images, record.failed), (1, 1, 1))
+        image = Image.objects.get()
+        self.assertTrue(os.path.exists(image.image.path))
+        self.assertFalse(image.processed)
+
+    def test_a_stopped_import_carries_on_after_the_last_batch_saved(self):
+        path = self.write("homes.csv", self.HEADER + self.row() + self.row(rooms="4"))
+        PropertyImport.objects.create(source=os.path.abspath(path), started=timezone.now(), rows=1)
+        record = property_import.Importer(path).run()
+        self.assertEqual((record.rows, record.imported), (2, 1))
+        self.assertEqual(Property.objects.get().no_of_rooms, 4)
+        # and from the start again with restart
+        self.assertEqual(property_import.Importer(path).run(restart=True).imported, 2)
+
+    def test_json_lines_and_the_errors_file_can_be_imported(self):
+        good = self.json_row()
+        path = self.write("homes.jsonl", json.dumps(good) + "\n" + json.dumps({**good, "country": "XX"}) + "\n")
+        call_command("import_properties", path, stdout=StringIO())
+        self.assertEqual(Property.objects.count(), 1)
+
+        # fix the row in the errors file and import that
+        fixed = [{**error, "country": "FR"} for error in self.errors(path)]
+        again = self.write("fixed.jsonl", "".join(json.dumps(row) + "\n" for row in fixed))
+        call_command("import_properties", again, stdout=StringIO())
+        self.assertEqual(sorted(Property.objects.values_list("country", flat=True)), ["FR", "IL"])
+
+    def test_lines_that_are_not_json_objects_fail_on_their_own(self):
+        good = self.json_row()
+        lines = [json.dumps(good), '{"owner": "owner", "city":', "[1, 2]", json.dumps(good)]
+        path = self.write("homes.jsonl", "\n".join(lines) + "\n")
+        record = property_import.Importer(path, batch_size=2).run()
+        self.assertEqual((record.rows, record.imported, record.failed), (4, 2, 2))
+        errors = self.errors(path)
+        self.assertEqual([(error["_row"], error["_line"]) for error in errors], [(2, lines[1]), (3, lines[2])])
+        self.assertIn("not JSON", errors[0]["_errors"][0])
+        self.assertIn("not a JSON object", errors[1]["_errors"][0])
+        # carrying on starts after them
+        self.assertEqual(property_import.Importer(path).run().rows, 4)
+        self.assertEqual(Property.objects.count(), 2)
+
+    def test_json_fields_of_the_wrong_type_fail_on_their_own(self):
+        rows = [
+            {**self.json_row(), "images": None},
+            {**self.json_row(), "images": "photos/front.jpg"},
+            {**self.json_row(), "owner": ["owner"]},
+            {**self.json_row(), "kashrut": {"name": "Kedassia"}},
+            {**self.json_row(), "images": [1]},
+        ]
+        path = self.write("homes.jsonl", "".join(json.dumps(row) + "\n" for row in rows))
+        record = property_import.Importer(path).run()
+        self.assertEqual((record.imported, record.images, record.failed), (2, 1, 3))
+        errors = self.errors(path)
+        self.assertEqual(
+            [(error["_row"], error["_errors"]) for error in errors],
+            [
+                (3, ["owner must be a name"]),
+                (4, ["kashrut must be a name"]),
+                (5, ["images must be a list of file names"]),
+            ],
+        )
+
+    def test_each_batch_is_searchable_even_if_a_later_one_fails(self):
+        country = Country.objects.create(name="United Kingdom", code2="GB", continent="EU")
+        City.objects.create(name="London", display_name="London", country=country, latitude=51.5, longitude=-0.12)
+        kedassia = Kashrut.objects.get(name="Kedassia")
+        # a home the owner had before, which moves to the kashrut in the file
+        make_property(self.owner, 1, random.Random(1)).save()
+        path = self.write("homes.csv", self.HEADER + self.row(kashrut="Kedassia") + self.row() + self.row())
+        copy_images = mock.patch.object(
+            property_import.Importer, "copy_images", side_effect=[{}, RuntimeError("the disk is full")]
+        )
+        with copy_images, self.assertRaises(RuntimeError):
+            property_import.Importer(path, batch_size=2).run()
+
+        # the first batch was saved and can be searched for, next to the older home
+        self.assertEqual(Property.objects.count(), 3)
+        self.assertEqual(facets.count_facets({"city": "London"})[0].bit_count(), 2)
+        self.assertEqual(facets.count_facets({"kashrut": str(kedassia.id)})[0].bit_count(), 3)
+        self.assertEqual(len(search.ranked_ids("Lovely")), 3)
+        self.assertEqual(SiteCounter.numbers()["properties"], 3)
+        home = Property.objects.filter(city="London").first()
+        self.assertEqual((home.latitude, home.longitude), (51.5, -0.12))
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class ExportTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="password")
+        self.guest = User.objects.create_user("guest", password="password")
+        self.other = User.objects.create_user("other", password="password")
+        homes = []
+        for number, user in enumerate([self.owner, self.guest, self.other]):
+            home = make_property(user, number, address=f"{number} Export Road")
+            home.save()
+            homes.append(home)
+        self.booking = Booking.objects.create(
+            user=self.guest,
+            property=homes[0],
+            my_property=homes[1],
+            date_from=date(2030, 1, 1),
+            date_to=date(2030, 1, 5),
+        )
+        Booking.objects.create(
+            user=self.other,
+            property=homes[1],
+            my_property=homes[2],
+            date_from=date(2030, 2, 1),
+            date_to=date(2030, 2, 5),
+        )
+        Review.objects.create(
+            booking=self.booking, property_reviewed=homes[0], reviewer=self.guest, stars=4, text="Lovely, quiet"
+        )
+
+    def download(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_bookings_as_csv_with_the_joined_columns(self):
+        self.client.login(username="owner", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response, text = self.download("api_bookings_export")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="bookings.csv"', response["Content-Disposition"])
+        rows = list(csv.DictReader(StringIO(text)))
+        # only the booking of the owner's home, with the homes and users in it
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["guest"], "guest")
+        self.assertEqual(rows[0]["owner"], "owner")
+        self.assertEqual(rows[0]["property_address"], "0 Export Road")
+        self.assertEqual(rows[0]["my_property_address"], "1 Export Road")
+        # the session and user, then one query for all the rows
+        self.assertEqual(len([query for query in queries if "kswap_booking" in query["sql"]]), 1)
+
+    def test_staff_get_every_row_and_json_lines(self):
+        User.objects.create_user("staff", password="password", is_staff=True)
+        self.client.login(username="staff", password="password")
+        response, text = self.download("api_bookings_export", format="jsonl")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in text.splitlines()]
+        self.assertEqual([row["guest"] for row in rows], ["guest", "other"])
+        self.assertEqual(rows[0]["date_from"], "2030-01-01")
+
+    def test_reviews_of_my_homes_and_by_me(self):
+        for username, count in [("owner", 1), ("guest", 1), ("other", 0)]:
+            self.client.login(username=username, password="password")
+            response, text = self.download("api_reviews_export")
+            rows = list(csv.DictReader(StringIO(text)))
+            self.assertEqual(len(rows), count)
+        self.client.login(username="owner", password="password")
+        response, text = self.download("api_reviews_export")
+        self.assertEqual(list(csv.DictReader(StringIO(text)))[0]["text"], "Lovely, quiet")
+
+    def test_login_and_format_are_checked(self):
+        self.assertEqual(self.client.get(reverse("api_bookings_export")).status_code, 401)
+        self.client.login(username="owner", password="password")
+        self.assertEqual(self.client.get(reverse("api_bookings_export"), {"format": "xml"}).status_code, 400)
+
+    def test_the_command_writes_the_same_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bookings.csv")
+            call_command("export_history", "bookings", output=path)
+            with open(path) as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 2)
+        out = StringIO()
+        call_command("export_history", "reviews", format="jsonl", user="other", stdout=out)
+        self.assertEqual(out.getvalue(), "")
+
+    def test_lines_are_sent_in_blocks(self):
+        blocks = list(exports.blocks(["header\n"] + ["row\n"] * 10, size=16))
+        self.assertEqual(blocks[0], b"header\n")
+        self.assertEqual(b"".join(blocks), b"header\n" + b"row\n" * 10)
+        self.assertEqual(len(blocks), 4)
+
+    def test_cells_a_spreadsheet_would_run_are_made_text(self):
+        Review.objects.update(text='=HYPERLINK("http://example.com")')
+        Property.objects.filter(owner=self.owner).update(address="@SUM(A1)")
+        self.client.login(username="owner", password="password")
+        response, text = self.download("api_reviews_export")
+        row = next(csv.DictReader(StringIO(text)))
+        self.assertEqual(row["text"], '\'=HYPERLINK("http://example.com")')
+        self.assertEqual(row["property_address"], "'@SUM(A1)")
+        # the JSON Lines file is data, not a spreadsheet, so it is left as it is
+        response, text = self.download("api_reviews_export", format="jsonl")
+        self.assertEqual(json.loads(text)["property_address"], "@SUM(A1)")
+        # a tab or carriage return in front can hide a formula too
+        Property.objects.filter(owner=self.owner).update(address="\t=1+2")
+        Review.objects.update(text="\r=1+2")
+        response, text = self.download("api_reviews_export")
+        row = next(csv.DictReader(StringIO(text)))
+        self.assertEqual((row["property_address"], row["text"]), ("'\t=1+2", "'\r=1+2"))
+
+    async def test_asgi_downloads_are_sent_a_block_at_a_time(self):
+        request = AsyncRequestFactory().get(reverse("api_bookings_export"))
+        request.user = self.owner
+        with mock.patch.object(exports, "BLOCK_SIZE", 1):
+            response = exports.export(request, "bookings")
+            self.assertTrue(response.is_async)
+            blocks = [block async for block in response]
+        # the header line and then the one booking of the owner's home
+        self.assertEqual(len(blocks), 2)
+        self.assertTrue(blocks[0].startswith(b"id,status,"))
+        self.assertIn(b"0 Export Road", blocks[1])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class PageAssetsTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user("owner", password="password")
+        self.home = make_property(owner, 0)
+        self.home.save()
+        Image.objects.bulk_create([Image(property=self.home, image=f"images/missing_{n}.jpg") for n in range(3)])
+        self.url = reverse("property_detail", args=[self.home.id])
+
+    def test_carousel_is_served_by_us_and_later_pictures_are_lazy(self):
+        page = self.client.get(self.url).content.decode()
+        self.assertNotIn("jquery", page)
+        self.assertNotIn("slick", page)
+        self.assertIn(f'<script src="{static("js/carousel.js")}" defer>', page)
+        pictures = re.findall(r"<img [^>]*>", page)
+        self.assertEqual(len(pictures), 3)
+        self.assertNotIn('loading="lazy"', pictures[0])
+        self.assertTrue(all('loading="lazy"' in picture for picture in pictures[1:]))
+
+    def test_new_static_file_names_change_the_etag(self):
+        etag = self.client.get(self.url)["ETag"]
+        with self.settings(STATIC_URL="/assets/"):
+            self.assertNotEqual(self.client.get(self.url)["ETag"], etag)
+
+    def test_collected_files_are_compressed_and_immutable(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        with self.settings(
+            STATIC_ROOT=static_root, STATICFILES_STORAGE="whitenoise.storage.CompressedManifestStaticFilesStorage"
+        ):
+            call_command("collectstatic", interactive=False, verbosity=0)
+            url = static("js/carousel.js")
+            self.assertRegex(url, r"^/static/js/carousel\.[0-9a-f]{12}\.js$")
+            # a new Client so WhiteNoiseMiddleware reads the new STATIC_ROOT
+            response = Client().get(url, headers={"Accept-Encoding": "gzip"})
+            b"".join(response.streaming_content)
+            response.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("immutable", response["Cache-Control"])
+
+
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class AsgiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("visitor", password="password")
+
+    async def test_history_middleware_saves_the_history_under_asgi(self):
+        async def page(request):
+            history.visit(request, request.path, False)
+            return HttpResponse()
+
+        request = AsyncRequestFactory().get("/")
+        request.user = self.user
+        response = await NavigationHistoryMiddleware(page)(request)
+        self.assertEqual(json.loads(response.cookies["visited_links"].value.rsplit(":", 2)[0]), ["/"])
+
+    async def test_back_link_with_no_history_goes_home(self):
+        response = await AsyncClient().get(reverse("go_back"))
+        self.assertRedirects(response, reverse("home"), fetch_redirect_response=False)
+
+    async def test_home_page_is_drawn(self):
+        response = await AsyncClient().get(reverse("home"))
+        self.assertEqual(response.status_code, 200)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    def test_only_one_of_many_bookings_at_the_same_time_gets_the_days(self):
+        owner = User.objects.create_user("owner")
+        home = make_property(owner, 0)
+        home.save()
+        guests = []
+        for number in range(1, 6):
+            guest = User.objects.create_user(f"guest{number}")
+            guest_home = make_property(guest, number)
+            guest_home.save()
+            guests.append((guest, guest_home))
+        ready = threading.Barrier(len(guests))
+
+        def book(guest):
+            user, guest_home = guest
+            ready.wait()
+            try:
+                # the in memory test database answers "table is locked" at
+                # once where a database file waits its timeout, so wait here
+                for attempt in range(200):
+                    booking = Booking(
+                        user=user,
+                        property=home,
+                        my_property=guest_home,
+                        date_from=date(2030, 7, 1),
+                        date_to=date(2030, 7, 7),
+                    )
+                    try:
+                        availability.reserve(booking)
+                        return "booked"
+                    except availability.BookingConflict:
+                        return "clash"
+                    except OperationalError:
+                        time.sleep(0.01)
+                return "locked"
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=lambda guest=guest: results.append(book(guest))) for guest in guests]
+        results = []
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ["booked"] + ["clash"] * 4)
+        self.assertEqual(Booking.objects.count(), 1)
+        self.assertEqual(OccupiedDay.objects.filter(property=home).count(), 7)
@@ -0,0 +1,194 @@
+# Uploading property pictures in pieces
+# Sending 30 phone photos in the one registration form meant one request
+# that could take minutes on a slow connection, with the whole of it read
+# before any picture was saved.  Instead the registration page sends each
+# picture in CHUNK_SIZE pieces to the upload views first:
+#   1. POST the file name and size to start an ImageUpload
+#   2. PATCH each piece with an Upload-Offset header saying where it goes
+#   3. if a piece fails, GET the upload to find out how much arrived and
+#      carry on from there
+# Every piece is a short request and is written straight to a file in
+# CHUNKED_UPLOAD_DIR a block at a time, so memory use stays small.  The SHA-256
+# of the picture is worked out as the blocks go past.  When the form is
+# saved the finished uploads become Images with one bulk_create
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.text import get_valid_filename
+from PIL import Image as PillowImage
+
+from .models import Image, ImageUpload, Property, property_changed
+from . import variants
+
+# the registration page sends pieces this big
+CHUNK_SIZE = 1024 * 1024
+# no piece may be bigger than this, and no picture bigger than MAX_SIZE
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_SIZE = 50 * 1024 * 1024
+# how much of a piece is read from the request and written at a time
+BLOCK_SIZE = 64 * 1024
+
+# The part worked out so far of the SHA-256 for each upload this process has
+# received pieces for, as {upload id: (bytes hashed, hash)}.  If the next
+# piece of an upload goes to a different server process the hash is worked
+# out again from the file when it is finished.  Uploads that are never
+# finished would stay here for good, so only the last HASHES_KEPT are kept
+# and an older one is worked out again from the file the same way
+HASHES_KEPT = 1000
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def take_hash(upload_id):
+    with _hashes_lock:
+        return _hashes.pop(upload_id, (None, None))
+
+
+def keep_hash(upload_id, hashed, sha256):
+    with _hashes_lock:
+        _hashes[upload_id] = (hashed, sha256)
+        while len(_hashes) > HASHES_KEPT:
+            _hashes.popitem(last=False)
+
+
+class UploadError(Exception):
+    pass
+
+
+# the piece doesn't start where the last one finished, so the page
+# should ask where to carry on from
+class WrongOffset(UploadError):
+    pass
+
+
+def start(owner, filename, size):
+    if size <= 0 or size > MAX_SIZE:
+        raise UploadError(f"Pictures must be smaller than {MAX_SIZE // (1024 * 1024)} MB")
+    filename = get_valid_filename(os.path.basename(filename)) or "picture"
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    upload = ImageUpload.objects.create(owner=owner, filename=filename[:100], size=size)
+    open(upload.path(), "wb").close()
+    return upload
+
+
+# Writes one piece read from stream (the request) at offset.  offset must be
+# the number of bytes already received, so a piece sent twice after a lost
+# reply is refused rather than added again.  Returns the new offset
+def append(upload, offset, stream, length):
+    if offset != upload.offset:
+        raise WrongOffset(f"Expected the piece starting at {upload.offset}")
+    if length > MAX_CHUNK_SIZE or offset + length > upload.size:
+        raise UploadError("The piece is too big")
+
+    hashed, sha256 = take_hash(upload.id)
+    if offset == 0:
+        sha256 = hashlib.sha256()
+    elif hashed != offset:
+        sha256 = None
+
+    written = 0
+    with open(upload.path(), "r+b") as file:
+        file.seek(offset)
+        while written < length:
+            block = stream.read(min(BLOCK_SIZE, length - written))
+            if not block:
+                break
+            file.write(block)
+            if sha256 is not None:
+                sha256.update(block)
+            written += len(block)
+        # anything after this piece is left over from an earlier try
+        file.truncate()
+    if written != length:
+        raise WrongOffset("The piece was cut short")
+
+    # only move the offset on if nobody else has moved it in the meantime
+    new_offset = offset + written
+    if not ImageUpload.objects.filter(id=upload.id, offset=offset).update(offset=new_offset):
+        raise WrongOffset("Another piece of this upload arrived at the same time")
+    upload.offset = new_offset
+    if sha256 is not None:
+        keep_hash(upload.id, new_offset, sha256)
+
+    if new_offset == upload.size:
+        finish(upload)
+    return new_offset
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256
+
+
+# Checks a finished upload really is a picture and saves its SHA-256
+def finish(upload):
+    hashed, sha256 = take_hash(upload.id)
+    if hashed != upload.size:
+        sha256 = hash_file(upload.path())
+    try:
+        with PillowImage.open(upload.path()) as picture:
+            picture.verify()
+    except Exception:
+        discard(upload)
+        raise UploadError(f"{upload.filename} is not a picture")
+    upload.sha256 = sha256.hexdigest()
+    upload.save(update_fields=["sha256"])
+
+
+# The file is only removed once the row's deletion is committed, so if
+# the property the picture was for isn't saved the upload can be used again
+def discard(upload):
+    take_hash(upload.id)
+    path = upload.path()
+    upload.delete()
+
+    def remove_file():
+        if os.path.exists(path):
+            os.remove(path)
+
+    transaction.on_commit(remove_file)
+
+
+# Turns the finished uploads, and any files sent with the form itself by
+# browsers without JavaScript, into Images of the property with one
+# bulk_create.  A picture uploaded twice is only added once.  The picture
+# files are written before the rows, so if saving the rows fails the files
+# written so far are deleted again rather than left with nothing using them
+@transaction.atomic
+def attach(property, uploads, files=()):
+    images = [Image(property=property, image=file) for file in files]
+    try:
+        seen = set()
+        for upload in uploads:
+            if not upload.complete or upload.sha256 in seen:
+                continue
+            seen.add(upload.sha256)
+            with open(upload.path(), "rb") as file:
+                name = default_storage.save(f"images/{upload.filename}", File(file))
+            images.append(Image(property=property, image=name))
+        Image.objects.bulk_create(images)
+        # bulk_create doesn't send post_save, so the property's version (see
+        # models.py) is changed here
+        Property.objects.filter(id=property.id).update(**property_changed())
+
+        # bulk_create doesn't send post_save, so ask for the smaller copies here
+        for image in images:
+            variants.queue(image)
+        for upload in uploads:
+            discard(upload)
+    except BaseException:
+        # the files sent with the form are only written by bulk_create
+        for image in images:
+            if image.image._committed:
+                default_storage.delete(image.image.name)
+        raise
+    return images
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, exports, views
 
 urlpatterns = [
     # in the path() function below, the urlpattern is an empty string
@@ -12,11 +12,26 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('update_profile/', views.update_profile, name='update_profile'),
     path('property_registration/', views.property_registration, name='property_registration'),
+    path('image_upload/', views.image_upload_start, name='image_upload_start'),
+    path('image_upload/<uuid:upload_id>', views.image_upload, name='image_upload'),
     path('property_search/', views.PropertyListView.as_view(), name='property_search'),
     path('property_detail/<int:pk>', views.PropertyDetailView.as_view(), name='property_detail'),
     path('property_book/<int:pk>', views.property_book, name='property_book'),
     path('pending_bookings/', views.pending_bookings, name='pending_bookings'),
     path('your_next_escapes/', views.your_next_escapes, name='your_next_escapes'),
+    path('swap_matches/', views.swap_matches, name='swap_matches'),
     path('user_dashboard/', views.user_dashboard, name='user_dashboard'),
     path('leave_review/', views.leave_review, name='leave_review'),
+    # the JSON API, see api.py
+    path('api/v1/', api.index, name='api_index'),
+    path('api/v1/properties/', api.properties, name='api_properties'),
+    path('api/v1/properties/<int:pk>', api.property_item, name='api_property'),
+    path('api/v1/properties/<int:pk>/images', api.property_images, name='api_property_images'),
+    path('api/v1/bookings/', api.bookings, name='api_bookings'),
+    path('api/v1/bookings/<int:pk>', api.booking_item, name='api_booking'),
+    path('api/v1/reviews/', api.reviews, name='api_reviews'),
+    path('api/v1/reviews/to_leave/', api.reviews_to_leave, name='api_reviews_to_leave'),
+    # the whole history as one CSV or JSON Lines file, see exports.py
+    path('api/v1/bookings/export', exports.bookings_export, name='api_bookings_export'),
+    path('api/v1/reviews/export', exports.reviews_export, name='api_reviews_export'),
 ]
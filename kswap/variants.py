@@ -0,0 +1,117 @@
+# Smaller copies of the property pictures
+# Photos are uploaded straight off phones and cameras and can be several MB
+# each.  For every Image this makes copies WIDTHS pixels wide in WebP and
+# JPEG, and the detail page uses srcset so the browser downloads the smallest
+# copy that still looks sharp on its screen.
+# The copies are made by a pool of worker threads once the upload has been
+# saved, so whoever is registering a property doesn't have to wait for them.
+# If the server stops before a picture is done it keeps processed=False and
+# the process_images management command makes its copies later
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image as PillowImage
+from PIL import ImageOps
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (400, 800, 1200)
+
+# (format, file extension, Pillow format, options for saving)
+FORMATS = (
+    ("webp", "webp", "WEBP", {"quality": 80, "method": 4}),
+    ("jpeg", "jpg", "JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+)
+
+_pool = None
+
+
+# the threads are only started the first time a picture is uploaded
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix="image-variants")
+    return _pool
+
+
+# The widths to make for a picture.  A copy is never bigger than the
+# original, but a small picture still gets one copy of its own size
+def widths_for(width):
+    widths = [size for size in WIDTHS if size <= width]
+    if width < WIDTHS[-1] and width not in widths:
+        widths.append(width)
+    return widths
+
+
+# Makes the copies of one picture, replacing any made before
+# Returns the number of copies
+def make_variants(image):
+    with image.image.open("rb") as file:
+        picture = PillowImage.open(file)
+        # phones often save photos sideways with the right way up written in
+        # the EXIF data, so turn the picture before the EXIF is left behind
+        picture = ImageOps.exif_transpose(picture)
+        picture.load()
+    transparent = picture.mode in ("RGBA", "LA", "PA") or "transparency" in picture.info
+
+    # do the slow part before touching the database.  Nothing is passed
+    # as exif= when saving, so none of the EXIF data is copied (it can
+    # include where the photo was taken and the camera's serial number)
+    copies = []
+    for width in widths_for(picture.width):
+        height = max(1, round(picture.height * width / picture.width))
+        resized = picture if width == picture.width else picture.resize((width, height), PillowImage.LANCZOS)
+        for format, extension, pillow_format, options in FORMATS:
+            # JPEG can't be see-through, WebP can
+            mode = "RGBA" if transparent and format == "webp" else "RGB"
+            data = BytesIO()
+            resized.convert(mode).save(data, pillow_format, **options)
+            copies.append((format, width, height, f"{image.id}_{width}.{extension}", data.getvalue()))
+
+    with transaction.atomic():
+        # Write first.  SQLite lets a transaction that has only read wait for
+        # another writer, but one that has read and then wants to write fails
+        # straight away with "database is locked"
+        image.width, image.height = picture.width, picture.height
+        image.processed = True
+        image.save(update_fields=["width", "height", "processed"])
+        # deleting the old copies also removes their files, see models.py
+        for old in image.variants.all():
+            old.delete()
+        for format, width, height, name, data in copies:
+            variant = image.variants.model(image=image, format=format, width=width, height=height, size=len(data))
+            variant.file.save(name, ContentFile(data), save=False)
+            variant.save()
+    return len(copies)
+
+
+# Runs in a worker thread.  A picture that can't be read is logged and
+# left for the process_images command instead of stopping the thread
+def process(model, image_id):
+    try:
+        image = model.objects.filter(id=image_id).first()
+        if image is None:
+            return False
+        make_variants(image)
+        return True
+    except Exception:
+        logger.exception("Could not make the smaller copies of image %s", image_id)
+        return False
+    finally:
+        # each thread has its own database connection
+        close_old_connections()
+
+
+# Called when an Image is saved.  The copies are made after the transaction
+# commits so that the worker thread can see the new row.  With IMAGE_WORKERS
+# set to 0 they are made straight away instead
+def queue(image):
+    model, image_id = type(image), image.id
+    if settings.IMAGE_WORKERS:
+        transaction.on_commit(lambda: pool().submit(process, model, image_id))
+    else:
+        transaction.on_commit(lambda: process(model, image_id))
@@ -4,29 +4,50 @@
 # get_object_or_404 is a function which tries to get something from
 # my database and if it not there then it will show an error message
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse
+from django.urls import reverse
 
-# There are all my database tables.  The first line is all the ones
-# I made myself and the second one is the standard User file
-# from Django authentication
-from .models import Kashrut, Profile, Property, Image, Booking, Review
-from django.contrib.auth.models import User
+# There are all my database tables, the ones I made myself
+from .models import BadgeCounts, Profile, Property, ImageUpload, Booking, Review, SiteCounter, SwapMatch, SwapWish, rebuild_ratings
 
 # theses are forms that I wrote in the forms.py file which I use here
 # in the views.py file to prepare the form to the user
-from .forms import ProfileForm, PropertyForm, PropertyBookForm
+from .forms import ProfileForm, PropertyForm, PropertyBookForm, SwapWishForm
 
 # This import allows me to add @login_required before any view that I only
 # want to be available to users who are logged in
 from django.contrib.auth.decorators import login_required
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Q is an object which allows me to add SQL filtering conditions together
 # so that I can return records if something is true AND something else is also true
-from django.db.models import Q
+# Exists and OuterRef make a NOT EXISTS subquery, used to find the bookings
+# that have no review yet
+from django.db.models import Exists, OuterRef, Q, Subquery
+from django.db import transaction
+from django.core.exceptions import ValidationError
 
 from django.views import generic
 
+# condition() answers "has this page changed?" with 304 Not Modified
+# when the browser already has the latest copy
+from django.views.decorators.http import condition
+from .context_processors import badge_counts
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+import hashlib
+from django.templatetags.static import static
+
+# availability.py keeps track of which days each property is in use
+# facets.py does the filters and counts on the property search page,
+# search.py does the keyword search and geo.py the search for homes near a place
+# uploads.py receives pictures in pieces, history.py keeps the
+# pages each user has visited for the Back link, expiry.py
+# declines swap requests that were never answered and matching.py finds
+# homes that can be swapped (the matching is run when a SwapWish is saved)
+from . import availability, expiry, facets, geo, history, search, search_cache, uploads
+
 
 # my own merge sort code
 def merge_sort(array):
@@ -72,8 +93,9 @@ def merge_sort(array):
             j += 1
             k += 1
 
-        # The merged array is returned, sorted in descending order based on 'date_from'
-        return array
+    # The merged array is returned, sorted in descending order based on 'date_from'
+    # (a list with one booking or none is already sorted, and is returned as it is)
+    return array
 
 
 
@@ -116,15 +138,14 @@ def home(request):
     is_back_link = request.GET.get('back', 'false') == 'true'
     visit_page(request, url, is_back_link)
 
-    # Count the number of properties and users
-    num_properties = Property.objects.all().count()
-    num_users = User.objects.all().count()
-    num_kashrut = Kashrut.objects.count()
+    # The number of properties, users and kashrut authorities are kept in
+    # the SiteCounter table, so they are read rather than counted
+    numbers = SiteCounter.numbers()
 
     context = {
-        "num_properties": num_properties,
-        "num_users": num_users,
-        "num_kashrut": num_kashrut,
+        "num_properties": numbers["properties"],
+        "num_users": numbers["users"],
+        "num_kashrut": numbers["kashrut"],
     }
 
     # Render the template home.html with data in the context dictionary
@@ -145,25 +166,79 @@ def property_registration(request):
     is_back_link = request.GET.get('back', 'false') == 'true'
     visit_page(request, url, is_back_link)
 
+    # if the form had a mistake, keep the pictures that were already sent
+    upload_ids = request.POST.getlist("uploads") if request.method == "POST" else []
     if request.method == "POST":
         form = PropertyForm(request.POST)
         if form.is_valid():
-            # create a variable called property_form which can then be added to
-            # but don't save it to the database yet
-            property_form = form.save(commit=False)
-            # add the owner (which is the user) to property form
-            property_form.owner = request.user
-            # now sabe it to the database
-            property_form.save()
-
-            images = request.FILES.getlist("images")
-            for image in images:
-                photo = Image(property=property_form, image=image)
-                photo.save()
-            return redirect("home")
+            # the pictures were sent in pieces before the form was saved -
+            # see uploads.py.  Only the user's own finished uploads are used
+            # An id that isn't a UUID makes the filter raise ValidationError,
+            # so the form is shown again with an error instead
+            try:
+                pictures = list(ImageUpload.objects.filter(id__in=upload_ids, owner=request.user).order_by("started"))
+            except ValidationError:
+                form.add_error(None, "Some of the pictures could not be found, please add them again")
+                upload_ids = []
+            else:
+                # the property and its pictures are saved together, so if
+                # adding the pictures fails there is no property without them
+                with transaction.atomic():
+                    # create a variable called property_form which can then be added to
+                    # but don't save it to the database yet
+                    property_form = form.save(commit=False)
+                    # add the owner (which is the user) to property form
+                    property_form.owner = request.user
+                    # now sabe it to the database
+                    property_form.save()
+                    # Pictures sent with the form itself, by browsers without
+                    # JavaScript, are added too
+                    uploads.attach(property_form, pictures, request.FILES.getlist("images"))
+                return redirect("home")
     else:
         form = PropertyForm()
-    return render(request, "property_registration.html", {"form": form})
+    context = {"form": form, "upload_ids": upload_ids, "chunk_size": uploads.CHUNK_SIZE}
+    return render(request, "property_registration.html", context)
+
+
+# The views the registration page sends the pieces of each picture to.
+# They answer in JSON with how many bytes have arrived
+@login_required
+def image_upload_start(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST the filename and size"}, status=405)
+    size = request.POST.get("size", "")
+    if not size.isdigit():
+        return JsonResponse({"error": "The size is missing"}, status=400)
+    try:
+        upload = uploads.start(request.user, request.POST.get("filename", ""), int(size))
+    except uploads.UploadError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    return JsonResponse({"id": str(upload.id), "offset": 0, "url": reverse("image_upload", args=[upload.id])})
+
+
+@login_required
+def image_upload(request, upload_id):
+    upload = get_object_or_404(ImageUpload, id=upload_id, owner=request.user)
+    if request.method == "PATCH":
+        offset = request.headers.get("Upload-Offset", "")
+        length = request.headers.get("Content-Length", "")
+        if not offset.isdigit() or not length.isdigit():
+            return JsonResponse({"error": "Upload-Offset and Content-Length are needed"}, status=400)
+        try:
+            # request is read a block at a time, the piece is never all in memory
+            uploads.append(upload, int(offset), request, int(length))
+        except uploads.WrongOffset as error:
+            # 409 tells the page to ask where to carry on from
+            return JsonResponse({"error": str(error), "offset": upload.offset}, status=409)
+        except uploads.UploadError as error:
+            return JsonResponse({"error": str(error)}, status=400)
+    elif request.method == "DELETE":
+        uploads.discard(upload)
+        return JsonResponse({"id": str(upload_id), "deleted": True})
+    elif request.method != "GET":
+        return JsonResponse({"error": "Use GET, PATCH or DELETE"}, status=405)
+    return JsonResponse({"id": str(upload.id), "offset": upload.offset, "size": upload.size, "complete": upload.complete})
 
 
 # This view is to show a list of all properties which are
@@ -178,6 +253,9 @@ def property_registration(request):
 class PropertyListView(generic.ListView):
     model = Property
     context_object_name = 'property_list'
+    # only show 20 homes at a time, otherwise the page would get very
+    # slow to draw once there are lots of properties
+    paginate_by = 20
 
     def get(self, request, *args, **kwargs):
         url = request.path
@@ -195,22 +273,157 @@ class PropertyListView(generic.ListView):
         start_date = self.request.GET.get('start_date')
         end_date = self.request.GET.get('end_date')
 
-        # include all properties and also include the Profile for this user
-        queryset = Property.objects.select_related('owner__profile')
+        # include all properties and also include the Profile and kashrut
+        # of the owner because the template shows them for every property
+        queryset = Property.objects.select_related('owner__profile__kashrut').order_by('id')
 
-        if start_date and end_date:
+        # the drop down filters (country, city, succah...) - see facets.py
+        self.filters = facets.filters_from_request(self.request.GET)
+        queryset = facets.filter_properties(queryset, self.filters)
+
+        dated = bool(start_date and end_date)
+        if dated:
             start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
             end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
-            # Filter out properties that have conflicting bookings
-            booked_properties = Booking.objects.filter(
-                Q(date_from__lte=end_date) & Q(date_to__gte=start_date)
-            ).values_list('property', flat=True)
+            # Filter out properties that are in use on any of the days.
+            # This used to look through every booking in the Booking table, which
+            # included declined ones and missed the my_property side of a swap.
+            # Now it looks the days up in the OccupiedDay table instead
+            queryset = availability.available_properties(queryset, start_date, end_date)
+
+        # the same search is often made by lots of people, so the results
+        # are kept in a cache - see search_cache.py
+        found = search_cache.get_or_work(
+            self.search_params(start_date, end_date),
+            lambda: self.search(queryset, start_date, end_date),
+            dated=dated,
+        )
+        self.matching, self.counts, self.ranked_ids, self.distances, self.near_error = found
+        return queryset
 
-            # finaly exclude properties that have already been booked
-            queryset = queryset.exclude(id__in=booked_properties)
+    # Everything in the request that changes which homes are found, in the
+    # same form however it was written, used for the search cache key
+    def search_params(self, start_date, end_date):
+        names = ('near', 'nearest', 'within', 'min_rating', 'sort')
+        params = {name: self.request.GET.get(name, '').strip() for name in names}
+        params['near'] = params['near'].lower()
+        # Postgres reads -word as NOT and "two words" as a phrase, so the
+        # key keeps the text as it was typed, only ignoring case and spaces
+        params['q'] = ' '.join(self.request.GET.get('q', '').lower().split())
+        params['filters'] = self.filters
+        if start_date and end_date:
+            params['dates'] = [start_date.isoformat(), end_date.isoformat()]
+        return params
 
-        return queryset
+    # Works out the homes that match and the counts next to each filter.
+    # Returns (matching bitmap, counts, ranked ids, distances, near error)
+    def search(self, queryset, start_date=None, end_date=None):
+        unavailable_ids = None
+        if start_date and end_date:
+            unavailable_ids = availability.unavailable_property_ids(start_date, end_date)
+
+        # keyword search on the address, city and description - see search.py
+        # the ids come back with the best match first, all of them, so that
+        # the filters below are applied to every home that matches
+        self.keywords = self.request.GET.get('q', '').strip()
+        self.ranked_ids = search.ranked_ids(self.keywords) if self.keywords else None
+
+        # homes near a place - see geo.py.  Either the homes within some km
+        # or the nearest few, and then they are shown nearest first
+        self.near_error = None
+        self.distances = {}
+        near = self.request.GET.get('near', '').strip()
+        if near:
+            nearby = self.homes_near(near, queryset)
+            self.distances = dict(nearby)
+            if self.ranked_ids is not None:
+                keyword_ids = set(self.ranked_ids)
+                nearby = [pair for pair in nearby if pair[0] in keyword_ids]
+            self.ranked_ids = [property_id for property_id, km in nearby]
+
+        # only homes with at least min_rating stars, and/or the best rated
+        # homes first.  The ratings are kept on Property (see the Review
+        # receivers in models.py) so this reads the rating index
+        # With only sort=rating there is no list of ids to put in order, the
+        # pages are read in rating order instead - see paginate_queryset
+        min_rating = self.request.GET.get('min_rating', '')
+        min_rating = int(min_rating) if min_rating.isdigit() else None
+        best_first = self.request.GET.get('sort') == 'rating'
+        if min_rating or (best_first and self.ranked_ids is not None):
+            self.ranked_ids = self.rated_ids(min_rating, best_first)
+
+        # the counts next to each filter come from the FacetBitmap table
+        # and if dates were chosen the homes that are not free are left out
+        matching, counts = facets.count_facets(self.filters, unavailable_ids, self.ranked_ids)
+        # only the ranked homes that match are kept, so they are stored in order
+        if self.ranked_ids is not None:
+            self.ranked_ids = [property_id for property_id in self.ranked_ids if matching >> property_id & 1]
+        return matching, counts, self.ranked_ids, self.distances, self.near_error
+
+    # returns [(property id, km away)] nearest first
+    def homes_near(self, near, queryset):
+        point = geo.locate_place(near)
+        if point is None:
+            self.near_error = f"Sorry, we could not find {near}"
+            return []
+        nearest = self.request.GET.get('nearest', '')
+        if nearest.isdigit() and int(nearest) > 0:
+            # the nearest homes have to be found among the ones that match
+            # everything else, otherwise the filters could leave too few.
+            # The keyword search is done by the database as part of the query
+            if self.keywords:
+                queryset = queryset.filter(id__in=search.matching(self.keywords))
+            return geo.nearest(queryset, *point, min(int(nearest), search.MAX_RESULTS))
+        within = self.request.GET.get('within', '')
+        km = int(within) if within.isdigit() else 30
+        # geo.within makes the radius smaller if it is more than geo.MAX_KM
+        return geo.within(Property.objects.all(), *point, km)
+
+    # returns the ids of the homes with at least min_rating stars, out of the
+    # ones found by the keyword or near search if there was one.  With
+    # best_first they are in order of rating, best first, then the homes
+    # from the keyword or near search without a rating in the order they were in
+    def rated_ids(self, min_rating, best_first):
+        homes = Property.objects.all()
+        if min_rating:
+            homes = homes.filter(rating__gte=min_rating)
+        if self.request.GET.get('near', '').strip():
+            homes = homes.filter(id__in=self.ranked_ids)
+        elif self.keywords:
+            # every keyword match can be a long list, so the database
+            # does the keyword search again as part of this query
+            homes = homes.filter(id__in=search.matching(self.keywords))
+        if not best_first:
+            keep = set(homes.values_list('id', flat=True))
+            order = self.ranked_ids if self.ranked_ids is not None else sorted(keep)
+            return [property_id for property_id in order if property_id in keep]
+
+        rated = list(homes.filter(rating__isnull=False).order_by('-rating', '-id').values_list('id', flat=True))
+        if min_rating:
+            return rated
+        rated_set = set(rated)
+        return rated + [property_id for property_id in self.ranked_ids if property_id not in rated_set]
+
+    # page through the bitmap of matching homes, see FacetResults in facets.py
+    def paginate_queryset(self, queryset, page_size):
+        if self.ranked_ids is None and self.request.GET.get('sort') == 'rating':
+            results = facets.RatedResults(self.matching, queryset)
+        else:
+            results = facets.FacetResults(self.matching, queryset, self.ranked_ids)
+        return super().paginate_queryset(results, page_size)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['facets'] = facets.facet_options(self.filters, self.counts)
+        context['near_error'] = self.near_error
+        for property in context['property_list']:
+            property.distance_km = self.distances.get(property.id)
+        # the page links need to keep the filters, but not the page number
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        context['query_string'] = params.urlencode()
+        return context
 
 
 # The view of property detail is a standard generic view
@@ -221,6 +434,10 @@ class PropertyListView(generic.ListView):
 # view is used.  So the stack code will be done
 class PropertyDetailView(generic.DetailView):
     model = Property
+    # load the pictures and their smaller copies in two queries
+    # instead of one query for each picture, and the owner's profile
+    # for their rating with the property
+    queryset = Property.objects.select_related('owner__profile').prefetch_related('image_set__variants')
 
     def get(self, request, *args, **kwargs):
         url = request.path
@@ -232,7 +449,60 @@ class PropertyDetailView(generic.DetailView):
         # It normaly inherits get based on generic.DetailView which
         # is called the superclass so I now call
         # the superclass get method and return its result
-        return super().get(request, *args, **kwargs)
+        # condition() first checks whether the browser's copy of the page is
+        # still right (see page_stamp) and if it is answers 304 Not Modified
+        # without drawing the page at all
+        get_page = condition(etag_func=self.page_etag, last_modified_func=self.page_last_modified)(super().get)
+        response = get_page(request, *args, **kwargs)
+        # the browser can keep the page but must check with us every time
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    # Everything on the page that can change, read with one query using the
+    # primary keys: the property's version (which goes up when the property,
+    # its rating or its pictures change, see models.py), the owner and their
+    # rating, and for a logged in user the numbers that decide the menu
+    def page_stamp(self, request, pk):
+        if not hasattr(self, '_page_stamp'):
+            fields = ['version', 'updated_at', 'owner__username',
+                      'owner__profile__rating_count', 'owner__profile__rating_sum']
+            homes = Property.objects.filter(pk=pk)
+            if request.user.is_authenticated:
+                badges = BadgeCounts.objects.filter(user_id=request.user.id)
+                homes = homes.annotate(
+                    pending_requests=Subquery(badges.values('pending_requests')[:1]),
+                    next_escapes=Subquery(badges.values('next_escapes')[:1]),
+                    badges_counted_on=Subquery(badges.values('counted_on')[:1]),
+                )
+                fields += ['badges_counted_on', 'pending_requests', 'next_escapes']
+            stamp = homes.values_list(*fields).first()
+            # a user with no menu numbers yet, or numbers counted on an
+            # earlier day, gets them counted now, which has to happen anyway
+            # to draw the menu
+            if stamp and request.user.is_authenticated and stamp[-3] != timezone.localdate():
+                counts = badge_counts(request)
+                stamp = stamp[:-3] + (counts.counted_on, counts.pending_requests, counts.next_escapes)
+            self._page_stamp = stamp
+        return self._page_stamp
+
+    # The page also names our css and js files, and after a deploy that
+    # changes them their names have a new hash in them and the old files
+    # are gone, so their names are part of the ETag too
+    page_files = ('css/styles.css', 'js/carousel.js')
+
+    def page_etag(self, request, pk):
+        stamp = self.page_stamp(request, pk)
+        if stamp is None:
+            return None
+        files = '|'.join(static(name) for name in self.page_files)
+        text = f'{request.user.pk}|{stamp}|{files}'
+        return hashlib.md5(text.encode()).hexdigest()
+
+    # only used by browsers that don't send the ETag back.  It doesn't know
+    # about the menu, so a logged in user's menu may be a little out of date
+    def page_last_modified(self, request, pk):
+        stamp = self.page_stamp(request, pk)
+        return stamp[1] if stamp else None
 
 
 # View for booking a property
@@ -246,10 +516,16 @@ def property_book(request, pk):
         form = PropertyBookForm(request.POST, user=request.user)
         if form.is_valid():
             booking_form = form.save(commit=False)
-            booking_form.property = Property.objects.get(pk=pk)
+            booking_form.property = get_object_or_404(Property, pk=pk)
             booking_form.user = request.user
-            booking_form.save()
-            return redirect("home")
+            # reserve() checks that neither home is already in use on these
+            # dates and saves the booking in the same transaction
+            try:
+                availability.reserve(booking_form)
+            except availability.BookingConflict as conflict:
+                form.add_error(None, str(conflict))
+            else:
+                return redirect("home")
     else:
         form = PropertyBookForm(user=request.user)
     return render(request, "booking.html", {"form": form})
@@ -261,48 +537,55 @@ def pending_bookings(request):
     is_back_link = request.GET.get('back', 'false') == 'true'
     visit_page(request, url, is_back_link)
 
+    error = None
     if request.method == 'POST':
         # Capture the booking ID and action from POST data
         booking_id = request.POST.get('booking_id')
         action = request.POST.get('action')
 
-        # Retrieve the booking object
-        booking = Booking.objects.get(id=booking_id)
+        # Retrieve the booking object, only a booking of one of the user's homes
+        booking_id = int(booking_id) if booking_id and booking_id.isdigit() else None
+        booking = get_object_or_404(Booking, id=booking_id, property__owner=request.user)
 
         # Update the booking status based on the action
-        if action == "accept":
-            booking.status = 'accepted'
-        elif action == "decline":
-            booking.status = 'declined'
-
-        booking.save()
-        return redirect("home")
+        # change_status() checks that the days haven't been taken by
+        # another booking since, and if they have the page says so
+        status = {'accept': 'accepted', 'decline': 'declined'}.get(action, booking.status)
+        try:
+            availability.change_status(booking, status)
+        except availability.BookingConflict as conflict:
+            error = str(conflict)
+        else:
+            return redirect("home")
 
-    else:
-        # Decline bookings with a start date in less than one day
-        Booking.objects.filter(date_from__lte=datetime.now() + timedelta(days=1), status='pending').update(status='declined')
+    # Bookings with a start date in less than one day used to be declined
+    # here.  Now the expire_bookings command does that (see expiry.py),
+    # so this page only reads, and it leaves out any stale ones that
+    # the command hasn't got to yet
 
-        # In the end,  I  created  the pending_requests_count  as a dict
-        # using something called a context processor which I stored in   the file
-        # called  context_processors.py in the same directory as this file
-        # And  then  I  had to add it to settings.py under HouseSwap
-        # and then the variable is always available in any template and not just
-        # when this view is being used
-        # Get pending bookings for current user's properties
+    # In the end,  I  created  the pending_requests_count  as a dict
+    # using something called a context processor which I stored in   the file
+    # called  context_processors.py in the same directory as this file
+    # And  then  I  had to add it to settings.py under HouseSwap
+    # and then the variable is always available in any template and not just
+    # when this view is being used
+    # Get pending bookings for current user's properties
 
-        # in order to see if I can do this with my own sort, I commented out this line
-        #bookings = Booking.objects.filter(property__owner=request.user, status='pending').order_by('-date_from')
-        # and instead I just fetch the data and then try to sort it
+    # in order to see if I can do this with my own sort, I commented out this line
+    #bookings = Booking.objects.filter(property__owner=request.user, status='pending').order_by('-date_from')
+    # and instead I just fetch the data and then try to sort it
 
-        # fetch the data
-        bookings = list(Booking.objects.filter(property__owner=request.user, status='pending'))
+    # fetch the data
+    bookings = list(Booking.objects.filter(property__owner=request.user, status='pending', date_from__gt=expiry.cutoff()))
 
-        # apply merge sort
-        bookings = merge_sort(bookings)
+    # apply merge sort
+    bookings = merge_sort(bookings)
 
-        #pending_requests_count = bookings.count()
+    #pending_requests_count = bookings.count()
 
-        return render(request, 'pending_bookings.html', {'bookings': bookings})
+    # a booking that couldn't be accepted is answered with 409 Conflict
+    return render(request, 'pending_bookings.html', {'bookings': bookings, 'error': error},
+                  status=409 if error else 200)
 
 
 def your_next_escapes(request):
@@ -311,7 +594,16 @@ def your_next_escapes(request):
     is_back_link = request.GET.get('back', 'false') == 'true'
     visit_page(request, url, is_back_link)
 
-    bookings = Booking.objects.filter(Q(property__owner=request.user) | Q(my_property__owner=request.user), status='accepted').order_by('-date_from')
+    # the user's homes are looked up in a subquery for each side of the swap
+    # so the database can use the (property, status) and (my_property,
+    # status) indexes.  With a join to Property for each side it read every
+    # accepted booking instead
+    homes = Property.objects.filter(owner=request.user).values('id')
+    bookings = Booking.objects.filter(Q(property__in=homes) | Q(my_property__in=homes), status='accepted').order_by('-date_from')
+    # both homes are shown for every booking, so they are loaded in the same
+    # query instead of one query each per booking.  The template compares
+    # the owner's id so the owner doesn't have to be loaded too
+    bookings = bookings.select_related('property', 'my_property')
     return render(request, 'your_next_escapes.html', {'bookings': bookings})
 
 
@@ -335,112 +627,135 @@ def user_dashboard(request):
     return render(request, "user_dashboard.html", context=context)
 
 
-# This view is the last view I will need for the proof of concept
-# (besides the back buttton)
-# It calls the function below which I called leave_review_sub
-def leave_review(request):
+# The places a user would like to go, and the swaps that were found for them
+# The matches are found when a wish is saved (see matching.py) so this page
+# only reads them
+@login_required
+def swap_matches(request):
 
     url = request.path
     is_back_link = request.GET.get('back', 'false') == 'true'
     visit_page(request, url, is_back_link)
 
-    # Fetch eligible bookings for the current user
-    # Allow for review for pending, accpeted or declined
-    # for example if it stays pending and the other person did not even decline
-    # then a review could be that the other person is not very responsive
-    eligible_bookings = Booking.objects.filter(
-        #status='accepted',  # Assuming 'accepted' status means eligible for review
-        user=request.user
+    if request.method == 'POST':
+        if request.POST.get('action') == 'delete':
+            # the id is checked first, filtering on one that isn't a number
+            # raises ValueError
+            wish_id = request.POST.get('wish_id')
+            wish_id = int(wish_id) if wish_id and wish_id.isdigit() else None
+            get_object_or_404(SwapWish, id=wish_id, owner=request.user).delete()
+            return redirect('swap_matches')
+        form = SwapWishForm(request.POST, user=request.user)
+        if form.is_valid():
+            wish = form.save(commit=False)
+            wish.owner = request.user
+            wish.save()
+            return redirect('swap_matches')
+    else:
+        form = SwapWishForm(user=request.user)
+
+    wishes = SwapWish.objects.filter(owner=request.user).select_related('home').order_by('date_from')
+    matches = (
+        SwapMatch.objects.filter(wishes__owner=request.user, date_to__gte=datetime.now().date())
+        .distinct()
+        .order_by('size', 'date_from')
+        .prefetch_related('wishes__home', 'wishes__owner')
     )
+    return render(request, 'swap_matches.html', {'form': form, 'wishes': wishes, 'matches': matches})
 
-    if request.method == 'POST':
-        booking_id = request.POST.get('booking_id')
-        review_text = request.POST.get('review_text')
-        review_stars = request.POST.get('review_stars')
-        booking = get_object_or_404(Booking, id=booking_id, user=request.user)
 
-        leave_review_sub(booking, request.user, review_text, int(review_stars))
-        return redirect("home")
+# This view is the last view I will need for the proof of concept
+# (besides the back buttton)
+# It used to show every booking of the user and save one review at a time,
+# loading the properties and owners of each booking one by one.  Now it
+# shows only the bookings the user hasn't reviewed yet, with a stars box and
+# a text box for each, and saves all the reviews that were filled in at once.
+# The page takes the same number of queries however many bookings there are
+@login_required
+def leave_review(request):
 
-    return render(request, 'leave_review.html', {'bookings': eligible_bookings})
+    url = request.path
+    is_back_link = request.GET.get('back', 'false') == 'true'
+    visit_page(request, url, is_back_link)
 
+    error = None
+    if request.method == 'POST':
+        try:
+            reviews = leave_reviews(request.user, request.POST)
+        except ValueError as problem:
+            error = str(problem)
+        else:
+            if reviews:
+                return redirect("home")
+            error = "Please give some stars to at least one booking."
+
+    bookings = list(bookings_awaiting_review(request.user))
+    for booking in bookings:
+        booking.property_to_review = reviewed_property(booking, request.user)
+    return render(request, 'leave_review.html', {'bookings': bookings, 'error': error})
+
+
+# Bookings the user is in, on either side, that they haven't reviewed yet
+# Allow for review for pending, accpeted or declined
+# for example if it stays pending and the other person did not even decline
+# then a review could be that the other person is not very responsive
+# The NOT EXISTS (an anti-join) uses the (booking, reviewer) index on Review
+def bookings_awaiting_review(user):
+    reviewed = Review.objects.filter(booking=OuterRef('pk'), reviewer=user)
+    # the ids of the user's homes are used instead of joining Property, so
+    # both sides of the OR can use an index
+    my_homes = Property.objects.filter(owner=user).values('id')
+    return (
+        Booking.objects.filter(Q(user=user) | Q(property_id__in=my_homes))
+        .exclude(Exists(reviewed))
+        .select_related('property', 'my_property')
+        .order_by('-date_from', 'id')
+    )
 
-def leave_review_sub(booking, reviewer, review_text, review_stars):
 
-    # Determine the property to be reviewed and the reviewer
-    if booking.property.owner == reviewer:
-        property_reviewed = booking.my_property
-    elif booking.my_property.owner == reviewer:
-        property_reviewed = booking.property
-    else:
-        raise Exception("Invalid reviewer for this booking.")
-
-    # Create a review
-    review = Review.objects.create(
-        booking=booking,
-        property_reviewed=property_reviewed,
-        reviewer=reviewer,
-        text=review_text,
-        stars=review_stars
-    )
-    return review
-
-
-# This creates a stack class for the go back link
-# I have used the Python inbuilt list to do this
-# I don't need the peek method which stacks normally have
-# because I will never look at and item in the stack without removing it
-# but I programmed it in anyway
-# I had a big problem that I am storing this Stack with all the other session
-# information that Django stores.  And Django stores it in a json format and
-# it can only deal with simple things like dictionaries or lists.
-# So each time I use this stack I have to turn it into a simple list.
-# so I added two methods at the end.  One which extracts the list of items
-# from the Stach and another one which creates a stack from a list of items
-
-class Stack:
-    # when I first called the stack, the items in it is an empty list
-    def __init__(self):
-        self.items = []
-
-    # I do the push method using the append method of python lists
-    def push(self, item):
-        self.items.append(item)
-
-    # I do the pop method using the pop method of lists
-    def pop(self):
-        return self.items.pop() if len(self.items) >= 1 else None
-
-    # I dont use this and I have not checked what happens if it tries
-    # to peek at a list which has nothing in it
-    def peek(self):
-        return self.items[-1]
-
-    # I will probably need to use is_empty to handle cases where the user
-    # presses the back link and the stack is empty
-    def is_empty(self):
-        return len(self.items) == 0
-
-    # I might used the size method to make sure I dont ever grow the stack too big
-    def size(self):
-        return len(self.items)
-
-    # I need to turn this class in to a dictionary since Django will not save
-    # it properly otherwise
-    def to_json(self):
-        return self.items
-
-    # and here I need to turn it back again
-    # I added the @staticmethod because I was getting errors because I don't
-    # need this method to receive self autmatically as the first argument
-    # because it actually makes a Stack in the first line when it says
-    # stack = Stack()
-    @staticmethod
-    def from_json(json_data):
-        stack = Stack()
-        for item in json_data:
-            stack.push(item)
-        return stack
+# The user reviews the other home in the swap.  Only the owner ids are
+# compared, so the owners don't need loading
+def reviewed_property(booking, reviewer):
+    if booking.property.owner_id == reviewer.id:
+        return booking.my_property
+    elif booking.my_property.owner_id == reviewer.id:
+        return booking.property
+    raise Exception("Invalid reviewer for this booking.")
+
+
+# Saves a review for each booking on the page that was given some stars,
+# in one transaction.  The form has "stars-<booking id>" and
+# "text-<booking id>" for each booking.  Raises ValueError when some stars
+# aren't a number from 1 to 5, and then nothing is saved
+def leave_reviews(reviewer, data):
+    booking_ids = []
+    for name, value in data.items():
+        if name.startswith('stars-') and name[6:].isdigit() and value.strip():
+            booking_ids.append(int(name[6:]))
+    if not booking_ids:
+        return []
+
+    with transaction.atomic():
+        # asking again which bookings still need a review means a form sent
+        # twice, or for somebody else's booking, doesn't save anything
+        reviews = []
+        for booking in bookings_awaiting_review(reviewer).filter(id__in=booking_ids):
+            stars = data[f'stars-{booking.id}'].strip()
+            if not stars.isdigit() or not 1 <= int(stars) <= 5:
+                raise ValueError("Stars must be a number from 1 to 5.")
+            reviews.append(Review(
+                booking=booking,
+                property_reviewed=reviewed_property(booking, reviewer),
+                reviewer=reviewer,
+                text=data.get(f'text-{booking.id}', '')[:100],
+                stars=int(stars),
+            ))
+        Review.objects.bulk_create(reviews)
+        # bulk_create doesn't send post_save so the ratings are worked out
+        # again for the homes that were reviewed
+        rebuild_ratings({review.property_reviewed_id for review in reviews})
+    return reviews
+
 
 # This view is for the 'back' link
 # It is actually quite complicated to do this
@@ -452,38 +767,19 @@ class Stack:
 # It turns out that I can do this using the normal redirect function and add
 # to it the argument back=true by typing ?back=true
 def go_back(request):
-    visited_links = request.session.get('visited_links', Stack())
-    print('start of go_back - visited links')
-    if not isinstance(visited_links, Stack):
-        temp = Stack()
-        visited_links = temp.from_json(visited_links)
-
-    print('before pop')
-    print(visited_links)
-    last_visited = visited_links.pop()
-    # put the list I am using for a stack back into the session
-    request.session['visited_links'] = visited_links.to_json()
+    last_visited = history.go_back(request)
     # check if anything came off the stack
     # I mean that if it is empty then nothing will come off it
     if last_visited:
         return redirect(f"{last_visited}?back=true")
     else:
-        return redirect(home)
+        return redirect("home")
 
 
 # This function is called in every single view
 # and it add the page if the user is not coming from the go_back
-# view just above here in the code
+# view just above here in the code
+# The list of pages is kept in history.py and saved once the page is ready
+# by NavigationHistoryMiddleware, and only if it has changed
 def visit_page(request, url, is_back_link):
-    print('is_back_link')
-    print(is_back_link)
-    visited_links = request.session.get('visited_links', Stack())
-    if not isinstance(visited_links, Stack):
-        temp = Stack()
-        visited_links = temp.from_json(visited_links)
-    print(visited_links.items)
-
-    if not is_back_link:
-        visited_links.push(url)
-        # Save the updated stack is saved back to the session
-        request.session['visited_links'] = visited_links.to_json()
+    history.visit(request, url, is_back_link)